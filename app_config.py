@@ -12,6 +12,8 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 # Application's generated client secret: never check this into source control!
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 TENANT_ID = os.getenv("TENANT_ID")
+# App role (Entra ID app registration) required by maintenance operations such as the message archiver run
+ADMIN_ROLE = os.getenv("ADMIN_ROLE", "Admin")
 
 # Azure Blob Storage - Used for storing image uploads
 UPLOAD_FOLDER = "uploads"
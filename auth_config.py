@@ -1,6 +1,8 @@
+from fastapi import Depends, HTTPException
 from fastapi_azure_auth import SingleTenantAzureAuthorizationCodeBearer
+from fastapi_azure_auth.user import User
 
-from app_config import CLIENT_ID, TENANT_ID, APP_SCOPE
+from app_config import CLIENT_ID, TENANT_ID, APP_SCOPE, ADMIN_ROLE
 
 # https://intility.github.io/fastapi-azure-auth/single-tenant/fastapi_configuration/
 azure_scheme = SingleTenantAzureAuthorizationCodeBearer(
@@ -8,4 +10,10 @@ azure_scheme = SingleTenantAzureAuthorizationCodeBearer(
     tenant_id=TENANT_ID,
     scopes={'api://' + APP_SCOPE + '/access_as_user':'access_as_user'},
     allow_guest_users=True
-)
\ No newline at end of file
+)
+
+async def require_admin(user: User = Depends(azure_scheme)) -> User:
+    """Authenticated user holding the ADMIN_ROLE app role."""
+    if ADMIN_ROLE not in (user.roles or []):
+        raise HTTPException(status_code=403, detail=f"The {ADMIN_ROLE} role is required for this operation.")
+    return user
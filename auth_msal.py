@@ -1,5 +1,6 @@
 import os
-import requests
+import asyncio
+import httpx
 from fastapi import Depends, HTTPException, status, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, JWTError
@@ -13,13 +14,17 @@ bearer_scheme = HTTPBearer()
 
 # Cache keys for performance
 _jwks = None
+_jwks_lock = asyncio.Lock()
 
 async def get_jwks():
     global _jwks
     if not _jwks:
-        resp = requests.get(JWKS_URL)
-        resp.raise_for_status()
-        _jwks = resp.json()
+        async with _jwks_lock:
+            if not _jwks:
+                async with httpx.AsyncClient(timeout=10) as client:
+                    resp = await client.get(JWKS_URL)
+                    resp.raise_for_status()
+                    _jwks = resp.json()
     return _jwks
 
 async def verify_jwt_token(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
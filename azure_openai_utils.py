@@ -1,4 +1,5 @@
 import os
+import asyncio
 import base64
 import logging
 import json
@@ -6,10 +7,9 @@ import re
 from fastapi.responses import StreamingResponse
 import requests
 import datetime
-import tiktoken
 
 from fastapi import UploadFile
-from openai import APIConnectionError, AsyncAzureOpenAI, AzureOpenAI, BadRequestError, RateLimitError
+from openai import AsyncAzureOpenAI, AzureOpenAI, BadRequestError, RateLimitError
 from azure.storage.blob import BlobServiceClient
 from azure.storage.blob import generate_blob_sas, BlobSasPermissions
 
@@ -18,14 +18,23 @@ from data.ModelConfiguration import ModelConfiguration
 
 from azure.identity import DefaultAzureCredential, ClientSecretCredential
 from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
-from azure.search.documents import SearchClient
 
 from dependencies import NiaAzureOpenAIClient
+from completion_executor import CompletionPolicy, CompletionFailedError, completion_executor
+from search_cache import cached_search
+from blocking_io import run_blocking
+from pipeline import Pipeline
+from token_ledger import ledger_for, ConversationTokens
+from context_builder import context_builder, CONTEXT_HISTORY_MAX_MESSAGES
+from conversation_summarizer import conversation_summarizer
+from search_context import search_context_compactor
+from intent_router import intent_router, log_tool_call
+from response_cache import CacheKey, response_cache, replay_stream, RESPONSE_CACHE_ENABLED
 from gpt_utils import extract_json_content, extract_response, get_previous_context_conversations, get_token_count, handle_upload_files
 from standalone_programs.image_analyzer import analyze_image
 from dotenv import load_dotenv # For environment variables (recommended)
 
-from mongo_service import fetch_chat_history, delete_chat_history, update_message, get_usecases
+from mongo_service import fetch_chat_history, update_message, get_usecases
 from role_mapping import ALL_FIELDS, FORMAT_RESPONSE_AS_MARKDOWN, FUNCTION_CALLING_USER_MESSAGE, NIA_FINOLEX_PDF_SEARCH_SEMANTIC_CONFIGURATION_NAME, NIA_FINOLEX_SEARCH_INDEX, NIA_SEMANTIC_CONFIGURATION_NAME, USE_CASE_CONFIG, CONTEXTUAL_PROMPT, SUMMARIZE_MODEL_CONFIGURATION, USE_CASES_LIST, FUNCTION_CALLING_SYSTEM_MESSAGE, get_role_information
 from standalone_programs.simple_gpt import run_conversation, ticket_conversations, get_conversation
 from routes.ilama32_routes import chat2
@@ -38,7 +47,6 @@ load_dotenv()  # Load environment variables from .env file
 # Create a logger for this module
 logger = logging.getLogger(__name__)
 
-token_encoder = tiktoken.encoding_for_model("gpt-4o") 
 
 # Model = should match the deployment name you chose for your model deployment
 delimiter = "```"
@@ -74,6 +82,11 @@ AZURE_BLOB_STORAGE_CONTAINER=os.getenv("BLOB_STORAGE_CONTAINER_NAME")
 AZURE_BLOB_STORAGE_ACCOUNT_NAME=os.getenv("BLOB_STORAGE_ACCOUNT_NAME")
 AZURE_BLOB_STORAGE_ACCESS_KEY=os.getenv("BLOB_STORAGE_ACCESS_KEY")
 
+# Speculative retrieval: search with the raw user message while the function calling model decides the real query.
+# Off by default, it adds an Azure Search query to every RAG turn whose tool call asks for something else.
+SPECULATIVE_SEARCH_ENABLED = os.getenv("SPECULATIVE_SEARCH_ENABLED", "false").lower() == "true"
+SPECULATIVE_SEARCH_MIN_SIMILARITY = float(os.getenv("SPECULATIVE_SEARCH_MIN_SIMILARITY", 0.6))
+
 DEFAULT_ERROR_RESPONSE_FROM_MODEL="The requested information is not available in the retrieved data. Please try another query or topic."
 DEFAULT_FOLLOW_UP_QUESTIONS = ["I would like to know more about this topic", "I need further clarification", "Rephrase your findings"]
 
@@ -104,6 +117,31 @@ async def getAzureOpenAIClient(azure_endpoint: str, api_key: str, api_version: s
     
     return client
 
+def get_retry_models(prefix: str = "GPT_RETRY_MODELS") -> list[str]:
+    """Alternate deployments (GPT_RETRY_MODELS_1..n) used when the primary deployment is rate limited."""
+    models_to_try = []
+    i = 1
+    while True:
+        alt_model = os.getenv(f"{prefix}_{i}")
+        if not alt_model:
+            break
+        models_to_try.append(alt_model)
+        i += 1
+    return models_to_try
+
+def get_vision_retry_models() -> list[str]:
+    """Alternate vision capable deployments (GPT_VISION_RETRY_MODELS_1..n) for image analysis. The generic retry models may not accept images."""
+    return get_retry_models("GPT_VISION_RETRY_MODELS")
+
+async def estimate_request_tokens(gpt: GPTData, conversations: list, model_configuration: ModelConfiguration, deployment: str = None) -> int:
+    """Pre-flight token estimate (prompt + max response) used to find a deployment with TPM headroom, counted for deployment (default: the gpt's)."""
+    token_data = await get_token_count(deployment or gpt["name"], gpt["instructions"], conversations, "", int(model_configuration.max_tokens))
+    return token_data["token_breakdown"]["estimated_max_tokens"]
+
+def estimate_messages_tokens(model_name: str, messages: list, max_tokens: int) -> int:
+    """Pre-flight token estimate (prompt + max response) of a message list without a gpt, counted with the deployment's encoding."""
+    return ConversationTokens(messages, model_name).total() + max_tokens
+
 def get_azure_search_parameters(search_endpoint: str, index_name: str, search_key: str, role_information: str, index_fields: list):
     extra_body = {
         "data_sources": [{
@@ -145,8 +183,8 @@ async def store_to_blob_storage(uploadedImage: UploadFile = None):
         # Initialize Blob Service Client
         blob_client = blob_service_client.get_blob_client(container=AZURE_BLOB_STORAGE_CONTAINER, blob=file_name)
 
-        # Upload image to Azure Blob Storage
-        blob_client.upload_blob(uploadedImage.file, overwrite=True)
+        # Upload image to Azure Blob Storage (the sync SDK call runs in the blocking I/O pool)
+        await run_blocking(blob_client.upload_blob, uploadedImage.file, overwrite=True)
 
         # Generate a SAS token (valid for 60 minutes)
         sas_token = generate_blob_sas(
@@ -202,18 +240,16 @@ async def saveAssistantResponse(response: str, gpt: GPTData, conversations: list
 
         conversations.append({"role": "assistant", "content": response}) # Append the response to the conversation history
 
-async def get_completion_from_messages_standard(gpt: GPTData, model_configuration, conversations, use_case, role_information):
+async def get_completion_from_messages_standard(gpt: GPTData, model_configuration, conversations, use_case, role_information, cache_key: CacheKey = None):
     model_response = "No Response from Model"
     main_response = ""
     total_tokens = 0
     follow_up_questions = []
     reasoning = ""
 
-    # This client is synchronous and doesn't need await signal. Set stream=False
+    # This call is not streamed. Set stream=False
 
     try:
-        # Get Azure Open AI Client and fetch response
-        client = await getAzureOpenAIClient(AZURE_ENDPOINT_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL_API_VERSION, False)
         model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
         extra_body = {}
         
@@ -226,8 +262,10 @@ async def get_completion_from_messages_standard(gpt: GPTData, model_configuratio
                 #extra_body = get_azure_search_parameters(search_endpoint, search_index, search_key, role_information, ecomm_rag_demo_index_fields)
                 pass
         
-        response = await client.chat.completions.create(
-            model=gpt["name"],
+        # Fetch the response. Endpoint failover and model fallback are handled by the completion executor
+        response = await completion_executor.create(
+            CompletionPolicy(models=[gpt["name"]] + get_retry_models(), hedge=True),
+            await estimate_request_tokens(gpt, conversations, model_configuration),
             messages=conversations,
             max_tokens=model_configuration.max_tokens, #max_tokens is now deprecated with o1 models
             temperature=model_configuration.temperature,
@@ -237,11 +275,9 @@ async def get_completion_from_messages_standard(gpt: GPTData, model_configuratio
             extra_body=extra_body,
             seed=100,
             stop=None,
-            stream=False,
             user=gpt["user"]
             #n=2,
             #reasoning_effort="low", # available for o1,o3 models only
-            #timeout=30,
         )
         model_response = response.choices[0].message.content
         logger.info(f"Full Model Response is {response}")
@@ -251,124 +287,23 @@ async def get_completion_from_messages_standard(gpt: GPTData, model_configuratio
             main_response = "No Response from Model. Please try again."
         else:            
             main_response, follow_up_questions, total_tokens = await extract_json_content(response)
-    
-    except (APIConnectionError) as retryable_ex:
-        logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-
-        from dependencies import NiaAzureOpenAIClient
-        logger.info(f"Retrying with next endpoint")
-        client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
-        try:
-            response = await client.chat.completions.create(
-                model=gpt["name"],
-                messages=conversations,
-                max_tokens=model_configuration.max_tokens,
-                temperature=model_configuration.temperature,
-                top_p=model_configuration.top_p,
-                frequency_penalty=model_configuration.frequency_penalty,
-                presence_penalty=model_configuration.presence_penalty,
-                extra_body=extra_body,
-                seed=100,
-                stop=None,
-                stream=False,
-                user=gpt["user"]
-            )
-            model_response = response.choices[0].message.content
-            logger.info(f"Retry Model Response is {response}")
-
-            if model_response is None or model_response == "":
-                main_response = "No Response from Model. Please try again."
-            else:
-                main_response, follow_up_questions, total_tokens = await extract_json_content(response)
-
-        except Exception as final_ex:
-            logger.error(f"Retry also failed: {final_ex}", exc_info=True)
-            total_tokens = len(token_encoder.encode(str(conversations)))
-            main_response = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex)}"
-
-    except (RateLimitError) as retryable_ex:
-        logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-
-        from dependencies import NiaAzureOpenAIClient
-        logger.info(f"Retrying with next models")
-        # Gather all retry model names from environment variables
-        models_to_try = []
-        i = 1
-        while True:
-            model_env_var = f"GPT_RETRY_MODELS_{i}"
-            alt_model = os.getenv(model_env_var)
-            if not alt_model:
-             break
-            models_to_try.append(alt_model)
-            i += 1
-
-        # Helper to call the model
-        async def call_model(client, model_name, conversations, model_configuration):
-            response = await client.chat.completions.create(
-            model=model_name,
-            messages=conversations,
-            max_tokens=model_configuration.max_tokens,
-            temperature=model_configuration.temperature,
-            top_p=model_configuration.top_p,
-            frequency_penalty=model_configuration.frequency_penalty,
-            presence_penalty=model_configuration.presence_penalty,
-            extra_body=extra_body,
-            seed=100,
-            stop=None,
-            stream=False,
-            user=gpt["user"]
-            )
-            model_response = response.choices[0].message.content
-            if model_response is None or model_response == "":
-                raise ValueError("No Response from Model. Please try again.")
-            return await extract_json_content(response)
-
-        success = False
-        for alt_model in models_to_try:
-            try:
-                main_response, follow_up_questions, total_tokens = await call_model(
-                    client, alt_model, conversations, model_configuration
-                )
-                logger.info(f"Succeeded with alternate model '{alt_model}'")
-                success = True
-                break
-
-            except RateLimitError as alt_rl_ex:
-                logger.warning(
-                    f"Rate-limit on alternate model '{alt_model}': {alt_rl_ex!s}",
-                    exc_info=True,
-                )
-                continue  # try the next model
-
-            except APIConnectionError as alt_conn_ex:
-                logger.warning(
-                    f"Connection issue on alternate model '{alt_model}': {alt_conn_ex!s}",
-                    exc_info=True,
-                )
-                break
-
-        # If we exhausted the loop with no success, go to the next subscription
-        if not success:
-            logger.info("All models on this endpoint exhausted – switching subscription")
-            client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
 
-            try:
-                # Start again with the original model on the new endpoint
-                main_response, follow_up_questions, total_tokens = await call_model(
-                    client, gpt["name"], conversations, model_configuration
-                )
-
-            except Exception as final_ex:
-                logger.error("Retry with next subscription also failed", exc_info=True)
-                total_tokens = len(token_encoder.encode(str(conversations)))
-                main_response = (
-                    "All Azure OpenAI endpoints failed. Please try again later.\n\n"
-                    f"Exception Details: {final_ex}"
-                )
+            if cache_key is not None:
+                await response_cache.put(cache_key, {
+                    "model_response": main_response,
+                    "total_tokens": total_tokens,
+                    "follow_up_questions": follow_up_questions,
+                    "reasoning": reasoning
+                })
+    
+    except CompletionFailedError as final_ex:
+        logger.error(f"Retry also failed: {final_ex}", exc_info=True)
+        total_tokens = ledger_for(gpt["name"]).count_messages(conversations, deployment=gpt["name"])
+        main_response = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex.last_exception)}"
         
     except BadRequestError as be:
         logger.error(f"BadRequestError occurred while fetching model response: {be}", exc_info=True)
-        total_tokens = len(token_encoder.encode(str(conversations)))
+        total_tokens = ledger_for(gpt["name"]).count_messages(conversations, deployment=gpt["name"])
         main_response = f"Bad Request error occurred while reaching to Azure Open AI. \n\n Exception Details : " + be.message
     
     except Exception as e:
@@ -385,11 +320,9 @@ async def get_completion_from_messages_standard(gpt: GPTData, model_configuratio
         "reasoning" : reasoning
     }
 
-async def get_completion_from_messages_stream(gpt: GPTData, model_configuration, conversations, use_case, role_information):
-     # This client is asynchronous and needs await signal. Set stream=True
+async def get_completion_from_messages_stream(gpt: GPTData, model_configuration, conversations, use_case, role_information, cache_key: CacheKey = None):
+     # This call is streamed. Set stream=True
     try:
-        # Get Azure Open AI Client and fetch response
-        client = await getAzureOpenAIClient(AZURE_ENDPOINT_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL_API_VERSION, True)
         model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
         extra_body = {}
 
@@ -402,15 +335,18 @@ async def get_completion_from_messages_stream(gpt: GPTData, model_configuration,
                 #extra_body = get_azure_search_parameters(search_endpoint, search_index, search_key, role_information, ecomm_rag_demo_index_fields)
                 pass
         
+        estimated_tokens = await estimate_request_tokens(gpt, conversations, model_configuration)
         full_response_content = ""
         
-        async def stream_processor():
+        # Create a wrapper generator that handles post-stream processing
+        async def response_wrapper():
             nonlocal full_response_content
-            nonlocal client
-
+            nonlocal gpt
             try:
-                response = await client.chat.completions.create(
-                    model=gpt["name"],
+                # Endpoint failover and model fallback are handled by the completion executor
+                async for chunk in completion_executor.stream(
+                    CompletionPolicy(models=[gpt["name"]] + get_retry_models()),
+                    estimated_tokens,
                     messages=conversations,
                     max_tokens=model_configuration.max_tokens,
                     temperature=model_configuration.temperature,
@@ -418,135 +354,21 @@ async def get_completion_from_messages_stream(gpt: GPTData, model_configuration,
                     frequency_penalty=model_configuration.frequency_penalty,
                     presence_penalty=model_configuration.presence_penalty,
                     stop=None,
-                    stream=True,
                     extra_body=extra_body,
                     seed=100,
                     user=gpt["user"]
-                )
-
-                async for chunk in response:
-                    if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
-                        chunkContent = chunk.choices[0].delta.content
-                        if chunkContent is not None:
-                            full_response_content += chunkContent
-                            yield chunkContent
-
-            except APIConnectionError as retryable_ex:
-                logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-                logger.info(f"Retrying with next endpoint")
-                client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
-                try:
-                    response = await client.chat.completions.create(
-                        model=gpt["name"],
-                        messages=conversations,
-                        max_tokens=model_configuration.max_tokens,
-                        temperature=model_configuration.temperature,
-                        top_p=model_configuration.top_p,
-                        frequency_penalty=model_configuration.frequency_penalty,
-                        presence_penalty=model_configuration.presence_penalty,
-                        extra_body=extra_body,
-                        seed=100,
-                        stop=None,
-                        stream=True,
-                        user=gpt["user"]
-                    )
-
-                    async for chunk in response:
-                        if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
-                            chunkContent = chunk.choices[0].delta.content
-                            if chunkContent is not None:
-                                full_response_content += chunkContent
-                                yield chunkContent
-                except Exception as final_ex:
-                    logger.error(f"Retry also failed: {final_ex}", exc_info=True)
-                    full_response_content = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex)}"
-                    yield full_response_content
-
-            except RateLimitError as retryable_ex:
-                logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-                logger.info(f"Retrying with next models")
-                # Gather all retry model names from environment variables
-                models_to_try = []
-                i = 1
-                while True:
-                    model_env_var = f"GPT_RETRY_MODELS_{i}"
-                    alt_model = os.getenv(model_env_var)
-                    if not alt_model:
-                        break
-                    models_to_try.append(alt_model)
-                    i += 1
-
-                # Helper to call the model
-                async def call_model(client, model_name, conversations, model_configuration):
-                    response = await client.chat.completions.create(
-                        model=model_name,
-                        messages=conversations,
-                        max_tokens=model_configuration.max_tokens,
-                        temperature=model_configuration.temperature,
-                        top_p=model_configuration.top_p,
-                        frequency_penalty=model_configuration.frequency_penalty,
-                        presence_penalty=model_configuration.presence_penalty,
-                        extra_body=extra_body,
-                        seed=100,
-                        stop=None,
-                        stream=True,
-                        user=gpt["user"]
-                    )
-                    async for chunk in response:
-                        if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
-                            chunkContent = chunk.choices[0].delta.content
-                            if chunkContent is not None:
-                                nonlocal full_response_content
-                                full_response_content += chunkContent
-                                yield chunkContent
-
-                success = False
-                for alt_model in models_to_try:
-                    try:
-                        async for chunk in call_model(client, alt_model, conversations, model_configuration):
-                            yield chunk
-                        logger.info(f"Succeeded with alternate model '{alt_model}'")
-                        success = True
-                        break
-
-                    except RateLimitError as alt_rl_ex:
-                        logger.warning(
-                            f"Rate-limit on alternate model '{alt_model}': {alt_rl_ex!s}",
-                            exc_info=True,
-                        )
-                        continue  # try the next model
-
-                    except APIConnectionError as alt_conn_ex:
-                        logger.warning(
-                            f"Connection issue on alternate model '{alt_model}': {alt_conn_ex!s}",
-                            exc_info=True,
-                        )
-                        break
-
-                # If we exhausted the loop with no success, go to the next subscription
-                if not success:
-                    logger.info("All models on this endpoint exhausted – switching subscription")
-                    client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
-                    try:
-                        async for chunk in call_model(client, gpt["name"], conversations, model_configuration):
-                            yield chunk
-                    except Exception as final_ex:
-                        logger.error("Retry with next subscription also failed", exc_info=True)
-                        full_response_content = (
-                            "All Azure OpenAI endpoints failed. Please try again later.\n\n"
-                            f"Exception Details: {final_ex}"
-                        )
-                        yield full_response_content
-        
-        # Create a wrapper generator that handles post-stream processing
-        async def response_wrapper():
-            nonlocal full_response_content
-            nonlocal gpt
-            try:
-                async for chunk in stream_processor():
-                    #logger.info(f"chunk data {chunk}")
+                ):
+                    full_response_content += chunk
                     yield chunk
-            
+
+                if cache_key is not None and full_response_content != "":
+                    await response_cache.put(cache_key, {"model_response": full_response_content})
+
+            except CompletionFailedError as final_ex:
+                logger.error(f"Retry also failed: {final_ex}", exc_info=True)
+                full_response_content = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex.last_exception)}"
+                yield full_response_content
+
             except BadRequestError as be:
                 logger.error(f"BadRequestError occurred while fetching model response: {be}", exc_info=True)
                 full_response_content = f"Bad Request error occurred while reaching to Azure Open AI. \n\n Exception Details : " + be.message
@@ -569,17 +391,16 @@ async def get_completion_from_messages_stream(gpt: GPTData, model_configuration,
         logger.error(f"Error occurred while fetching model response: {e}", exc_info=True)
         return StreamingResponse(iter([str(e)]), media_type="text/event-stream")
 
-async def get_completion_from_messages_default(model_name: str, use_rag: bool, messages: list, model_configuration: ModelConfiguration):
+async def get_completion_from_messages_default(model_name: str, use_rag: bool, messages: list, model_configuration: ModelConfiguration, raise_errors: bool = False):
 
     model_response = "No Response from Model"
 
-    # Get Azure Open AI Client and fetch response
-    client = await getAzureOpenAIClient(AZURE_ENDPOINT_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL_API_VERSION, False)
-    model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
-
     try:
-        response = await client.chat.completions.create(
-            model=model_name,
+        model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
+
+        response = await completion_executor.create(
+            CompletionPolicy(models=[model_name] + get_retry_models()),
+            estimate_messages_tokens(model_name, messages, int(model_configuration.max_tokens)),
             messages=messages,
             max_tokens=model_configuration.max_tokens,
             temperature=model_configuration.temperature,
@@ -587,7 +408,6 @@ async def get_completion_from_messages_default(model_name: str, use_rag: bool, m
             frequency_penalty=model_configuration.frequency_penalty,
             presence_penalty=model_configuration.presence_penalty,
             stop=None,
-            stream=False,
             seed=100
         )
         logger.info(f"Default Model Response is {response}")
@@ -595,6 +415,8 @@ async def get_completion_from_messages_default(model_name: str, use_rag: bool, m
         #logger.info(f"Tokens used: {response.usage.total_tokens}")
     except Exception as e:
         logger.error(f"Error occurred while fetching model response: {e}", exc_info=True)
+        if raise_errors:
+            raise
         model_response = str(e)
     
     return model_response
@@ -605,159 +427,44 @@ async def analyzeImage_standard(gpt: GPTData, conversations, model_configuration
     total_tokens = 0
     follow_up_questions = []
 
-    # Get Azure Open AI Client and fetch response
-    #client = getAzureOpenAIClient(gpt4o_endpoint, gpt4o_api_key, gpt4o_api_version, False)
     try:
-        client = await getAzureOpenAIClient(AZURE_ENDPOINT_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL_API_VERSION, False)
         model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
 
-        try:
-            response = await client.chat.completions.create(
-                model=GPT_4o_2_MODEL_NAME,
-                messages=conversations,
-                max_tokens=model_configuration.max_tokens,
-                temperature=model_configuration.temperature,
-                top_p=model_configuration.top_p,
-                frequency_penalty=model_configuration.frequency_penalty,
-                presence_penalty=model_configuration.presence_penalty,
-                stop=None,
-                stream=False,
-                seed=100
-            )
-            model_response = response.choices[0].message.content
-            #logger.info(f"Model Response is {response}")
-            #logger.info(f"Tokens used: {response.usage.total_tokens}")
-
-            if model_response is None or model_response == "":
-                model_response = "No Response from Model. Please try again."
-            else:
-                main_response, follow_up_questions, total_tokens = await processResponse(response)
-
-            # Log the response to database
-            if save_response_to_db:
-                await saveAssistantResponse(main_response, gpt, conversations)
-
-        except Exception as e:
-            logger.error(f"Error occurred while fetching model response: {e}", exc_info=True)
-            main_response = str(e)
+        # Image analysis only falls back to the vision capable deployments
+        response = await completion_executor.create(
+            CompletionPolicy(models=[GPT_4o_2_MODEL_NAME] + get_vision_retry_models()),
+            await estimate_request_tokens(gpt, conversations, model_configuration, GPT_4o_2_MODEL_NAME),
+            messages=conversations,
+            max_tokens=model_configuration.max_tokens,
+            temperature=model_configuration.temperature,
+            top_p=model_configuration.top_p,
+            frequency_penalty=model_configuration.frequency_penalty,
+            presence_penalty=model_configuration.presence_penalty,
+            stop=None,
+            seed=100,
+            user=gpt["user"]
+        )
+        model_response = response.choices[0].message.content
+        #logger.info(f"Model Response is {response}")
+        #logger.info(f"Tokens used: {response.usage.total_tokens}")
 
-    except (APIConnectionError) as retryable_ex:
-        logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
+        if model_response is None or model_response == "":
+            main_response = "No Response from Model. Please try again."
+        else:
+            main_response, follow_up_questions, total_tokens = await processResponse(response)
 
-        from dependencies import NiaAzureOpenAIClient
-        logger.info(f"Retrying with next endpoint")
-        client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
-        try:
-            response = await client.chat.completions.create(
-                model=gpt["name"],
-                messages=conversations,
-                max_tokens=model_configuration.max_tokens,
-                temperature=model_configuration.temperature,
-                top_p=model_configuration.top_p,
-                frequency_penalty=model_configuration.frequency_penalty,
-                presence_penalty=model_configuration.presence_penalty,
-                # extra_body=extra_body,
-                seed=100,
-                stop=None,
-                stream=False,
-                user=gpt["user"]
-            )
-            model_response = response.choices[0].message.content
-            logger.info(f"Retry Model Response is {response}")
-
-            if model_response is None or model_response == "":
-                main_response = "No Response from Model. Please try again."
-            else:
-                main_response, follow_up_questions, total_tokens = await extract_json_content(response)
-
-        except Exception as final_ex:
-            logger.error(f"Retry also failed: {final_ex}", exc_info=True)
-            total_tokens = len(token_encoder.encode(str(conversations)))
-            main_response = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex)}"
-
-    except (RateLimitError) as retryable_ex:
-        logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-
-        from dependencies import NiaAzureOpenAIClient
-        logger.info(f"Retrying with next models")
-        # Gather all retry model names from environment variables
-        models_to_try = []
-        i = 1
-        while True:
-            model_env_var = f"GPT_RETRY_MODELS_{i}"
-            alt_model = os.getenv(model_env_var)
-            if not alt_model:
-                break
-            models_to_try.append(alt_model)
-            i += 1
-
-        # Helper to call the model
-        async def call_model(client, model_name, conversations, model_configuration):
-            response = await client.chat.completions.create(
-                model=model_name,
-                messages=conversations,
-                max_tokens=model_configuration.max_tokens,
-                temperature=model_configuration.temperature,
-                top_p=model_configuration.top_p,
-                frequency_penalty=model_configuration.frequency_penalty,
-                presence_penalty=model_configuration.presence_penalty,
-                # extra_body=extra_body,
-                seed=100,
-                stop=None,
-                stream=False,
-                user=gpt["user"]
-            )
-            model_response = response.choices[0].message.content
-            if model_response is None or model_response == "":
-                raise ValueError("No Response from Model. Please try again.")
-            return await extract_json_content(response)
-
-        success = False
-        for alt_model in models_to_try:
-            try:
-                main_response, follow_up_questions, total_tokens = await call_model(
-                    client, alt_model, conversations, model_configuration
-                )
-                logger.info(f"Succeeded with alternate model '{alt_model}'")
-                success = True
-                break
-
-            except RateLimitError as alt_rl_ex:
-                logger.warning(
-                    f"Rate-limit on alternate model '{alt_model}': {alt_rl_ex!s}",
-                    exc_info=True,
-                )
-                continue  # try the next model
-
-            except APIConnectionError as alt_conn_ex:
-                logger.warning(
-                    f"Connection issue on alternate model '{alt_model}': {alt_conn_ex!s}",
-                    exc_info=True,
-                )
-                break
-
-        # If we exhausted the loop with no success, go to the next subscription
-        if not success:
-            logger.info("All models on this endpoint exhausted – switching subscription")
-            client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
+        # Log the response to database
+        if save_response_to_db:
+            await saveAssistantResponse(main_response, gpt, conversations)
 
-            try:
-                # Start again with the original model on the new endpoint
-                main_response, follow_up_questions, total_tokens = await call_model(
-                    client, gpt["name"], conversations, model_configuration
-                )
-
-            except Exception as final_ex:
-                logger.error("Retry with next subscription also failed", exc_info=True)
-                total_tokens = len(token_encoder.encode(str(conversations)))
-                main_response = (
-                    "All Azure OpenAI endpoints failed. Please try again later.\n\n"
-                    f"Exception Details: {final_ex}"
-                )
+    except CompletionFailedError as final_ex:
+        logger.error(f"Retry also failed: {final_ex}", exc_info=True)
+        total_tokens = ledger_for(gpt["name"]).count_messages(conversations, deployment=gpt["name"])
+        main_response = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex.last_exception)}"
     
     except BadRequestError as be:
         logger.error(f"BadRequestError occurred while fetching model response: {be}", exc_info=True)
-        total_tokens = len(token_encoder.encode(str(conversations)))
+        total_tokens = ledger_for(gpt["name"]).count_messages(conversations, deployment=gpt["name"])
         main_response = f"Bad Request error occurred while reaching to Azure Open AI. \n\n Exception Details : " + be.message
     
     except Exception as e:
@@ -770,189 +477,68 @@ async def analyzeImage_standard(gpt: GPTData, conversations, model_configuration
     }
 
 async def analyzeImage_stream(gpt: GPTData, conversations, model_configuration, save_response_to_db: bool):
-    # Get Azure Open AI Client and fetch response
-    #client = getAzureOpenAIClient(gpt4o_endpoint, gpt4o_api_key, gpt4o_api_version, True)
     try:
-        client = await getAzureOpenAIClient(AZURE_ENDPOINT_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL_API_VERSION, True)
         model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
+        estimated_tokens = await estimate_request_tokens(gpt, conversations, model_configuration, GPT_4o_2_MODEL_NAME)
+        full_response_content = ""
+        
+        # Create a wrapper generator that handles post-stream processing
+        async def response_wrapper():
+            nonlocal full_response_content
 
-        try:
-            full_response_content = ""
-            
-            async def stream_processor():
-                nonlocal full_response_content
-                nonlocal client
-                
-                try:
-                    response = await client.chat.completions.create(
-                        model=GPT_4o_2_MODEL_NAME,
-                        messages=conversations,
-                        max_completion_tokens=model_configuration.max_tokens,
-                        temperature=model_configuration.temperature,
-                        top_p=model_configuration.top_p,
-                        frequency_penalty=model_configuration.frequency_penalty,
-                        presence_penalty=model_configuration.presence_penalty,
-                        stop=None,
-                        stream=True,
-                        seed=100
-                    )
-                    
-                    async for chunk in response:
-                        nonlocal full_response_content
-
-                        if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
-                            logger.info(f"chunk.choices[0].delta {chunk.choices[0].delta}")
-                            chunkContent = chunk.choices[0].delta.content
-                            if chunkContent is not None:
-                                full_response_content += chunkContent
-                                yield chunkContent
-                except APIConnectionError as retryable_ex:
-                    logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-                    logger.info(f"Retrying with next endpoint")
-                    client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
-                    try:
-                        response = await client.chat.completions.create(
-                            model=gpt["name"],
-                            messages=conversations,
-                            max_tokens=model_configuration.max_tokens,
-                            temperature=model_configuration.temperature,
-                            top_p=model_configuration.top_p,
-                            frequency_penalty=model_configuration.frequency_penalty,
-                            presence_penalty=model_configuration.presence_penalty,
-                            stop=None,
-                            stream=True,
-                            seed=100,
-                            user=gpt["user"]
-                        )
-                        async for chunk in response:
-                            if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
-                                chunkContent = chunk.choices[0].delta.content
-                                if chunkContent is not None:
-                                    full_response_content += chunkContent
-                                    yield chunkContent
-                    except Exception as final_ex:
-                        logger.error(f"Retry also failed: {final_ex}", exc_info=True)
-                        full_response_content = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex)}"
-                        yield full_response_content
-
-                except RateLimitError as retryable_ex:
-                    logger.warning(f"Retryable error: {type(retryable_ex).__name__} - {retryable_ex}", exc_info=True)
-                    logger.info(f"Retrying with next models")
-                    # Gather all retry model names from environment variables
-                    models_to_try = []
-                    i = 1
-                    while True:
-                        model_env_var = f"GPT_RETRY_MODELS_{i}"
-                        alt_model = os.getenv(model_env_var)
-                        if not alt_model:
-                            break
-                        models_to_try.append(alt_model)
-                        i += 1
-
-                    # Helper to call the model
-                    async def call_model(client, model_name, conversations, model_configuration):
-                        response = await client.chat.completions.create(
-                            model=model_name,
-                            messages=conversations,
-                            max_tokens=model_configuration.max_tokens,
-                            temperature=model_configuration.temperature,
-                            top_p=model_configuration.top_p,
-                            frequency_penalty=model_configuration.frequency_penalty,
-                            presence_penalty=model_configuration.presence_penalty,
-                            stop=None,
-                            stream=True,
-                            seed=100,
-                            user=gpt["user"]
-                        )
-                        async for chunk in response:
-                            if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
-                                chunkContent = chunk.choices[0].delta.content
-                                if chunkContent is not None:
-                                    nonlocal full_response_content
-                                    full_response_content += chunkContent
-                                    yield chunkContent
-
-                    success = False
-                    for alt_model in models_to_try:
-                        try:
-                            async for chunk in call_model(client, alt_model, conversations, model_configuration):
-                                yield chunk
-                            logger.info(f"Succeeded with alternate model '{alt_model}'")
-                            success = True
-                            break
-
-                        except RateLimitError as alt_rl_ex:
-                            logger.warning(
-                                f"Rate-limit on alternate model '{alt_model}': {alt_rl_ex!s}",
-                                exc_info=True,
-                            )
-                            continue  # try the next model
-
-                        except APIConnectionError as alt_conn_ex:
-                            logger.warning(
-                                f"Connection issue on alternate model '{alt_model}': {alt_conn_ex!s}",
-                                exc_info=True,
-                            )
-                            break
-
-                    # If we exhausted the loop with no success, go to the next subscription
-                    if not success:
-                        logger.info("All models on this endpoint exhausted – switching subscription")
-                        client = await NiaAzureOpenAIClient().retry_with_next_endpoint()
-
-                        try:
-                            async for chunk in call_model(client, gpt["name"], conversations, model_configuration):
-                                yield chunk
-                        except Exception as final_ex:
-                            logger.error("Retry with next subscription also failed", exc_info=True)
-                            full_response_content = (
-                                "All Azure OpenAI endpoints failed. Please try again later.\n\n"
-                                f"Exception Details: {final_ex}"
-                            )
-                            yield full_response_content
-            
-            # Create a wrapper generator that handles post-stream processing
-            async def response_wrapper():
-                nonlocal full_response_content
-
-                try:
-                    async for chunk in stream_processor():
-                        yield chunk
-
-                except BadRequestError as be:
-                    logger.error(f"BadRequestError occurred while fetching model response: {be}", exc_info=True)
-                    full_response_content = f"Bad Request error occurred while reaching to Azure Open AI. \n\n Exception Details : " + be.message
-                    yield full_response_content
-
-                except Exception as e:
-                    logger.error(f"Exception occurred while fetching model response: {e}", exc_info=True)
-                    #yield str(re)
-                    full_response_content = f"Exception occurred while fetching model response: {str(e)}."
-                    yield full_response_content
-                finally:
-                    # This block ensures post-stream processing happens after the stream is complete
-                    if full_response_content is not None:
-                        nonlocal gpt
-                        # update the response to database
-                        if save_response_to_db:
-                            await saveAssistantResponse(full_response_content, gpt, conversations)
-            
-            return StreamingResponse(response_wrapper(), media_type="text/event-stream")
+            try:
+                # Image analysis only falls back to the vision capable deployments
+                async for chunk in completion_executor.stream(
+                    CompletionPolicy(models=[GPT_4o_2_MODEL_NAME] + get_vision_retry_models()),
+                    estimated_tokens,
+                    messages=conversations,
+                    max_completion_tokens=model_configuration.max_tokens,
+                    temperature=model_configuration.temperature,
+                    top_p=model_configuration.top_p,
+                    frequency_penalty=model_configuration.frequency_penalty,
+                    presence_penalty=model_configuration.presence_penalty,
+                    stop=None,
+                    seed=100,
+                    user=gpt["user"]
+                ):
+                    full_response_content += chunk
+                    yield chunk
+
+            except CompletionFailedError as final_ex:
+                logger.error(f"Retry also failed: {final_ex}", exc_info=True)
+                full_response_content = f"All Azure OpenAI endpoints failed. Please try again later.\n\n Exception Details : {str(final_ex.last_exception)}"
+                yield full_response_content
+
+            except BadRequestError as be:
+                logger.error(f"BadRequestError occurred while fetching model response: {be}", exc_info=True)
+                full_response_content = f"Bad Request error occurred while reaching to Azure Open AI. \n\n Exception Details : " + be.message
+                yield full_response_content
+
+            except Exception as e:
+                logger.error(f"Exception occurred while fetching model response: {e}", exc_info=True)
+                #yield str(re)
+                full_response_content = f"Exception occurred while fetching model response: {str(e)}."
+                yield full_response_content
+            finally:
+                # This block ensures post-stream processing happens after the stream is complete
+                if full_response_content is not None:
+                    # update the response to database
+                    if save_response_to_db:
+                        await saveAssistantResponse(full_response_content, gpt, conversations)
         
-        except Exception as e:
-            logger.error(f"Error occurred while fetching model response: {e}", exc_info=True)
-            return StreamingResponse(iter([str(e)]), media_type="text/event-stream")
+        return StreamingResponse(response_wrapper(), media_type="text/event-stream")
+    
     except Exception as e:
         logger.error(f"Error occurred while fetching model response: {e}", exc_info=True)
         return StreamingResponse(iter([str(e)]), media_type="text/event-stream")
     
-async def preprocessForRAG(user_message: str, image_response:str, use_case:str, gpt: GPTData, conversations: list, model_configuration: ModelConfiguration):
+async def preprocessForRAG(user_message: str, image_response:str, use_case:str, gpt: GPTData, conversations: list, model_configuration: ModelConfiguration, usecases: list = None):
 
     logger.info(f"USE_CASE : {use_case}")
     USER_PROMPT = USE_CASE_CONFIG[use_case]["user_message"]
     #logger.info(f"USE_CASE_CONFIG[{use_case}]: {USER_PROMPT}")
 
-    context_information, additional_context_information, conversations = await determineFunctionCalling(user_message, image_response, use_case, gpt, conversations, model_configuration)
+    context_information, additional_context_information, conversations = await determineFunctionCalling(user_message, image_response, use_case, gpt, conversations, model_configuration, usecases)
 
     # Step 4: Append the current user query with additional context into the conversation. This additional context is only to generate the response from the model and won't be saved in the conversation history for aesthetic reasons.
     if use_case == "CREATE_PRODUCT_DESCRIPTION":
@@ -977,12 +563,16 @@ async def preprocessForRAG(user_message: str, image_response:str, use_case:str,
     token_data = await get_token_count(gpt["name"], gpt["instructions"],  conversations, user_message, int(model_configuration.max_tokens))
     logger.info(f"Token Calculation : stage 1.3 - preprocessForRAG {token_data}")
 
-async def processImage(streaming_response: bool, save_response_to_db: bool, user_message: str, model_configuration: ModelConfiguration, gpt: GPTData, conversations: list, uploadedImage: UploadFile = None):
+    # The retrieved context identifies the grounded answer, used as part of the response cache key
+    return f"{context_information}\n{additional_context_information}"
+
+async def processImage(streaming_response: bool, save_response_to_db: bool, user_message: str, model_configuration: ModelConfiguration, gpt: GPTData, conversations: list, uploadedImage: UploadFile = None, uploaded_image_url: str = None):
     image_url = ""
     base64_image = ""
     try:
         if uploadedImage is not None and uploadedImage.filename != "blob" and uploadedImage.filename != "dummy":
-            image_url = await store_to_blob_storage(uploadedImage)
+            # The image may already have been uploaded concurrently with the other pre-processing stages
+            image_url = uploaded_image_url if uploaded_image_url is not None else await store_to_blob_storage(uploadedImage)
 
             if image_url == None or image_url == "" or image_url == "N/A":
                 logger.info(f"Image URL is empty. Passing Base64 encoded image for inference {image_url}")
@@ -1063,54 +653,102 @@ async def processResponse(response):
 
     return main_response, follow_up_questions, total_tokens
 
-async def generate_response(streaming_response: bool, user_message: str, model_configuration: ModelConfiguration, gpt: GPTData, uploadedFile: UploadFile = None):
+async def generate_response(streaming_response: bool, user_message: str, model_configuration: ModelConfiguration, gpt: GPTData, uploadedFile: UploadFile = None, bypass_cache: bool = False):
     has_image = False
-    previous_conversations_count = 6
     proceed = False
     model_name = gpt["name"]
     use_rag = bool(gpt["use_rag"])
     image_response = ""
     DEFAULT_IMAGE_RESPONSE = ""
+    cache_key = None
+
+    #has_image = (uploadedFile is not None and uploadedFile.filename != "blob" and uploadedFile.filename != "dummy")
+    file_extension = os.path.splitext(uploadedFile.filename)[1].lower()
+    if file_extension in ALLOWED_IMAGE_EXTENSIONS:
+        has_image = True
+    
+    if file_extension in [".pdf"]:
+        use_rag = True
+
+    # Steps 1 - 5 are independent I/O and run concurrently. The user message is saved while the history is read,
+    # so one extra history record is fetched and the just saved message is filtered out again.
+    pipeline = Pipeline("generate_response")
 
     # Step 1 : Get the use case, role information, model configuration parameters
-    use_case = await get_use_case(gpt)
-    role_information, model_configuration = await get_role_information(use_case) if use_rag else ("AI Assistant", model_configuration)
-    model_configuration: ModelConfiguration = await construct_model_configuration(model_configuration)
+    async def resolve_use_case(results):
+        use_case = await get_use_case(gpt)
+        role_information, configuration = await get_role_information(use_case) if use_rag else ("AI Assistant", model_configuration)
+        return use_case, role_information, await construct_model_configuration(configuration)
+
+    # Step 2 : Get the last conversation history (up to CONTEXT_HISTORY_MAX_MESSAGES, the context builder keeps what fits) for the given gpt_id and model_name
+    async def load_chat_history(results):
+        return await fetch_chat_history(gpt["_id"], model_name, limit=CONTEXT_HISTORY_MAX_MESSAGES + 1, profile="chat_context") # use limit=-1 if needing the entire conversation history to be passed to the model
+
+    # Step 3: Add the current user query to the messages Collection (Chat History). Avoid saving the query with additional grounded prompt information
+    async def save_user_message(results):
+        return await update_message({
+            "gpt_id": gpt["_id"],
+            "gpt_name": gpt["name"],
+            "role": "user",
+            "content": f"{user_message}",
+            "user": gpt["user"],
+            "use_case_id": gpt["use_case_id"]
+        })
 
-    # Step 2 : Get last conversation history (6 messages) for the given gpt_id and model_name
-    chat_history = await fetch_chat_history(gpt["_id"], model_name, limit=6) # use limit=-1 if needing the entire conversation history to be passed to the model
-    
-    # Step 3: Format the conversation to support OpenAI format (System Message, User Message, Assistant Message)
+    # Step 4: Use cases of the gpt, shared by function calling and Azure Search
+    async def load_usecases(results):
+        return await get_usecases(gpt["_id"]) if use_rag else []
+
+    # Step 4b: Rolling summary of the older turns, used by the context builder when they no longer fit
+    async def load_summary(results):
+        return await conversation_summarizer.get_summary(gpt["_id"])
+
+    # Step 5: Upload attachments (image to blob storage, documents to the RAG index)
+    async def upload_attachment(results):
+        if has_image:
+            return await store_to_blob_storage(uploadedFile)
+        if file_extension in [".pdf"]:
+            await handle_upload_files(gpt["_id"], gpt, [uploadedFile])
+        return None
+
+    pipeline.add_stage("use_case", resolve_use_case)
+    pipeline.add_stage("chat_history", load_chat_history)
+    pipeline.add_stage("summary", load_summary)
+    pipeline.add_stage("save_user_message", save_user_message)
+    pipeline.add_stage("upload_attachment", upload_attachment)
+    # An uploaded pdf creates the DOC_SEARCH use case, so the use cases are read after it is indexed
+    pipeline.add_stage("usecases", load_usecases, depends_on=("upload_attachment",) if file_extension in [".pdf"] else ())
+    results = await pipeline.run()
+
+    use_case, role_information, model_configuration = results["use_case"]
+    usecases = results["usecases"]
+    image_url = results["upload_attachment"]
+    saved_message_id = str(results["save_user_message"])
+    chat_history = [msg for msg in results["chat_history"] if msg["_id"] != saved_message_id][:CONTEXT_HISTORY_MAX_MESSAGES]
+    chat_history.reverse() # The history is read newest first, the model gets it in chronological order
+    summary = results["summary"]
+    summary_text = summary["summary"] if summary else None
+
+    # Format the conversation to support OpenAI format (System Message, User Message, Assistant Message)
     conversations = [{"role": "system", "content": gpt["instructions"]}]
     for msg in chat_history:
         conversations.append({"role": msg["role"], "content": msg["content"]})
 
-    # Step 4: get token count for the conversation 
-    token_data = await get_token_count(model_name, gpt["instructions"],  conversations, user_message, int(model_configuration.max_tokens))
+    # Keep the newest history that fits the model's prompt budget, leaving room for the user turn, retrieved context and image added in Step 6.
+    # History messages carry their persisted token counts, so fitting them does not tokenize them again.
+    ledger_for(model_name).prime_messages(chat_history)
+    reserved_tokens = context_builder.reserve_for_turn(model_name, user_message, use_rag, has_image)
+    context_report = context_builder.fit(conversations, len(chat_history), model_name, user_message, int(model_configuration.max_tokens), summary=summary_text, reserved_tokens=reserved_tokens)
+    logger.info(f"Context window : stage 1 {context_report}")
+
+    # get token count for the conversation. Later stages only count what is appended.
+    conversation_tokens = ConversationTokens(conversations, deployment=model_name)
+    token_data = conversation_tokens.token_data(user_message, int(model_configuration.max_tokens))
     logger.info(f"Token Calculation : stage 1 {token_data}")
     
     # Get previous conversation for context
     #previous_conversations = get_previous_context_conversations(conversation_list=conversations, previous_conversations_count=previous_conversations_count)
 
-    # Step 5: Add the current user query to the messages Collection (Chat History). Avoid saving the query with additional grounded prompt information
-    await update_message({
-        "gpt_id": gpt["_id"],
-        "gpt_name": gpt["name"],
-        "role": "user",
-        "content": f"{user_message}",
-        "user": gpt["user"],
-        "use_case_id": gpt["use_case_id"]
-    })
-    
-    #has_image = (uploadedFile is not None and uploadedFile.filename != "blob" and uploadedFile.filename != "dummy")
-    file_extension = os.path.splitext(uploadedFile.filename)[1].lower()
-    if file_extension in ALLOWED_IMAGE_EXTENSIONS:
-        has_image = True
-    
-    if file_extension in [".pdf"]:
-        use_rag = True
-        await handle_upload_files(gpt["_id"], gpt, [uploadedFile])
-
     logger.info(f"use_rag is {use_rag} and has_image is {has_image}")
     logger.info(f"Uploaded File {uploadedFile}")
 
@@ -1118,7 +756,7 @@ async def generate_response(streaming_response: bool, user_message: str, model_c
     if not use_rag and has_image:
         logger.info("CASE 1 : No RAG but Image is present")
         proceed = False
-        response = await processImage(streaming_response, True, user_message, model_configuration, gpt, conversations, uploadedFile)
+        response = await pipeline.timed("image_analysis", processImage(streaming_response, True, user_message, model_configuration, gpt, conversations, uploadedFile, image_url))
     elif use_rag and has_image:
         logger.info("CASE 2 : RAG and Image is present")
         proceed = True
@@ -1160,35 +798,64 @@ async def generate_response(streaming_response: bool, user_message: str, model_c
                 "- Respond professionally and helpfully in every case"
         })
         
-        image_response = await processImage(False, False, user_message, model_configuration, gpt, conversation_for_image_analysis, uploadedFile)
+        image_response = await pipeline.timed("image_analysis", processImage(False, False, user_message, model_configuration, gpt, conversation_for_image_analysis, uploadedFile, image_url))
         conversation_for_image_analysis.clear()
 
         # Step 2 : Function Calling
         if image_response is not None and image_response.get("model_response") is not None and image_response.get("model_response") != "":
             #conversations.append({"role": "user", "content": user_message})
             #conversations.append({"role": "assistant", "content": "Image Analysis Result : " + image_response.get("model_response")})
-            await preprocessForRAG(user_message, image_response.get("model_response"), use_case, gpt, conversations, model_configuration)
+            await pipeline.timed("retrieval", preprocessForRAG(user_message, image_response.get("model_response"), use_case, gpt, conversations, model_configuration, usecases))
     elif use_rag and not has_image:
         logger.info("CASE 3 : RAG and No Image")
         proceed = True
-        await preprocessForRAG(user_message, DEFAULT_IMAGE_RESPONSE, use_case, gpt, conversations, model_configuration)
+        retrieved_context = await pipeline.timed("retrieval", preprocessForRAG(user_message, DEFAULT_IMAGE_RESPONSE, use_case, gpt, conversations, model_configuration, usecases))
         conversations.append({"role": "user", "content": user_message})
+
+        # Grounded answers without attachments are cacheable: same question over the same retrieved context
+        if RESPONSE_CACHE_ENABLED and bypass_cache:
+            response_cache.record_bypass()
+        elif RESPONSE_CACHE_ENABLED:
+            cache_key = response_cache.build_key(gpt, use_case, user_message, retrieved_context, model_configuration, streaming_response)
     else:
         logger.info("CASE 4 : No RAG and No Image")
         proceed = True
         logger.info("No function calling. Plain query used as user message")
         conversations.append({"role": "user", "content": user_message})
         
-    # Step 7: Get the token count after the user message is added to the conversation
-    token_data = await get_token_count(model_name, gpt["instructions"],  conversations, user_message, int(model_configuration.max_tokens))
+    # Step 7: Fit the complete prompt (the retrieved context is truncated if it does not fit) and get the token count
+    if proceed:
+        history_count = context_report["history_kept"] + int(context_report["summary_used"])
+        context_report = context_builder.fit(conversations, history_count, model_name, user_message, int(model_configuration.max_tokens), summary=summary_text)
+        logger.info(f"Context window : stage 2 {context_report}")
+
+    token_data = conversation_tokens.token_data(user_message, int(model_configuration.max_tokens))
     logger.info(f"Token Calculation : stage 2 (Before generating response) {token_data}")
 
+    # Step 8: Serve repeated questions from the response cache
+    cached_response = await response_cache.get(cache_key) if cache_key is not None else None
+    if cached_response is not None:
+        logger.info(f"Response cache hit for use case {use_case}")
+        proceed = False
+        await saveAssistantResponse(cached_response["model_response"], gpt, conversations)
+        if streaming_response:
+            response = StreamingResponse(replay_stream(cached_response["model_response"]), media_type="text/event-stream")
+        else:
+            response = dict(cached_response)
+
     # Azure OpenAI API call
     if proceed == True:
         if streaming_response:
-            response = await get_completion_from_messages_stream(gpt, model_configuration, conversations, use_case, role_information)
+            response = await pipeline.timed("completion", get_completion_from_messages_stream(gpt, model_configuration, conversations, use_case, role_information, cache_key))
         else:
-            response = await get_completion_from_messages_standard(gpt, model_configuration, conversations, use_case, role_information)
+            response = await pipeline.timed("completion", get_completion_from_messages_standard(gpt, model_configuration, conversations, use_case, role_information, cache_key))
+
+    # Per stage timing breakdown. For streams the completion stage is the time to the start of the stream.
+    pipeline.log_timings()
+    if isinstance(response, StreamingResponse):
+        response.headers["Server-Timing"] = pipeline.server_timing_header()
+    elif isinstance(response, dict):
+        response["stage_timings"] = pipeline.timing_breakdown()
 
     # Sometimes model returns "null" which is not supported by python
     # the null gets into the chat history and ruins all the subsequent calls to the model
@@ -1199,22 +866,14 @@ async def generate_response(streaming_response: bool, user_message: str, model_c
         pass
         
     logger.info(f"Conversation : {conversations}")
-    logger.info(f"Tokens in the conversation {len(token_encoder.encode(str(conversations)))}")
-
-    # summarize the conversation history if its close to 90% of the token limit
-    # if int(response["total_tokens"]) >= int(model_configuration["max_tokens"]) * 0.9:
-    #     conversation_summary = await summarize_conversations(conversations, gpt)
-    #     # Insert the summarization into the messages collection with role "assistant"
-    #     update_message({
-    #         "gpt_id": gpt["_id"],
-    #         "gpt_name": gpt["name"],
-    #         "role": "assistant",
-    #         "content": f"Below is the summary of the previous conversations with the assistant. \n{conversation_summary}"
-    #     })
+    logger.info(f"Tokens in the conversation {conversation_tokens.total()}")
+
+    # Step 9: Fold the older turns into a new summary version in the background once the unsummarized history crossed SUMMARIZER_TRIGGER_TOKENS
+    conversation_summarizer.maybe_schedule(gpt, chat_history, summary, summarize_conversations)
 
     return response
 
-async def get_data_from_azure_search(search_query: str, use_case: str, gpt_id: str, get_extra_data: bool):
+async def get_data_from_azure_search(search_query: str, use_case: str, gpt_id: str, get_extra_data: bool, usecases: list = None):
     """
     # PREREQUISITES
         pip install azure-identity
@@ -1236,7 +895,7 @@ async def get_data_from_azure_search(search_query: str, use_case: str, gpt_id: s
     tenant_id = os.getenv("TENANT_ID")
 
     logger.info(f"Client ID: {client_id} \nClient Secret: {client_secret} \nTenant ID: {tenant_id}")
-    use_cases = await get_usecases(gpt_id)
+    use_cases = usecases if usecases is not None else await get_usecases(gpt_id)
     # Extract the matching use case from the collection
     use_case_data = next((uc for uc in use_cases if uc["name"] == use_case), None)
 
@@ -1253,71 +912,47 @@ async def get_data_from_azure_search(search_query: str, use_case: str, gpt_id: s
     #logger.info(f"use_case: {use_case}")
 
     try:
-         # Use the token with Azure SDK's client
-        credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-
-        # Create a search client
-        azure_ai_search_client = SearchClient(
-            endpoint=os.getenv("SEARCH_ENDPOINT_URL"),
-            #index_name=os.getenv("SEARCH_INDEX_NAME"),
-            # index_name=USE_CASE_CONFIG[use_case]["index_name"],
-            index_name = index_name,
-            credential=credential)
-        
         if not all([client_id, client_secret, tenant_id, search_endpoint, search_index]):
             raise ValueError("Missing environment variables.")
         
-        logger.info(f"Search Client: {azure_ai_search_client} \nSearch Query: {search_query}")
+        logger.info(f"Search Index: {index_name} \nSearch Query: {search_query}")
 
         # Get the documents
         if use_case == "TRACK_ORDERS_TKE" or use_case == "MANAGE_TICKETS" or use_case == "REVIEW_BYTES" or use_case == "COMPLAINTS_AND_FEEDBACK" or use_case == "SEASONAL_SALES" or use_case == "DOC_SEARCH":
             selected_fields = USE_CASE_CONFIG[use_case]["fields_to_select"]
         else:
             selected_fields = ALL_FIELDS 
+        selected_fields = search_context_compactor.selectable_fields(selected_fields) # e.g. password is never read from the index
 
         logger.info(f"Selected Fields: {selected_fields}")
         # semantic_config_name = USE_CASE_CONFIG[use_case]["semantic_configuration_name"]
         # logger.info(f"Semantic Config Name {semantic_config_name}")
         #selected_fields = ["user_name", "order_id", "product_description", "brand", "order_date", "status", "delivery_date"]
-        search_results = azure_ai_search_client.search(search_text=search_query, 
-                                                 #top = 5,
-                                                 top=USE_CASE_CONFIG.get(use_case, {}).get("document_count", 30), 
-                                                 include_total_count=True, 
-                                                 query_type="semantic",
-                                                #  semantic_configuration_name=USE_CASE_CONFIG[use_case]["semantic_configuration_name"],
-                                                 semantic_configuration_name = semantic_configuration_name,
-                                                 select=selected_fields)
-        additional_search_results = []
+        document_count = USE_CASE_CONFIG.get(use_case, {}).get("document_count", 30)
+
+        # Searches go through pooled async clients (one per index) and a short lived result cache
+        search_tasks = [cached_search(index_name, semantic_configuration_name, search_query, selected_fields, document_count, gpt_id)]
         if get_extra_data:
             logger.info("Fetching additional data from Azure Search")
-            # Create a search client
-            additional_azure_ai_search_client = SearchClient(
-                endpoint=os.getenv("SEARCH_ENDPOINT_URL"),
-                index_name = NIA_FINOLEX_SEARCH_INDEX,
-                credential=credential
-            )
-
-            additional_search_results = additional_azure_ai_search_client.search(search_text=search_query, 
-                                                 top=USE_CASE_CONFIG.get(use_case, {}).get("document_count", 30), 
-                                                 include_total_count=True, 
-                                                 query_type="semantic",
-                                                 semantic_configuration_name = NIA_FINOLEX_PDF_SEARCH_SEMANTIC_CONFIGURATION_NAME,
-                                                 select=["Name_of_Supplier", "Purchase_Order_Number", "Purchase_Order_Date", "Expense_Made_For", "Quantity", "Net_Price", "Total_Expense", "Supplier_Supplying_Plant", "Currency"])
-            
+            search_tasks.append(cached_search(NIA_FINOLEX_SEARCH_INDEX,
+                                              NIA_FINOLEX_PDF_SEARCH_SEMANTIC_CONFIGURATION_NAME,
+                                              search_query,
+                                              ["Name_of_Supplier", "Purchase_Order_Number", "Purchase_Order_Date", "Expense_Made_For", "Quantity", "Net_Price", "Total_Expense", "Supplier_Supplying_Plant", "Currency"],
+                                              document_count))
             logger.info(f"search endpoint url {NIA_FINOLEX_SEARCH_INDEX}\n semantic config {NIA_FINOLEX_PDF_SEARCH_SEMANTIC_CONFIGURATION_NAME}")
-            
-            logger.info(f"Additional Context Information: {additional_search_results}")
-            additional_results_list = [result for result in additional_search_results]
-            additional_results_formatted = json.dumps(additional_results_list, default=lambda x: x.__dict__, indent=2)
+
+        search_results = await asyncio.gather(*search_tasks)
+        results_list = search_results[0]
+
+        if get_extra_data:
+            additional_results_list = search_results[1]
+            additional_results_formatted = search_context_compactor.compact(additional_results_list)
             logger.info(f"Additional Context Information: {additional_results_formatted}")
         
         logger.info("Documents in Azure Search:")
 
-        # Convert SearchItemPaged to a list of dictionaries
-        results_list = [result for result in search_results]
-
-        # Serialize the results
-        sources_formatted = json.dumps(results_list, default=lambda x: x.__dict__, indent=2)
+        # Rank, filter, dedupe and serialize the results within the token cap of the retrieved context
+        sources_formatted = search_context_compactor.compact(results_list)
         logger.info(f"Context Information: {sources_formatted}")
         
     except Exception as e:
@@ -1359,13 +994,14 @@ def get_azure_openai_deployments():
     except Exception as e:
         logger.error("Exception while fetching deployments from Azure OpenAI", exc_info=True)
 
-async def summarize_conversations(chat_history, gpt):
+async def summarize_conversations(chat_history, gpt, previous_summary: str = None):
     """
-    Summarize the conversations using LLM (replace with your code)
+    Summarize the conversations using LLM, folding them into the previous summary if there is one.
+    Used by the conversation summarizer; the chat history itself is kept (the UI still shows it).
     """
     logger.info(f"Length of chat history: {len(chat_history)}")
 
-    gpt_name = gpt["name"]
+    conversation_summary = previous_summary or ""
 
     if chat_history is not None and len(chat_history) > 0:
         summarization_system_prompt = f"""
@@ -1381,25 +1017,25 @@ async def summarize_conversations(chat_history, gpt):
             
             {delimiter} {json.dumps(chat_history)} {delimiter}
         """
+        if previous_summary:
+            summarization_user_prompt += f"""
+            Merge the conversations into this summary of the earlier conversations and return one combined summary:
+            {delimiter} {previous_summary} {delimiter}
+        """
 
         messages = [
                     {"role": "system", "content": summarization_system_prompt },
                     {"role": "user", "content": summarization_user_prompt }
                    ]
 
-        #model_configuration: ModelConfiguration = ModelConfiguration(**SUMMARIZE_MODEL_CONFIGURATION)
-        model_configuration: ModelConfiguration = model_configuration if  isinstance(model_configuration, ModelConfiguration) else ModelConfiguration(**SUMMARIZE_MODEL_CONFIGURATION)
+        model_configuration: ModelConfiguration = ModelConfiguration(**SUMMARIZE_MODEL_CONFIGURATION)
 
-        # Get Azure Open AI Client and fetch response
-        conversation_summary = await get_completion_from_messages_default(DEFAULT_MODEL_NAME, messages, model_configuration)
-
-        # Remove the summarized conversations from the messages collection
-        delete_chat_history(gpt["_id"], gpt["name"])
-        logger.info(f"Deleted chat history (post summarization) for GPT: { gpt_name} successfully.")
+        # Get Azure Open AI Client and fetch response. Failures raise, so an error text is never stored as the summary.
+        conversation_summary = await get_completion_from_messages_default(DEFAULT_MODEL_NAME or gpt["name"], False, messages, model_configuration, raise_errors=True)
 
     return conversation_summary
 
-async def determineFunctionCalling(search_query: str, image_response: str, use_case: str, gpt: GPTData, conversations: list, model_configuration: ModelConfiguration):
+async def determineFunctionCalling(search_query: str, image_response: str, use_case: str, gpt: GPTData, conversations: list, model_configuration: ModelConfiguration, usecases: list = None):
     function_calling_conversations = []
     data = []
     additional_data = []
@@ -1408,21 +1044,28 @@ async def determineFunctionCalling(search_query: str, image_response: str, use_c
     gpt_id: str = str(gpt["_id"]) 
 
     logger.info(f"determineFunctionCalling calling Start {deployment_name}")
-    use_case_from_db = await get_usecases(gpt_id)
+    use_case_from_db = usecases if usecases is not None else await get_usecases(gpt_id)
     use_case_list = [use_case["name"] for use_case in use_case_from_db]
 
-    # Azure Open AI Clients for different tasks
-    azure_openai_client =  AsyncAzureOpenAI(
-        azure_endpoint=GPT_4o_ENDPOINT_URL, 
-        api_key=GPT_4o_API_KEY, 
-        api_version=GPT_4o_API_VERSION)
-    
     if use_case == "TRACKING_ORDERS_TKE":
         search_query = search_query + "(TKE)"
 
+    # Confident queries are routed locally, skipping the function calling round-trip
+    route_decision = intent_router.route(search_query, use_case, use_case_from_db, image_response, gpt_id)
+    if route_decision is not None:
+        logger.info(f"Intent router decision {route_decision.to_dict()}")
+        data, additional_data = await get_data_from_azure_search(
+            search_query=route_decision.search_query,
+            use_case=route_decision.use_case,
+            get_extra_data=route_decision.get_extra_data,
+            gpt_id=gpt_id,
+            usecases=use_case_from_db
+        )
+        return data, additional_data, conversations
+
     # Initial user message
     function_calling_conversations.append({"role": "system", "content":FUNCTION_CALLING_SYSTEM_MESSAGE}) # Single function call
-    function_calling_conversations.append({"role": "user", "content": FUNCTION_CALLING_USER_MESSAGE.format(query=search_query, use_case=use_case, conversation_history=conversations, image_details=image_response)}) # Single function call
+    function_calling_conversations.append({"role": "user", "content": FUNCTION_CALLING_USER_MESSAGE.format(query=search_query, use_case=use_case, conversation_history=context_builder.recent_context(conversations), image_details=image_response)}) # Single function call
     #messages = [{"role": "user", "content": "What's the current time in San Francisco, Tokyo, and Paris?"}] # Parallel function call with a single tool/function defined
 
     # Define the function for the model
@@ -1458,10 +1101,17 @@ async def determineFunctionCalling(search_query: str, image_response: str, use_c
     response_from_function_calling_model = ""
     function_calling_model_response = ""
 
+    # Start the search with the raw user message against the current use case, hidden behind the function calling round-trip
+    speculative_search = None
+    if SPECULATIVE_SEARCH_ENABLED and use_case in use_case_list and not image_response:
+        speculative_search = asyncio.create_task(get_data_from_azure_search(search_query, use_case, gpt_id, False, use_case_from_db))
+
     try:
         # First API call: Ask the model to use the function
-        response_from_function_calling_model = await azure_openai_client.chat.completions.create(
-            model=GPT_4o_2_MODEL_NAME,
+        # Sent through the endpoint pool like every other completion (circuit breakers, rate limiter, failover)
+        response_from_function_calling_model = await completion_executor.create(
+            CompletionPolicy(models=[GPT_4o_2_MODEL_NAME] + get_retry_models()),
+            estimate_messages_tokens(GPT_4o_2_MODEL_NAME, function_calling_conversations, int(model_configuration.max_tokens)),
             messages=function_calling_conversations,
             tools=tools,
             #tool_choice="none",
@@ -1483,11 +1133,26 @@ async def determineFunctionCalling(search_query: str, image_response: str, use_c
                     logger.info("get_data_from_azure_search called")
                     function_args = json.loads(tool_call.function.arguments)
                     logger.info(f"Function arguments: {function_args}")  
+                    await log_tool_call(search_query, use_case, function_args, gpt_id)
+                    get_extra_data = function_args.get("get_extra_data") if use_case == "DOC_SEARCH" else False # Only for doc search the fetch of extra data must be enabled
+
+                    if speculative_search is not None and is_speculative_search_usable(search_query, use_case, function_args, get_extra_data):
+                        logger.info(f"Reusing speculative search results for '{function_args.get('search_query')}'")
+                        data, additional_data = await speculative_search
+                        speculative_search = None
+                        continue
+
+                    if speculative_search is not None:
+                        logger.info(f"Speculative search discarded. Tool call arguments differ: {function_args}")
+                        discard_speculative_search(speculative_search)
+                        speculative_search = None
+
                     data, additional_data = await get_data_from_azure_search(
                         search_query=function_args.get("search_query"),
                         use_case=function_args.get("use_case"),
-                        get_extra_data= function_args.get("get_extra_data") if use_case == "DOC_SEARCH" else False, # Only for doc search the fetch of extra data must be enabled
-                        gpt_id = gpt_id
+                        get_extra_data=get_extra_data,
+                        gpt_id = gpt_id,
+                        usecases = use_case_from_db
                     )
 
                     # Append the function response to the original conversation list
@@ -1501,13 +1166,20 @@ async def determineFunctionCalling(search_query: str, image_response: str, use_c
         else:
             logger.info("No tool calls were made by the model.")
 
-    except RateLimitError as rle:
-        logger.error(f"RateLimitError occurred while calling the function: {rle}", exc_info=True)
-        function_calling_model_response = "ERROR#####" + str(rle) + "Your token utilization is high (Max tokens per window 8000). Please try again later."
+    except CompletionFailedError as cfe:
+        logger.error(f"Function calling failed on every endpoint: {cfe}", exc_info=True)
+        if isinstance(cfe.last_exception, RateLimitError):
+            function_calling_model_response = "ERROR#####" + str(cfe.last_exception) + "Your token utilization is high (Max tokens per window 8000). Please try again later."
+        else:
+            function_calling_model_response = "ERROR#####" + str(cfe)
     except Exception as e:
         logger.error(f"Error occurred while calling the function: {e}", exc_info=True)
         function_calling_model_response = "ERROR#####" + str(e)
     finally:
+        # The speculative search is not needed when the model made no (matching) tool call or failed
+        if speculative_search is not None:
+            discard_speculative_search(speculative_search)
+
         token_data = await get_token_count(gpt["name"], gpt["instructions"],  function_calling_conversations, search_query, int(model_configuration.max_tokens))
         logger.info(f"Token Calculation : stage 1.2 - Function calling {token_data}")
         function_calling_conversations.clear() # Clear the messages list because we do not need the system message, user message in this function
@@ -1515,6 +1187,25 @@ async def determineFunctionCalling(search_query: str, image_response: str, use_c
 
     return data, additional_data, conversations
 
+def discard_speculative_search(task: asyncio.Task):
+    """Cancel a speculative search that is not needed. Its outcome is retrieved, so a failed search is not reported as never retrieved."""
+    task.cancel()
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+def is_speculative_search_usable(user_message: str, use_case: str, function_args: dict, get_extra_data: bool) -> bool:
+    """The speculative search (raw user message, current use case, no extra data) is reused when the tool call asks for nearly the same."""
+    if function_args.get("use_case") != use_case or get_extra_data:
+        return False
+
+    speculative_words = set(re.findall(r"[a-z0-9]+", user_message.lower()))
+    requested_words = set(re.findall(r"[a-z0-9]+", (function_args.get("search_query") or "").lower()))
+    if not speculative_words or not requested_words:
+        return False
+
+    similarity = len(speculative_words & requested_words) / len(speculative_words | requested_words)
+    logger.info(f"Speculative search similarity {similarity:.2f}")
+    return similarity >= SPECULATIVE_SEARCH_MIN_SIMILARITY
+
 async def call_maf(ticketId: str):
     client = await getAzureOpenAIClient(AZURE_ENDPOINT_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL_API_VERSION, False)
     model_output = await run_conversation(client, ticketId)
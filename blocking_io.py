@@ -0,0 +1,24 @@
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Bounded pool for the synchronous SDK calls that have no async counterpart
+BLOCKING_IO_MAX_WORKERS = int(os.getenv("BLOCKING_IO_MAX_WORKERS", 16))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_MAX_WORKERS, thread_name_prefix="nia-blocking-io")
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call in the bounded thread pool so it does not stall the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def shutdown_blocking_executor():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,322 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from dotenv import load_dotenv
+
+from dependencies import NiaAzureOpenAIClient
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Default retry / fallback policy
+COMPLETION_DEADLINE_SECONDS = float(os.getenv("COMPLETION_DEADLINE_SECONDS", 120))
+COMPLETION_MAX_ATTEMPTS = int(os.getenv("COMPLETION_MAX_ATTEMPTS", 4))
+COMPLETION_BACKOFF_BASE_SECONDS = float(os.getenv("COMPLETION_BACKOFF_BASE_SECONDS", 0.2))
+COMPLETION_BACKOFF_MAX_SECONDS = float(os.getenv("COMPLETION_BACKOFF_MAX_SECONDS", 2))
+
+# Hedged requests (non-streaming only). A duplicate is sent to another endpoint once the primary call
+# is slower than the given percentile of recent latencies, as long as hedges stay within the extra TPM budget.
+COMPLETION_HEDGING_ENABLED = os.getenv("COMPLETION_HEDGING_ENABLED", "false").lower() == "true"
+COMPLETION_HEDGE_PERCENTILE = float(os.getenv("COMPLETION_HEDGE_PERCENTILE", 95))
+COMPLETION_HEDGE_MIN_SAMPLES = int(os.getenv("COMPLETION_HEDGE_MIN_SAMPLES", 20))
+COMPLETION_HEDGE_LATENCY_WINDOW = int(os.getenv("COMPLETION_HEDGE_LATENCY_WINDOW", 200))
+COMPLETION_HEDGE_MAX_EXTRA_TPM_PERCENT = float(os.getenv("COMPLETION_HEDGE_MAX_EXTRA_TPM_PERCENT", 10))
+
+class CompletionFailedError(Exception):
+    """Raised when every endpoint/deployment allowed by the policy failed or the deadline expired."""
+
+    def __init__(self, message: str, last_exception: Exception = None):
+        super().__init__(f"{message} Last error: {last_exception}" if last_exception else message)
+        self.last_exception = last_exception
+
+class CompletionPolicy:
+    """
+    Describes how a completion request is retried.
+        models: fallback chain of deployments, primary first
+        deadline_seconds: overall time budget, propagated to every attempt as the request timeout
+        max_attempts: upper bound on attempts across endpoints and deployments
+        backoff_*: full-jitter exponential backoff between attempts
+        hedge: allow a hedged duplicate for non-streaming calls (only when COMPLETION_HEDGING_ENABLED)
+    """
+
+    def __init__(self, models: list[str],
+                 deadline_seconds: float = COMPLETION_DEADLINE_SECONDS,
+                 max_attempts: int = COMPLETION_MAX_ATTEMPTS,
+                 backoff_base_seconds: float = COMPLETION_BACKOFF_BASE_SECONDS,
+                 backoff_max_seconds: float = COMPLETION_BACKOFF_MAX_SECONDS,
+                 hedge: bool = False):
+        self.models = [model for model in models if model]
+        self.deadline_seconds = deadline_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.hedge = hedge
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * (2 ** attempt)))
+
+class LatencyTracker:
+    """Rolling window of recent completion latencies."""
+
+    def __init__(self, window: int = COMPLETION_HEDGE_LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, percentile: float, min_samples: int = COMPLETION_HEDGE_MIN_SAMPLES) -> float:
+        """Latency at the given percentile, or None until enough samples have been seen."""
+        if len(self._samples) < max(1, min_samples):
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+class HedgeBudget:
+    """Caps the tokens spent on hedges at a percentage of the primary tokens sent over the last minute."""
+
+    def __init__(self, max_extra_percent: float = COMPLETION_HEDGE_MAX_EXTRA_TPM_PERCENT, window_seconds: float = 60):
+        self.max_extra_percent = max_extra_percent
+        self.window_seconds = window_seconds
+        self._primary = deque()
+        self._hedged = deque()
+
+    def _total(self, entries: deque) -> int:
+        cutoff = time.monotonic() - self.window_seconds
+        while entries and entries[0][0] < cutoff:
+            entries.popleft()
+        return sum(tokens for _, tokens in entries)
+
+    def record_primary(self, tokens: int):
+        self._primary.append((time.monotonic(), tokens))
+
+    def can_spend(self, tokens: int) -> bool:
+        return self._total(self._hedged) + tokens <= self._total(self._primary) * self.max_extra_percent / 100
+
+    def spend(self, tokens: int):
+        self._hedged.append((time.monotonic(), tokens))
+
+    def stats(self) -> dict:
+        return {"primary_tokens_last_minute": self._total(self._primary), "hedged_tokens_last_minute": self._total(self._hedged)}
+
+class CompletionExecutor:
+    """
+    Single place where Azure OpenAI chat completions are sent, retried and failed over.
+        - APIConnectionError / 5xx : the endpoint is excluded and the request moves to the next endpoint
+        - RateLimitError           : the (endpoint, deployment) pair is excluded and the next pair with headroom is used
+        - anything else            : raised to the caller (e.g. BadRequestError)
+    Streaming and non-streaming calls share the same loop. A stream can only fail over before its first chunk.
+    """
+
+    def __init__(self):
+        self._stats = {
+            "requests": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "fallbacks": 0,
+            "fallback_latency_ms_total": 0.0,
+            "fallback_latency_ms_max": 0.0,
+            "hedges_fired": 0,
+            "hedges_won": 0,
+            "hedges_skipped_budget": 0,
+            "hedges_skipped_no_endpoint": 0,
+        }
+        # Keyed by primary model and call type: a function calling round trip says nothing about a long chat answer
+        self._latency: dict[str, LatencyTracker] = {}
+        self._hedge_budget = HedgeBudget()
+
+    async def create(self, policy: CompletionPolicy, estimated_tokens: int, **request_kwargs):
+        """Non-streaming completion. Returns the ChatCompletion of the first successful attempt."""
+
+        async def call(client, model, timeout):
+            return await client.chat.completions.create(model=model, stream=False, timeout=timeout, **request_kwargs)
+
+        latency = self._latency_for(policy, request_kwargs)
+        started_at = time.monotonic()
+        if policy.hedge and COMPLETION_HEDGING_ENABLED:
+            result = await self._execute_hedged(policy, estimated_tokens, call, latency)
+        else:
+            result = await self._execute(policy, estimated_tokens, call)
+        latency.record(time.monotonic() - started_at)
+        return result
+
+    def _latency_for(self, policy: CompletionPolicy, request_kwargs: dict) -> LatencyTracker:
+        call_type = "tools" if request_kwargs.get("tools") or request_kwargs.get("functions") else "chat"
+        key = f"{policy.models[0] if policy.models else None}:{call_type}"
+        latency = self._latency.get(key)
+        if latency is None:
+            latency = self._latency[key] = LatencyTracker()
+        return latency
+
+    async def stream(self, policy: CompletionPolicy, estimated_tokens: int, **request_kwargs):
+        """Streaming completion. Yields the content of every chunk as it arrives."""
+
+        async def call(client, model, timeout):
+            response = await client.chat.completions.create(model=model, stream=True, timeout=timeout, **request_kwargs)
+            chunks = response.__aiter__()
+            # Pull the first content chunk inside the retry loop so that failures before the first token can still fail over
+            first_content = await _next_content(chunks)
+            return chunks, first_content
+
+        chunks, first_content = await self._execute(policy, estimated_tokens, call)
+
+        if first_content is not None:
+            yield first_content
+            while (content := await _next_content(chunks)) is not None:
+                yield content
+
+    async def _execute_hedged(self, policy: CompletionPolicy, estimated_tokens: int, call, latency: LatencyTracker):
+        """
+        Run the primary request and, if it is still pending after the hedge delay, a duplicate on another
+        endpoint. The first successful response wins and the other request is cancelled.
+        """
+        self._hedge_budget.record_primary(estimated_tokens)
+        hedge_delay = latency.percentile(COMPLETION_HEDGE_PERCENTILE)
+        started_at = time.monotonic()
+
+        primary_endpoints = set()
+        primary = asyncio.create_task(self._execute(policy, estimated_tokens, call, primary_endpoints))
+        if hedge_delay is None:
+            return await primary
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+            if done:
+                return primary.result()
+
+            hedge = await self._start_hedge(policy, estimated_tokens, call, primary_endpoints, started_at)
+            if hedge is None:
+                return await primary
+
+            result, winner = await _first_successful(primary, hedge)
+            if winner is hedge:
+                self._stats["hedges_won"] += 1
+                logger.info(f"Hedged request won after {time.monotonic() - started_at:.2f}s (hedge delay {hedge_delay:.2f}s)")
+            return result
+        finally:
+            if not primary.done():
+                primary.cancel()
+
+    async def _start_hedge(self, policy: CompletionPolicy, estimated_tokens: int, call, primary_endpoints: set, started_at: float):
+        if not self._hedge_budget.can_spend(estimated_tokens):
+            self._stats["hedges_skipped_budget"] += 1
+            return None
+
+        nia_azure_client = await NiaAzureOpenAIClient.create()
+        acquired = nia_azure_client.try_acquire_deployment(policy.models, estimated_tokens, primary_endpoints)
+        if acquired is None:
+            self._stats["hedges_skipped_no_endpoint"] += 1
+            return None
+
+        # Only a hedge that is actually sent counts against the budget
+        self._hedge_budget.spend(estimated_tokens)
+        endpoint, model = acquired
+        self._stats["hedges_fired"] += 1
+        logger.info(f"Hedging slow request with '{model}' on {endpoint.name}")
+        remaining = max(0.0, started_at + policy.deadline_seconds - time.monotonic())
+        return asyncio.create_task(call(endpoint.client, model, remaining))
+
+    async def _execute(self, policy: CompletionPolicy, estimated_tokens: int, call, used_endpoints: set = None):
+        nia_azure_client = await NiaAzureOpenAIClient.create()
+        self._stats["requests"] += 1
+
+        started_at = time.monotonic()
+        deadline = started_at + policy.deadline_seconds
+        failed_endpoints = set()
+        tried_pairs = set()
+        last_exception = None
+
+        for attempt in range(policy.max_attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Completion deadline of {policy.deadline_seconds}s expired after {attempt} attempt(s)")
+                break
+
+            try:
+                endpoint, model = await nia_azure_client.acquire_deployment(policy.models, estimated_tokens, failed_endpoints, tried_pairs)
+            except Exception as e:
+                if not failed_endpoints and not tried_pairs:
+                    last_exception = e
+                    break
+                # Every alternative has been tried once: let circuit breakers and rate limit buckets decide on a second round
+                logger.info(f"All endpoint/deployment pairs tried once, starting over: {e}")
+                failed_endpoints.clear()
+                tried_pairs.clear()
+                continue
+
+            tried_pairs.add((endpoint.index, model))
+            if used_endpoints is not None:
+                used_endpoints.add(endpoint.index)
+
+            try:
+                result = await call(endpoint.client, model, remaining)
+                self._record_success(attempt, started_at)
+                if attempt > 0:
+                    logger.info(f"Succeeded with '{model}' on {endpoint.name} after {attempt} fallback(s)")
+                return result
+
+            except RateLimitError as e:
+                logger.warning(f"Rate-limit on '{model}' at {endpoint.name}: {e!s}")
+                last_exception = e
+
+            except (APIConnectionError, InternalServerError) as e:
+                logger.warning(f"Retryable error on {endpoint.name}: {type(e).__name__} - {e!s}")
+                failed_endpoints.add(endpoint.index)
+                last_exception = e
+
+            delay = min(policy.backoff(attempt), max(0.0, deadline - time.monotonic()))
+            await asyncio.sleep(delay)
+
+        self._stats["failed"] += 1
+        raise CompletionFailedError("All Azure OpenAI endpoints failed. Please try again later.", last_exception)
+
+    def _record_success(self, attempt: int, started_at: float):
+        self._stats["succeeded"] += 1
+        if attempt > 0:
+            latency_ms = (time.monotonic() - started_at) * 1000
+            self._stats["fallbacks"] += 1
+            self._stats["fallback_latency_ms_total"] += latency_ms
+            self._stats["fallback_latency_ms_max"] = max(self._stats["fallback_latency_ms_max"], latency_ms)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["fallback_latency_ms_avg"] = round(stats["fallback_latency_ms_total"] / stats["fallbacks"], 1) if stats["fallbacks"] else 0.0
+        stats["hedging_enabled"] = COMPLETION_HEDGING_ENABLED
+        hedge_delays = {key: latency.percentile(COMPLETION_HEDGE_PERCENTILE) for key, latency in self._latency.items()}
+        stats["hedge_delay_ms"] = {key: round(delay * 1000, 1) if delay is not None else None for key, delay in hedge_delays.items()}
+        stats.update(self._hedge_budget.stats())
+        return stats
+
+async def _first_successful(primary: asyncio.Task, hedge: asyncio.Task):
+    """Wait for the first task to succeed. Returns (result, task). Raises the primary error if both fail."""
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task
+                if task is hedge:
+                    logger.warning(f"Hedged request failed: {task.exception()!s}")
+        raise primary.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def _next_content(chunks):
+    """Return the next non-empty content delta of a stream, or None once the stream is exhausted."""
+    async for chunk in chunks:
+        if len(chunk.choices) > 0 and hasattr(chunk.choices[0].delta, 'content'):
+            content = chunk.choices[0].delta.content
+            if content is not None:
+                return content
+    return None
+
+# Process wide executor shared by every completion call
+completion_executor = CompletionExecutor()
@@ -0,0 +1,175 @@
+import os
+import json
+import logging
+from dotenv import load_dotenv
+
+from tokenizer_registry import tokenizer_registry, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+from token_ledger import ledger_for
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Deployment name -> context window in tokens, e.g. {"nia-gpt-35-turbo": 16385}
+CONTEXT_WINDOW_TOKENS = json.loads(os.getenv("CONTEXT_WINDOW_TOKENS", "{}"))
+CONTEXT_DEFAULT_WINDOW_TOKENS = int(os.getenv("CONTEXT_DEFAULT_WINDOW_TOKENS", 128000))
+# Upper bound of the prompt, whatever the window allows. Every prompt token costs TPM and time to first token.
+CONTEXT_MAX_PROMPT_TOKENS = int(os.getenv("CONTEXT_MAX_PROMPT_TOKENS", 32000))
+# Upper bound of the retrieved (RAG) context within the prompt
+CONTEXT_MAX_RAG_TOKENS = int(os.getenv("CONTEXT_MAX_RAG_TOKENS", 16000))
+# History messages read per request. Fewer are sent when they do not fit the budget.
+CONTEXT_HISTORY_MAX_MESSAGES = int(os.getenv("CONTEXT_HISTORY_MAX_MESSAGES", 50))
+# Order in which the optional parts claim the budget left after the system prompt and the user turn
+CONTEXT_PRIORITIES = [part.strip() for part in os.getenv("CONTEXT_PRIORITIES", "rag,summary,history").split(",") if part.strip()]
+# History messages passed to the function calling prompt (it only needs the recent turns to resolve references)
+CONTEXT_FUNCTION_CALLING_MESSAGES = int(os.getenv("CONTEXT_FUNCTION_CALLING_MESSAGES", 6))
+
+# Model families recognised in deployment names, most specific first: (name fragment, context window)
+MODEL_FAMILY_WINDOWS = [
+    ("gpt-4o", 128000), ("gpt4o", 128000), ("gpt-4.1", 1047576), ("gpt-5", 272000),
+    ("gpt-4-32k", 32768), ("gpt-4", 8192), ("gpt4", 8192), ("gpt-35", 16385), ("gpt-3.5", 16385),
+]
+
+RAG = "rag"
+SUMMARY = "summary"
+HISTORY = "history"
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+TRUNCATION_MARKER = "\n...[truncated]"
+
+class ContextBuilder:
+    """
+    Packs a conversation into the prompt budget of a deployment. The system prompt and the user turn are always kept,
+    the retrieved context, the conversation summary and the history share what is left in CONTEXT_PRIORITIES order.
+    History is kept newest first, whole messages only; the summary replaces the oldest turns when they no longer fit.
+    """
+
+    def __init__(self):
+        self._stats = {"builds": 0, "history_messages_kept": 0, "history_messages_dropped": 0, "summaries_used": 0,
+                       "rag_truncations": 0, "over_budget": 0}
+
+    def context_window(self, deployment: str) -> int:
+        if deployment in CONTEXT_WINDOW_TOKENS:
+            return int(CONTEXT_WINDOW_TOKENS[deployment])
+        lowered = (deployment or "").lower()
+        return next((window for fragment, window in MODEL_FAMILY_WINDOWS if fragment in lowered), CONTEXT_DEFAULT_WINDOW_TOKENS)
+
+    def prompt_budget(self, deployment: str, max_response_tokens: int = 0) -> int:
+        """Tokens the prompt may use: the window minus the response, capped by CONTEXT_MAX_PROMPT_TOKENS."""
+        return min(self.context_window(deployment) - int(max_response_tokens or 0), CONTEXT_MAX_PROMPT_TOKENS)
+
+    def fit(self, conversations: list, history_count: int, deployment: str, user_message: str, max_response_tokens: int = 0,
+            summary: str = None, reserved_tokens: int = 0) -> dict:
+        """
+        Fit conversations (system message, history_count history messages, then the current turn) into the budget, in place.
+        Turn messages other than the plain user message carry the retrieved context and are truncated when needed.
+        reserved_tokens keeps room for content that is added later (e.g. the retrieved context or an image).
+        Returns a report of what was kept.
+        """
+        ledger = ledger_for(deployment)
+        budget = self.prompt_budget(deployment, max_response_tokens)
+
+        system = [message for message in conversations[:1] if message.get("role") == "system"]
+        # A summary added by an earlier fit stands for history dropped then, it is placed again like a new one
+        history = conversations[len(system):len(system) + history_count]
+        earlier_summaries = [message for message in history if self._is_summary(message)]
+        history = [message for message in history if not self._is_summary(message)]
+        turn = conversations[len(system) + history_count:]
+        rag_indexes = [index for index, message in enumerate(turn) if message.get("role") == "user" and message.get("content") != user_message]
+
+        def cost(message: dict) -> int:
+            return ledger.count_content(message["content"], deployment) + TOKENS_PER_MESSAGE
+
+        # Step 1: The system prompt and the user turn are always sent
+        remaining = budget - reserved_tokens - TOKENS_PER_REPLY
+        remaining -= sum(cost(message) for message in system)
+        remaining -= sum(cost(message) for index, message in enumerate(turn) if index not in rag_indexes)
+
+        # Step 2: The optional parts claim the rest in priority order
+        history_costs = [cost(message) for message in history]
+        summary_message = {"role": "system", "content": f"{SUMMARY_PREFIX}{summary}"} if summary else (earlier_summaries[0] if earlier_summaries else None)
+        kept_history, used_summary, truncated_rag, history_done, dropped_rag = [], False, False, False, set()
+
+        for part in CONTEXT_PRIORITIES:
+            if part == RAG:
+                for index in rag_indexes:
+                    allowed = max(0, min(remaining, CONTEXT_MAX_RAG_TOKENS)) - TOKENS_PER_MESSAGE
+                    if cost(turn[index]) - TOKENS_PER_MESSAGE > allowed:
+                        turn[index] = dict(turn[index], content=self.truncate(turn[index]["content"], allowed, deployment))
+                        truncated_rag = True
+                        if isinstance(turn[index]["content"], str) and cost(turn[index]) - TOKENS_PER_MESSAGE > allowed:
+                            # Not even the truncation marker fits: the retrieved context is left out
+                            dropped_rag.add(index)
+                            continue
+                    remaining -= cost(turn[index])
+            elif part == SUMMARY:
+                # Needed only when the history does not fit as a whole
+                history_dropped = bool(earlier_summaries) or (len(kept_history) < len(history) if history_done else sum(history_costs) > remaining)
+                if summary_message is not None and history_dropped and cost(summary_message) <= remaining:
+                    used_summary = True
+                    remaining -= cost(summary_message)
+            elif part == HISTORY:
+                for message, message_cost in zip(reversed(history), reversed(history_costs)):
+                    if message_cost > remaining:
+                        break
+                    kept_history.insert(0, message)
+                    remaining -= message_cost
+                history_done = True
+            else:
+                logger.warning(f"Unknown context part '{part}' in CONTEXT_PRIORITIES")
+
+        turn = [message for index, message in enumerate(turn) if index not in dropped_rag]
+        conversations[:] = system + ([summary_message] if used_summary else []) + kept_history + turn
+
+        self._stats["builds"] += 1
+        self._stats["history_messages_kept"] += len(kept_history)
+        self._stats["history_messages_dropped"] += len(history) - len(kept_history)
+        self._stats["summaries_used"] += int(used_summary)
+        self._stats["rag_truncations"] += int(truncated_rag)
+        if remaining < 0:
+            self._stats["over_budget"] += 1
+            logger.warning(f"Context for {deployment} exceeds its budget of {budget} tokens by {-remaining} tokens (system prompt and user turn are never trimmed)")
+
+        return {"budget": budget, "prompt_tokens": budget - reserved_tokens - remaining, "history_kept": len(kept_history),
+                "history_dropped": len(history) - len(kept_history), "summary_used": used_summary, "rag_truncated": truncated_rag}
+
+    def reserve_for_turn(self, deployment: str, user_message: str, use_rag: bool = False, has_image: bool = False) -> int:
+        """Tokens to keep free while the history is fitted, for the parts of the turn that are added afterwards."""
+        reserved = ledger_for(deployment).count(user_message or "") + TOKENS_PER_MESSAGE
+        # The retrieved context is only guaranteed its room when it ranks before the history
+        if use_rag and RAG in CONTEXT_PRIORITIES and (HISTORY not in CONTEXT_PRIORITIES or CONTEXT_PRIORITIES.index(RAG) < CONTEXT_PRIORITIES.index(HISTORY)):
+            reserved += CONTEXT_MAX_RAG_TOKENS
+        if has_image:
+            reserved += tokenizer_registry.image_tokens(deployment)
+        return reserved
+
+    def _is_summary(self, message: dict) -> bool:
+        return message.get("role") == "system" and isinstance(message.get("content"), str) and message["content"].startswith(SUMMARY_PREFIX)
+
+    def truncate(self, content, max_tokens: int, deployment: str = None):
+        """Cut a text to max_tokens tokens of the deployment's encoding. Multi-part contents are returned unchanged."""
+        if not isinstance(content, str):
+            return content
+        encoder = tokenizer_registry.encoder_for(deployment)
+        tokens = encoder.encode(content, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return content
+        marker_tokens = len(encoder.encode(TRUNCATION_MARKER, disallowed_special=()))
+        return encoder.decode(tokens[:max(0, max_tokens - marker_tokens)]) + TRUNCATION_MARKER
+
+    def recent_context(self, conversations: list, count: int = CONTEXT_FUNCTION_CALLING_MESSAGES) -> list:
+        """The system message and the last count other messages."""
+        system = [message for message in conversations[:1] if message.get("role") == "system"]
+        return system + conversations[len(system):][-count:] if count > 0 else system
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["priorities"] = CONTEXT_PRIORITIES
+        stats["max_prompt_tokens"] = CONTEXT_MAX_PROMPT_TOKENS
+        stats["max_rag_tokens"] = CONTEXT_MAX_RAG_TOKENS
+        stats["history_max_messages"] = CONTEXT_HISTORY_MAX_MESSAGES
+        return stats
+
+# Process wide builder
+context_builder = ContextBuilder()
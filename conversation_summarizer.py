@@ -0,0 +1,156 @@
+import os
+import time
+import asyncio
+import logging
+import datetime as date
+from bson import ObjectId
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+from dotenv import load_dotenv
+
+from mongo_service import get_collection, fetch_chat_history_page, encode_history_cursor, decode_history_cursor, created_at_utc, CHAT_HISTORY_MAX_PAGE_SIZE
+from entity_cache import entity_cache, SUMMARIES
+from token_ledger import ledger_for
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Off by default: every run is a background completion on the production deployments
+SUMMARIZER_ENABLED = os.getenv("SUMMARIZER_ENABLED", "false").lower() == "true"
+# Tokens of not yet summarized history that trigger a new summary version after a turn
+SUMMARIZER_TRIGGER_TOKENS = int(os.getenv("SUMMARIZER_TRIGGER_TOKENS", 6000))
+# The newest messages are always sent verbatim, they are left out of the summary
+SUMMARIZER_KEEP_RECENT_MESSAGES = int(os.getenv("SUMMARIZER_KEEP_RECENT_MESSAGES", 6))
+# Older versions are pruned, the newest SUMMARIZER_KEEP_VERSIONS are kept
+SUMMARIZER_KEEP_VERSIONS = int(os.getenv("SUMMARIZER_KEEP_VERSIONS", 3))
+
+# Cursor before the first message of any conversation (legacy string dates sort before native dates)
+HISTORY_START_CURSOR = encode_history_cursor({"created_at": "", "_id": ObjectId("000000000000000000000000")})
+# Position of messages whose created_at cannot be parsed
+UNKNOWN_TIME = date.datetime.min.replace(tzinfo=date.timezone.utc)
+
+class ConversationSummarizer:
+    """
+    Rolling summaries of long conversations, one versioned document per gpt in conversation_summaries.
+    Summaries are kept per gpt, like the history sent to the model (fetch_chat_history reads all the use cases of the gpt).
+    A new version folds the messages after the previous version's cursor into the previous summary. Runs are
+    scheduled after a turn completes and run in the background, off the latency critical path of the next request.
+    """
+
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._stats = {"scheduled": 0, "skipped_running": 0, "runs": 0, "versions_written": 0, "messages_summarized": 0,
+                       "errors": 0, "last_run_seconds": None}
+
+    async def get_summary(self, gpt_id: str) -> dict:
+        """Latest summary version of the conversation (None when there is none), read through the entity cache."""
+        if not SUMMARIZER_ENABLED:
+            return None
+        return await entity_cache.get_or_load(SUMMARIES, str(gpt_id), lambda: self._load_summary(gpt_id))
+
+    async def _load_summary(self, gpt_id: str) -> dict:
+        summaries_collection = await get_collection(SUMMARIES)
+        return await summaries_collection.find_one({"gpt_id": ObjectId(gpt_id)}, sort=[("version", DESCENDING)])
+
+    def unsummarized_tokens(self, chat_history: list, summary: dict = None) -> int:
+        """Tokens of the (chronological, chat_context) history messages newer than the summary, except the ones always sent verbatim."""
+        covered = self._position(*decode_history_cursor(summary["cursor"])) if summary else None
+        candidates = chat_history[:-SUMMARIZER_KEEP_RECENT_MESSAGES] if SUMMARIZER_KEEP_RECENT_MESSAGES > 0 else chat_history
+        return sum(message.get("token_count") or 0 for message in candidates
+                   if covered is None or self._position(message.get("created_at"), message.get("_id")) > covered)
+
+    def _position(self, created_at, message_id) -> tuple:
+        """(created_at in UTC, _id) of a message. Native and legacy string dates are normalized, so they compare by time."""
+        return created_at_utc(created_at) or UNKNOWN_TIME, str(message_id)
+
+    def maybe_schedule(self, gpt: dict, chat_history: list, summary: dict, summarize) -> bool:
+        """
+        Start a background run when the history newer than the summary crossed SUMMARIZER_TRIGGER_TOKENS.
+        summarize(messages, gpt, previous_summary) returns the new summary text.
+        """
+        if not SUMMARIZER_ENABLED or self.unsummarized_tokens(chat_history, summary) < SUMMARIZER_TRIGGER_TOKENS:
+            return False
+
+        key = str(gpt["_id"])
+        if key in self._tasks:
+            self._stats["skipped_running"] += 1
+            return False
+
+        self._stats["scheduled"] += 1
+        task = asyncio.create_task(self.run(gpt, summarize))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return True
+
+    async def run(self, gpt: dict, summarize) -> dict:
+        """Write the next summary version of the conversation. Returns the new version, None when there is nothing to summarize."""
+        started = time.monotonic()
+        gpt_id = str(gpt["_id"])
+        try:
+            # Step 1: The latest version, read from the database (another worker may have written a newer one)
+            previous = await self._load_summary(gpt_id)
+
+            # Step 2: The messages after it, oldest first, without the newest ones that are sent verbatim anyway
+            page = await fetch_chat_history_page(gpt_id, CHAT_HISTORY_MAX_PAGE_SIZE, after=previous["cursor"] if previous else HISTORY_START_CURSOR,
+                                                 profile="chat_context", with_cursors=True)
+            messages = page["chat_history"]
+            if page["after"] is None and SUMMARIZER_KEEP_RECENT_MESSAGES > 0:
+                messages = messages[:-SUMMARIZER_KEEP_RECENT_MESSAGES]
+            if not messages:
+                return None
+
+            # Step 3: Fold them into the previous summary
+            text = await summarize([{"role": message["role"], "content": message["content"]} for message in messages], gpt, previous["summary"] if previous else None)
+            version = {
+                "gpt_id": ObjectId(gpt_id),
+                "version": previous["version"] + 1 if previous else 1,
+                "summary": text,
+                "token_count": ledger_for(gpt["name"]).count(text),
+                "cursor": messages[-1]["cursor"],
+                "covered_until": created_at_utc(messages[-1]["created_at"]),
+                "message_count": (previous["message_count"] if previous else 0) + len(messages),
+                "created_at": date.datetime.now(date.timezone.utc),
+            }
+
+            # Step 4: Store the version. The unique (gpt_id, version) index lets one concurrent writer win.
+            summaries_collection = await get_collection(SUMMARIES)
+            try:
+                await summaries_collection.insert_one(version)
+            except DuplicateKeyError:
+                logger.info(f"Summary version {version['version']} of {gpt_id} already written by another worker")
+                return None
+            await summaries_collection.delete_many({"gpt_id": ObjectId(gpt_id), "version": {"$lte": version["version"] - SUMMARIZER_KEEP_VERSIONS}})
+            entity_cache.invalidate(SUMMARIES, gpt_id)
+
+            self._stats["versions_written"] += 1
+            self._stats["messages_summarized"] += len(messages)
+            logger.info(f"Summary version {version['version']} of {gpt_id} written: {len(messages)} message(s) folded in, {version['token_count']} tokens")
+            return version
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Conversation summarization of {gpt_id} failed: {e}", exc_info=True)
+            return None
+        finally:
+            self._stats["runs"] += 1
+            self._stats["last_run_seconds"] = round(time.monotonic() - started, 2)
+
+    async def stop(self):
+        """Shutdown hook: cancel the running summarizations, the next turn schedules them again."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["enabled"] = SUMMARIZER_ENABLED
+        stats["running"] = len(self._tasks)
+        stats["trigger_tokens"] = SUMMARIZER_TRIGGER_TOKENS
+        return stats
+
+# Process wide summarizer, shared by all requests of the worker
+conversation_summarizer = ConversationSummarizer()
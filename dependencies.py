@@ -1,19 +1,188 @@
 import os
-from openai import AsyncAzureOpenAI
-from openai import APIConnectionError, RateLimitError
+import time
+import random
+import httpx
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 import asyncio
 import logging
 
+from rate_limiter import rate_limiter
+
 load_dotenv()
 
 # Create a logger for this module
 logger = logging.getLogger(__name__)
+
+# Endpoint pool parameters
+POOL_FAILURE_THRESHOLD = int(os.getenv("AZURE_OPENAI_POOL_FAILURE_THRESHOLD", 3)) # consecutive failures before the circuit opens
+POOL_COOLDOWN_SECONDS = float(os.getenv("AZURE_OPENAI_POOL_COOLDOWN_SECONDS", 30)) # time an open circuit waits before a trial request
+POOL_PROBE_INTERVAL_SECONDS = float(os.getenv("AZURE_OPENAI_POOL_PROBE_INTERVAL_SECONDS", 15))
+POOL_PROBE_TIMEOUT_SECONDS = float(os.getenv("AZURE_OPENAI_POOL_PROBE_TIMEOUT_SECONDS", 5))
+POOL_LATENCY_EWMA_ALPHA = 0.2
+POOL_DEFAULT_LATENCY_SECONDS = 1.0 # assumed latency for endpoints without any samples yet
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# Status codes that indicate the endpoint itself is unhealthy (429 is a quota signal, not a health signal)
+UNHEALTHY_STATUS_CODES = (500, 502, 503, 504)
+
+class EndpointState:
+    """Load, latency and circuit breaker state of a single Azure OpenAI endpoint."""
+
+    def __init__(self, index: int, config: dict):
+        self.index = index
+        self.config = config
+        self.client: AsyncAzureOpenAI = None
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.consecutive_failures = 0
+        self.circuit_state = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_probe_at = None
+        self.last_probe_ok = None
+
+    @property
+    def name(self) -> str:
+        return self.config["name"]
+
+    def is_available(self) -> bool:
+        if self.circuit_state == CIRCUIT_CLOSED:
+            return True
+
+        if self.circuit_state == CIRCUIT_OPEN and time.monotonic() - self.opened_at >= POOL_COOLDOWN_SECONDS:
+            logger.info(f"Circuit half-open for Azure OpenAI: {self.name}")
+            self.circuit_state = CIRCUIT_HALF_OPEN
+
+        # A half-open endpoint only admits a single trial request at a time
+        return self.circuit_state == CIRCUIT_HALF_OPEN and self.in_flight == 0
+
+    def score(self) -> float:
+        """Lower is better: expected wait given the current queue depth and recent latency."""
+        latency = self.latency_ewma if self.latency_ewma is not None else POOL_DEFAULT_LATENCY_SECONDS
+        return (self.in_flight + 1) * latency
+
+    def begin_request(self):
+        self.in_flight += 1
+        self.total_requests += 1
+
+    def end_request(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def record_success(self, latency_seconds: float = None):
+        if latency_seconds is not None:
+            if self.latency_ewma is None:
+                self.latency_ewma = latency_seconds
+            else:
+                self.latency_ewma = POOL_LATENCY_EWMA_ALPHA * latency_seconds + (1 - POOL_LATENCY_EWMA_ALPHA) * self.latency_ewma
+
+        self.consecutive_failures = 0
+        if self.circuit_state != CIRCUIT_CLOSED:
+            logger.info(f"Circuit closed for Azure OpenAI: {self.name}")
+            self.circuit_state = CIRCUIT_CLOSED
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.total_failures += 1
+
+        if self.circuit_state == CIRCUIT_HALF_OPEN or self.consecutive_failures >= POOL_FAILURE_THRESHOLD:
+            if self.circuit_state != CIRCUIT_OPEN:
+                logger.warning(f"Circuit opened for Azure OpenAI: {self.name} after {self.consecutive_failures} failures")
+            self.circuit_state = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "circuit_state": self.circuit_state,
+            "in_flight": self.in_flight,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "last_probe_ok": self.last_probe_ok,
+        }
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Wraps a response body so the endpoint's in-flight slot is released once the body is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._on_close()
+        await self._stream.aclose()
+
+def _deployment_from_path(path: str) -> str:
+    # e.g. /openai/deployments/gpt-4o/chat/completions
+    return path.split("/deployments/", 1)[1].split("/", 1)[0]
+
+class _EndpointTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that reports every model call of an endpoint back to its EndpointState.
+    Tracking at the transport level covers standard and streaming calls from every call site.
+    """
+
+    def __init__(self, endpoint: EndpointState):
+        self._endpoint = endpoint
+        self._transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self._endpoint
+        is_model_call = "/deployments/" in request.url.path # health probes (models.list) are tracked by the probe loop
+
+        if is_model_call:
+            endpoint.begin_request()
+        start = time.monotonic()
+
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException as e:
+            if is_model_call:
+                endpoint.end_request()
+                if isinstance(e, httpx.TransportError):
+                    endpoint.record_failure()
+            raise
+
+        if not is_model_call:
+            return response
+
+        # Keep the client-side rate limiter in sync with the quota reported by Azure
+        rate_limiter.update_from_headers(endpoint.name, _deployment_from_path(request.url.path), response.headers, response.status_code)
+
+        if response.status_code in UNHEALTHY_STATUS_CODES:
+            endpoint.record_failure()
+        else:
+            # Time to response headers. For streams this is the time to the first chunk.
+            endpoint.record_success(time.monotonic() - start)
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, endpoint.end_request),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
 class NiaAzureOpenAIClient:
     _instance = None
-    _clients = []
-    _configs = []
-    _current_index = 0
+    _endpoints: list[EndpointState] = []
+    _init_lock = asyncio.Lock()
+    _probe_task: asyncio.Task = None
 
     def __init__(self):
         pass  # Initialization logic is handled in async create method
@@ -21,63 +190,189 @@ class NiaAzureOpenAIClient:
     @classmethod
     async def create(cls):
         if cls._instance is None:
-            cls._instance = cls()
-            await cls._instance._initialize()
+            async with cls._init_lock:
+                if cls._instance is None:
+                    instance = cls()
+                    await instance._initialize()
+                    cls._instance = instance
         return cls._instance
 
     async def _initialize(self):
         endpoints = self._collect_env_endpoints()
 
-        for endpoint in endpoints:
-            try:
-                client = AsyncAzureOpenAI(
-                    azure_endpoint=endpoint["name"],
-                    api_key=endpoint["api_key"],
-                    api_version=endpoint["api_version"],
-                    max_retries=0
-                )
+        for index, endpoint in enumerate(endpoints):
+            state = EndpointState(index, endpoint)
+            state.client = AsyncAzureOpenAI(
+                azure_endpoint=endpoint["name"],
+                api_key=endpoint["api_key"],
+                api_version=endpoint["api_version"],
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(transport=_EndpointTransport(state))
+            )
+            self._endpoints.append(state)
+
+        if not self._endpoints:
+            raise Exception("No available Azure OpenAI endpoints.")
 
-                # Test connection
-                await client.models.list()
+        # Test connections concurrently. Failed endpoints stay in the pool with an open circuit
+        # so that the background probes can bring them back once they recover.
+        await asyncio.gather(*(self._probe(state) for state in self._endpoints))
+
+        if not any(state.circuit_state == CIRCUIT_CLOSED for state in self._endpoints):
+            raise Exception("No available Azure OpenAI endpoints.")
 
-                logger.info(f"Connected to Azure OpenAI: {endpoint['name']}")
-                self._clients.append(client)
-                self._configs.append(endpoint)
+        self.start_health_probes()
 
+    async def _probe(self, state: EndpointState):
+        state.last_probe_at = time.monotonic()
+        try:
+            await asyncio.wait_for(state.client.models.list(), timeout=POOL_PROBE_TIMEOUT_SECONDS)
+            state.last_probe_ok = True
+            state.record_success()
+            logger.info(f"Connected to Azure OpenAI: {state.name}")
+        except Exception as e:
+            state.last_probe_ok = False
+            # A failed probe opens the circuit immediately, regardless of the failure threshold
+            state.consecutive_failures = max(state.consecutive_failures, POOL_FAILURE_THRESHOLD - 1)
+            state.record_failure()
+            logger.info(f"Failed to connect to {state.name}: {str(e)}")
+
+    async def _health_probe_loop(self):
+        while True:
+            await asyncio.sleep(POOL_PROBE_INTERVAL_SECONDS)
+            try:
+                await asyncio.gather(*(self._probe(state) for state in self._endpoints))
             except Exception as e:
-                logger.info(f"Failed to connect to {endpoint['name']}: {str(e)}")
+                logger.error(f"Error during Azure OpenAI health probes: {e}", exc_info=True)
 
-        if not self._clients:
-            raise Exception("No available Azure OpenAI endpoints.")
+    def start_health_probes(self):
+        cls = type(self)
+        if cls._probe_task is None or cls._probe_task.done():
+            cls._probe_task = asyncio.create_task(self._health_probe_loop())
+            logger.info(f"Started Azure OpenAI health probes every {POOL_PROBE_INTERVAL_SECONDS}s")
 
-    def get_azure_client(self):
-        if not self._clients:
+    @classmethod
+    async def shutdown(cls):
+        if cls._probe_task is not None:
+            cls._probe_task.cancel()
+            try:
+                await cls._probe_task
+            except asyncio.CancelledError:
+                pass
+            cls._probe_task = None
+
+        for state in cls._endpoints:
+            await state.client.close()
+
+        cls._endpoints.clear()
+        cls._instance = None
+        logger.info("Azure OpenAI endpoint pool closed")
+
+    def select_endpoint(self, exclude: tuple = ()) -> EndpointState:
+        """Pick the available endpoint with the lowest expected wait. Ties are broken randomly."""
+        if not self._endpoints:
+            raise ValueError("Azure clients have not been initialized.")
+
+        candidates = [state for state in self._endpoints if state.index not in exclude and state.is_available()]
+        if not candidates:
+            return self._least_bad_endpoint(exclude)
+
+        return min(candidates, key=lambda state: (state.score(), random.random()))
+
+    def _least_bad_endpoint(self, exclude: set = ()) -> EndpointState:
+        """
+        Endpoint to use when no circuit admits a request: a busy half-open endpoint first, then the open circuit
+        closest to its trial request. Failing the request outright would make a single endpoint pool a full outage.
+        """
+        remaining = [state for state in self._endpoints if state.index not in exclude]
+        if not remaining:
+            raise Exception("All Azure OpenAI endpoints are unavailable.")
+
+        state = min(remaining, key=lambda state: (state.circuit_state == CIRCUIT_OPEN, state.opened_at, state.score()))
+        logger.warning(f"No Azure OpenAI endpoint available, falling back to {state.name} (circuit {state.circuit_state})")
+        return state
+
+    async def acquire_deployment(self, models: list[str], estimated_tokens: int, exclude_endpoints: set = (), exclude_pairs: set = ()) -> tuple[EndpointState, str]:
+        """
+        Pick the (endpoint, deployment) pair to send a request to.
+        Prefers the first model in the list, on the best scored endpoint, that has rate limit headroom.
+        If nothing has headroom, waits in a short queue for the preferred pair before giving up and
+        letting the service decide.
+        """
+        if not self._endpoints:
             raise ValueError("Azure clients have not been initialized.")
-        return self._clients[self._current_index]
+
+        candidates = sorted(
+            (state for state in self._endpoints if state.index not in exclude_endpoints and state.is_available()),
+            key=lambda state: (state.score(), random.random())
+        )
+        if not candidates:
+            candidates = [self._least_bad_endpoint(exclude_endpoints)]
+
+        pairs = [(state, model) for model in models for state in candidates if (state.index, model) not in exclude_pairs]
+        if not pairs:
+            raise Exception("No untried Azure OpenAI endpoint/deployment left.")
+
+        for state, model in pairs:
+            if rate_limiter.try_acquire(state.name, model, estimated_tokens):
+                return state, model
+
+        best, model = pairs[0]
+        if await rate_limiter.acquire(best.name, model, estimated_tokens):
+            return best, model
+
+        logger.warning(f"No rate limit headroom for {models} ({estimated_tokens} tokens). Sending to {best.name} anyway")
+        return best, model
+
+    def try_acquire_deployment(self, models: list[str], estimated_tokens: int, exclude_endpoints: set = ()) -> tuple[EndpointState, str]:
+        """
+        Non-blocking variant of acquire_deployment. Returns None instead of queueing when no
+        available (endpoint, deployment) pair has rate limit headroom.
+        """
+        candidates = sorted(
+            (state for state in self._endpoints if state.index not in exclude_endpoints and state.is_available()),
+            key=lambda state: (state.score(), random.random())
+        )
+        for model in models:
+            for state in candidates:
+                if rate_limiter.try_acquire(state.name, model, estimated_tokens):
+                    return state, model
+        return None
+
+    def get_endpoint_for_client(self, client: AsyncAzureOpenAI) -> EndpointState:
+        return next((state for state in self._endpoints if state.client is client), None)
+
+    def get_azure_client(self):
+        return self.select_endpoint().client
 
     def get_config(self):
-        if not self._configs:
-            raise ValueError("Azure configs have not been initialized.")
-        return self._configs[self._current_index]
+        return self.select_endpoint().config
 
-    async def retry_with_next_endpoint(self):
-        if not self._clients:
+    async def retry_with_next_endpoint(self, failed_client: AsyncAzureOpenAI = None):
+        """
+        Return the best endpoint other than the one that just failed.
+        Endpoint health comes from the background probes, so nothing is probed on the request path.
+        """
+        if not self._endpoints:
             raise ValueError("No available clients to retry.")
 
-        original_index = self._current_index
-        total = len(self._clients)
+        failed_endpoint = self.get_endpoint_for_client(failed_client) if failed_client is not None else None
+        exclude = (failed_endpoint.index,) if failed_endpoint is not None else ()
 
-        for _ in range(total):
-            self._current_index = (self._current_index + 1) % total
-            try:
-                await self._clients[self._current_index].models.list()
-                logger.info(f"Switched to Azure OpenAI: {self._configs[self._current_index]['name']}")
-                return self._clients[self._current_index]
-            except Exception as e:
-                logger.info(f"Failed on retry with {self._configs[self._current_index]['name']}: {e}")
-                continue
+        try:
+            state = self.select_endpoint(exclude)
+        except Exception:
+            # Single endpoint deployments (or everything else down): retry the same endpoint if its circuit allows it
+            if failed_endpoint is not None and failed_endpoint.is_available():
+                state = failed_endpoint
+            else:
+                raise Exception("All Azure OpenAI endpoints failed during retry.")
+
+        logger.info(f"Switched to Azure OpenAI: {state.name}")
+        return state.client
 
-        raise Exception("All Azure OpenAI endpoints failed during retry.")
+    def get_pool_stats(self) -> list[dict]:
+        return [state.stats() for state in self._endpoints]
 
     def _collect_env_endpoints(self):
         endpoints = []
@@ -103,4 +398,4 @@ class NiaAzureOpenAIClient:
 
             i += 1
 
-        return endpoints
\ No newline at end of file
+        return endpoints
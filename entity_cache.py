@@ -0,0 +1,157 @@
+import os
+import copy
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from mongo_client import get_mongo_db
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+ENTITY_CACHE_ENABLED = os.getenv("ENTITY_CACHE_ENABLED", "true").lower() == "true"
+ENTITY_CACHE_TTL_SECONDS = float(os.getenv("ENTITY_CACHE_TTL_SECONDS", 60))
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", 1000))
+# Invalidate on changes made by other workers. Requires a replica set (change streams).
+ENTITY_CACHE_CHANGE_STREAMS = os.getenv("ENTITY_CACHE_CHANGE_STREAMS", "false").lower() == "true"
+
+GPTS = "gpts"
+USECASES = "usecases"
+SUMMARIES = "conversation_summaries" # keyed by gpt_id, see conversation_summarizer.py
+
+class EntityCache:
+    """
+    Read-through TTL/LRU cache for the rarely changing gpt and usecase documents, keyed by (kind, gpt_id).
+    Writers in mongo_service invalidate the entries they change. Entries are copied on the way in and out,
+    so callers can modify what they get. Concurrent misses for the same key share a single database read.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict = OrderedDict()
+        self._loading: dict[tuple, asyncio.Future] = {}
+        self._generations: dict[tuple, int] = {}
+        self._change_stream_task: asyncio.Task = None
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "evictions": 0, "change_events": 0}
+
+    async def get_or_load(self, kind: str, key: str, loader):
+        """Return the cached document for (kind, key), calling loader() on a miss."""
+        if not ENTITY_CACHE_ENABLED:
+            return await loader()
+
+        cache_key = (kind, str(key))
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(cache_key)
+            self._stats["hits"] += 1
+            return copy.deepcopy(entry[1])
+
+        if cache_key in self._loading:
+            self._stats["coalesced"] += 1
+            return copy.deepcopy(await asyncio.shield(self._loading[cache_key]))
+
+        self._stats["misses"] += 1
+        generation = self._generations.get(cache_key, 0)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[cache_key] = future
+        try:
+            value = await loader()
+            # An invalidation while loading means the value may already be stale
+            if self._generations.get(cache_key, 0) == generation:
+                self._store(cache_key, copy.deepcopy(value))
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # Waiters get the exception, nobody else needs to retrieve it
+            raise
+        finally:
+            self._loading.pop(cache_key, None)
+
+    def _store(self, cache_key: tuple, value):
+        self._entries[cache_key] = (time.monotonic() + ENTITY_CACHE_TTL_SECONDS, value)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > ENTITY_CACHE_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, kind: str, key: str = None):
+        """Drop one entry, or every entry of a kind when no key is given."""
+        cache_keys = [(kind, str(key))] if key is not None else [cache_key for cache_key in self._entries if cache_key[0] == kind]
+        for cache_key in cache_keys:
+            self._entries.pop(cache_key, None)
+            self._generations[cache_key] = self._generations.get(cache_key, 0) + 1
+        if key is None:
+            # Pending loads of the kind must not fill the cache either
+            for cache_key in self._loading:
+                if cache_key[0] == kind:
+                    self._generations[cache_key] = self._generations.get(cache_key, 0) + 1
+        self._stats["invalidations"] += len(cache_keys)
+
+    def invalidate_gpt(self, gpt_id: str):
+        self.invalidate(GPTS, gpt_id)
+        self.invalidate(USECASES, gpt_id)
+
+    def start_change_stream(self):
+        if ENTITY_CACHE_ENABLED and ENTITY_CACHE_CHANGE_STREAMS and (self._change_stream_task is None or self._change_stream_task.done()):
+            self._change_stream_task = asyncio.create_task(self._watch())
+
+    async def stop_change_stream(self):
+        if self._change_stream_task is not None:
+            self._change_stream_task.cancel()
+            try:
+                await self._change_stream_task
+            except asyncio.CancelledError:
+                pass
+            self._change_stream_task = None
+
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": [GPTS, USECASES]}}}]
+        retry_delay = 1
+
+        while True:
+            try:
+                db = await get_mongo_db()
+                async with db.watch(pipeline, full_document="updateLookup") as stream:
+                    logger.info("Entity cache is following the gpts and usecases change stream")
+                    retry_delay = 1
+                    async for change in stream:
+                        self._apply_change(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Without the change stream, entries still expire after ENTITY_CACHE_TTL_SECONDS
+                logger.warning(f"Entity cache change stream interrupted, retrying in {retry_delay}s: {e}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+
+    def _apply_change(self, change: dict):
+        self._stats["change_events"] += 1
+        collection = change.get("ns", {}).get("coll")
+        document = change.get("fullDocument") or {}
+
+        if collection == GPTS:
+            self.invalidate_gpt(change["documentKey"]["_id"])
+        elif collection == USECASES and document.get("gpt_id") is not None:
+            self.invalidate(USECASES, document["gpt_id"])
+        elif collection == USECASES:
+            # Deleted usecases do not carry their gpt_id anymore
+            self.invalidate(USECASES)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_ratio"] = round((stats["hits"] + stats["coalesced"]) / lookups, 3) if lookups else 0.0
+        stats["entries"] = len(self._entries)
+        stats["enabled"] = ENTITY_CACHE_ENABLED
+        stats["change_streams"] = self._change_stream_task is not None and not self._change_stream_task.done()
+        return stats
+
+# Process wide cache used by mongo_service
+entity_cache = EntityCache()
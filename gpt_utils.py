@@ -4,10 +4,12 @@ from data.GPTData import GPTData
 import logging
 import json
 import re
-import tiktoken
 
 from mongo_service import update_usecases, update_orders, create_usecase_for_document_search
 from azure_ai_search_utils import store_to_azure_ai_search
+from search_cache import search_cache
+from blocking_io import run_blocking
+from token_ledger import ledger_for
 from constants import ALLOWED_DOCUMENT_EXTENSIONS, ALLOWED_IMAGE_EXTENSIONS
 
 logger = logging.getLogger(__name__)
@@ -18,8 +20,6 @@ APP_IMAGES_FOLDER = os.path.join(UPLOAD_FOLDER, "appimages")
 CHAT_IMAGES_FOLDER = os.path.join(UPLOAD_FOLDER, "chatimages")
 RAG_DOCUMENTS_FOLDER = os.path.join(UPLOAD_FOLDER, "ragdocuments")
 
-token_encoder = tiktoken.encoding_for_model("gpt-4o")
-
 def create_folders():
     # Create upload folders if they don't exist
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -89,12 +89,11 @@ async def handle_upload_files(gpt_id: str, gpt: GPTData, files: list[UploadFile]
 
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-                with open(file_path, "wb") as buffer:
-                    content = uploadedFile.file.read()
-                    if content:
-                        buffer.write(content)
-                    else:
-                        raise HTTPException(status_code=500, detail="Error saving file: Empty file.")
+                content = await uploadedFile.read()
+                if content:
+                    await run_blocking(_write_file, file_path, content)
+                else:
+                    raise HTTPException(status_code=500, detail="Error saving file: Empty file.")
                 
                 if file_name.find('usecases') != -1:
                     try:
@@ -137,6 +136,9 @@ async def handle_upload_files(gpt_id: str, gpt: GPTData, files: list[UploadFile]
             logger.info(f"Storing into Azure AI Search Index - Started")
             index_name, semantic_configuration_name = await store_to_azure_ai_search(gpt_id, True)
             logger.info(f"Storing into Azure AI Search Index - Completed")
+
+            # Re-indexed documents make the cached search results of this index stale
+            search_cache.invalidate(index_name=index_name, gpt_id=gpt_id)
         # else:
         #     # Store the uploaded PDF into vector database
         #     logger.info(f"Storing into vector database - Started")
@@ -148,6 +150,10 @@ async def handle_upload_files(gpt_id: str, gpt: GPTData, files: list[UploadFile]
 
     return file_upload_status
 
+def _write_file(file_path: str, content: bytes):
+    with open(file_path, "wb") as buffer:
+        buffer.write(content)
+
 def handle_image_uploads(uploadedFile: UploadFile):
     file_size = uploadedFile.size
     file_upload_status = ""
@@ -232,14 +238,16 @@ def get_previous_context_conversations(conversation_list, previous_conversations
 
     return previous_conversations
 
-def trim_conversation_history(conversation_history, max_tokens):
-    total_tokens = sum(len(msg['content'].split()) for msg in conversation_history)  # Simple token count (by word)
+def trim_conversation_history(conversation_history, max_tokens, model_name: str = None):
+    # Token counts of the model's encoding (see context_builder for the budgeted context used by generate_response)
+    ledger = ledger_for(model_name)
+    total_tokens = ledger.count_messages(conversation_history, deployment=model_name)
     
-    while total_tokens > max_tokens:
+    while total_tokens > max_tokens and len(conversation_history) > 2:
         # Remove the earliest user-assistant pairs to make space
         conversation_history.pop(1)  # Remove the first user message (system message stays)
         conversation_history.pop(1)  # Remove the first assistant message
-        total_tokens = sum(len(msg['content'].split()) for msg in conversation_history)
+        total_tokens = ledger.count_messages(conversation_history, deployment=model_name)
     
     return conversation_history
 
@@ -282,33 +290,24 @@ async def extract_json_content(response):
 
     return main_response, follow_up_questions, total_tokens 
 
-# Token counting function
+# Token counting function (cached per text by the token ledger of the model's encoding)
 async def count_tokens(text: str, model_name: str) -> int:
     tokens = 0
     try:
-        #tokenizer = MODEL_TOKENIZERS.get(model_name)
-        if model_name == "gpt-4o" or model_name == "gpt-3.5":
-            tokens = len(token_encoder.encode(str(text)))  # OpenAI's `tiktoken`
+        tokens = ledger_for(model_name).count(text)
     except Exception as e:
         logger.error(f"Tokenization error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Tokenization error: {str(e)}")
     finally:
-        logger.info(f"Token count {tokens} for model {model_name}")
+        logger.debug(f"Token count {tokens} for model {model_name}")
     
     return tokens
 
-
 async def get_token_count(model_name, system_message,  conversations, user_message, max_tokens: int = 0):
     # Construct the token request
-    # Remove the system message from the conversation history
-    user_conversations: str = ""
-    for msg in conversations:
-        if msg["role"] != "system":
-            user_conversations += str(msg["content"])+ " "
-
-    # Calculate tokens for each component
+    # The system message is counted separately, the history is the sum of the (cached) per message counts
     system_tokens = await count_tokens(system_message, model_name)
-    history_tokens = await count_tokens(user_conversations, model_name)
+    history_tokens = ledger_for(model_name).count_messages(conversations, include_system=False, deployment=model_name)
     query_tokens = await count_tokens(user_message, model_name)
 
     logger.info(f"System Tokens: {system_tokens}, History Tokens: {history_tokens}, Query Tokens: {query_tokens}")
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import math
+import time
+import asyncio
+import logging
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+
+from role_mapping import USE_CASE_CONFIG
+from blocking_io import run_blocking
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Off until standalone_programs/intent_router_eval.py has validated the thresholds against the real tool call log
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "false").lower() == "true"
+INTENT_ROUTER_MIN_SCORE = float(os.getenv("INTENT_ROUTER_MIN_SCORE", 0.3))
+INTENT_ROUTER_MIN_MARGIN = float(os.getenv("INTENT_ROUTER_MIN_MARGIN", 0.05))
+# A routed query is sent to Azure AI Search as is, so it must contain at least this many terms of the winning use case
+INTENT_ROUTER_MIN_MATCHED_TERMS = int(os.getenv("INTENT_ROUTER_MIN_MATCHED_TERMS", 2))
+# Gpts whose model is kept in memory, least recently used first out
+INTENT_ROUTER_MAX_GPTS = int(os.getenv("INTENT_ROUTER_MAX_GPTS", 256))
+# The tool call log holds raw user queries, it is only written when enabled. Past the size limit it is rotated to <log>.1.
+INTENT_ROUTER_TOOL_CALL_LOG_ENABLED = os.getenv("INTENT_ROUTER_TOOL_CALL_LOG_ENABLED", "false").lower() == "true"
+INTENT_ROUTER_TOOL_CALL_LOG = os.getenv("INTENT_ROUTER_TOOL_CALL_LOG", "logs/tool_calls.jsonl")
+INTENT_ROUTER_TOOL_CALL_LOG_MAX_BYTES = int(os.getenv("INTENT_ROUTER_TOOL_CALL_LOG_MAX_BYTES", 10 * 1024 * 1024))
+
+# Queries referring back to the conversation need the LLM to rephrase them with the history
+FOLLOW_UP_TERMS = {"it", "its", "that", "those", "these", "them", "they", "this", "above", "previous", "same", "earlier", "more", "else"}
+# Fields of the additional (NIA Finolex purchase order) index. Asking for them is what get_extra_data is for.
+EXTRA_DATA_TERMS = {"supplier", "suppliers", "purchase", "po", "expense", "expenses", "quantity", "net", "price", "plant", "currency"}
+STOP_WORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "by", "from", "at", "as", "is", "are", "was", "were",
+    "be", "been", "can", "could", "would", "should", "will", "you", "your", "i", "me", "my", "we", "our", "us", "please",
+    "what", "which", "who", "whom", "how", "when", "where", "why", "do", "does", "did", "all", "any", "if", "not", "no",
+    "query", "sources", "user", "response", "data", "retrieved", "format", "include", "provide", "based", "below",
+}
+
+class RouteDecision:
+    """Arguments for get_data_from_azure_search decided without the function calling model."""
+
+    def __init__(self, search_query: str, use_case: str, get_extra_data: bool, score: float, margin: float):
+        self.search_query = search_query
+        self.use_case = use_case
+        self.get_extra_data = get_extra_data
+        self.score = score
+        self.margin = margin
+
+    def to_dict(self) -> dict:
+        return {"search_query": self.search_query, "use_case": self.use_case, "get_extra_data": self.get_extra_data,
+                "score": round(self.score, 3), "margin": round(self.margin, 3)}
+
+class IntentModel:
+    """TF-IDF centroids of the use cases of one gpt. Built once, then only read by route()."""
+
+    def __init__(self):
+        self._examples: dict[str, list[str]] = {}
+        self._centroids: dict[str, dict] = {}
+        self._idf: dict[str, float] = {}
+
+    def add_example(self, use_case: str, text: str):
+        if use_case and text:
+            self._examples.setdefault(use_case, []).append(text)
+
+    def add_usecases(self, usecases: list):
+        """Learn the name, description and canned prompts of the gpt's use cases, with the USE_CASE_CONFIG examples of known names."""
+        for usecase in usecases or []:
+            name = usecase.get("name")
+            config = USE_CASE_CONFIG.get(name)
+            if config is not None:
+                self.add_example(name, f"{name.replace('_', ' ')} {config.get('role_information', '')} {config.get('user_message', '')}")
+            self.add_example(name, f"{name.replace('_', ' ')} {usecase.get('description', '')}")
+            for prompt in usecase.get("prompts", []) or []:
+                self.add_example(name, f"{prompt.get('title', '')} {prompt.get('prompt', '')}")
+
+    def build(self) -> "IntentModel":
+        documents = {use_case: Counter(token for text in texts for token in tokenize(text)) for use_case, texts in self._examples.items()}
+        document_frequency = Counter(token for counts in documents.values() for token in counts)
+        total = len(documents)
+        self._idf = {token: math.log((1 + total) / (1 + frequency)) + 1 for token, frequency in document_frequency.items()}
+        self._centroids = {use_case: self._vectorize(counts) for use_case, counts in documents.items()}
+        # The examples are not needed once the centroids exist
+        self._examples = {}
+        return self
+
+    def _vectorize(self, counts: Counter) -> dict:
+        vector = {token: (1 + math.log(count)) * self._idf.get(token, 0.0) for token, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {token: weight / norm for token, weight in vector.items()} if norm else {}
+
+    def classify(self, query: str) -> list[tuple[str, float]]:
+        """Use cases ranked by cosine similarity to the query."""
+        query_vector = self._vectorize(Counter(tokenize(query)))
+        scores = [
+            (use_case, sum(weight * centroid.get(token, 0.0) for token, weight in query_vector.items()))
+            for use_case, centroid in self._centroids.items()
+        ]
+        return sorted(scores, key=lambda item: item[1], reverse=True)
+
+    def decide(self, query: str, use_case: str, image_response: str = "") -> RouteDecision:
+        """The search arguments when the model is confident, None otherwise."""
+        words = set(re.findall(r"[a-z0-9]+", query.lower()))
+
+        # Image descriptions and follow-up questions need the model to write the search query
+        if image_response or words & FOLLOW_UP_TERMS or len(words) < 3:
+            return None
+
+        ranking = self.classify(query)
+        if not ranking:
+            return None
+
+        best_use_case, best_score = ranking[0]
+        margin = best_score - (ranking[1][1] if len(ranking) > 1 else 0.0)
+        if best_use_case != use_case or best_score < INTENT_ROUTER_MIN_SCORE or margin < INTENT_ROUTER_MIN_MARGIN:
+            return None
+
+        # The model would have rewritten a vague query into search terms, a routed one must already name the subject
+        if len(set(tokenize(query)) & self._centroids[best_use_case].keys()) < INTENT_ROUTER_MIN_MATCHED_TERMS:
+            return None
+
+        get_extra_data = use_case == "DOC_SEARCH" and len(words & EXTRA_DATA_TERMS) >= 2
+        return RouteDecision(query, best_use_case, get_extra_data, best_score, margin)
+
+class IntentRouter:
+    """
+    Local TF-IDF router for the use case of a RAG query, one IntentModel per gpt (the INTENT_ROUTER_MAX_GPTS most recently used).
+    Examples come from USE_CASE_CONFIG, the gpt's use cases and the gpt's logged decisions of the function calling model.
+    Models are built in the background; until a gpt's model matches its current use cases, its queries go to the model.
+    A query is routed locally only when the nearest use case is the gpt's own use case, with enough score and margin.
+    """
+
+    def __init__(self):
+        self._logged: dict[str, list[tuple[str, str]]] = {}
+        self._models: OrderedDict = OrderedDict()
+        self._building: dict[str, asyncio.Task] = {}
+        self._stats = {"routed": 0, "fallbacks": 0, "route_time_us_total": 0.0, "builds": 0, "evictions": 0}
+
+    def load_tool_call_log(self, path: str = INTENT_ROUTER_TOOL_CALL_LOG) -> int:
+        """Learn from the decisions previously made by the function calling model (the rotated log first)."""
+        count = 0
+        for log_path in (f"{path}.1", path):
+            if not os.path.exists(log_path):
+                continue
+            with open(log_path, "r", encoding="utf-8") as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                        if record["use_case"] and record["query"]:
+                            self._logged.setdefault(str(record["gpt_id"]), []).append((record["use_case"], record["query"]))
+                            count += 1
+                    except (ValueError, KeyError):
+                        continue
+        logger.info(f"Intent router learned {count} logged tool call(s) from {path}")
+        return count
+
+    def build_model(self, gpt_id: str, usecases: list) -> IntentModel:
+        model = IntentModel()
+        model.add_usecases(usecases)
+        names = {usecase.get("name") for usecase in usecases or []}
+        for use_case, query in self._logged.get(str(gpt_id), []):
+            if use_case in names:
+                model.add_example(use_case, query)
+        return model.build()
+
+    def _signature(self, usecases: list) -> tuple:
+        return tuple(sorted((str(usecase.get("_id")), usecase.get("name"), usecase.get("description")) for usecase in usecases or []))
+
+    def _schedule_build(self, gpt_id: str, usecases: list, signature: tuple):
+        if gpt_id in self._building:
+            return
+        task = asyncio.create_task(self._build(gpt_id, usecases, signature))
+        self._building[gpt_id] = task
+        task.add_done_callback(lambda _: self._building.pop(gpt_id, None))
+
+    async def _build(self, gpt_id: str, usecases: list, signature: tuple):
+        try:
+            model = await run_blocking(self.build_model, gpt_id, usecases)
+        except Exception as e:
+            logger.warning(f"Intent router could not build the model of {gpt_id}: {e}")
+            return
+        self._models[gpt_id] = (signature, model)
+        self._models.move_to_end(gpt_id)
+        self._stats["builds"] += 1
+        while len(self._models) > INTENT_ROUTER_MAX_GPTS:
+            self._models.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def route(self, query: str, use_case: str, usecases: list = None, image_response: str = "", gpt_id: str = None) -> RouteDecision:
+        """Return the search arguments when the router is confident, None to fall back to the function calling model."""
+        if not INTENT_ROUTER_ENABLED or not usecases:
+            return None
+
+        started = time.perf_counter()
+        decision = None
+        try:
+            gpt_id = str(gpt_id)
+            signature = self._signature(usecases)
+            entry = self._models.get(gpt_id)
+            if entry is None or entry[0] != signature:
+                self._schedule_build(gpt_id, usecases, signature)
+                return None
+            self._models.move_to_end(gpt_id)
+
+            decision = entry[1].decide(query, use_case, image_response)
+            return decision
+        finally:
+            self._stats["routed" if decision is not None else "fallbacks"] += 1
+            self._stats["route_time_us_total"] += (time.perf_counter() - started) * 1_000_000
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        decisions = stats["routed"] + stats["fallbacks"]
+        stats["enabled"] = INTENT_ROUTER_ENABLED
+        stats["routed_ratio"] = round(stats["routed"] / decisions, 3) if decisions else 0.0
+        stats["route_time_us_avg"] = round(stats["route_time_us_total"] / decisions, 1) if decisions else 0.0
+        stats["gpts"] = len(self._models)
+        stats["building"] = len(self._building)
+        return stats
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in re.findall(r"[a-z0-9]+", (text or "").lower()) if token not in STOP_WORDS and len(token) > 1]
+
+async def log_tool_call(query: str, current_use_case: str, function_args: dict, gpt_id: str):
+    """Append a decision of the function calling model to the tool call log (training and evaluation data for the router)."""
+    if not INTENT_ROUTER_TOOL_CALL_LOG_ENABLED:
+        return
+
+    record = {
+        "query": query,
+        "current_use_case": current_use_case,
+        "use_case": function_args.get("use_case"),
+        "search_query": function_args.get("search_query"),
+        "get_extra_data": bool(function_args.get("get_extra_data")),
+        "gpt_id": gpt_id,
+        "logged_at": time.time(),
+    }
+    try:
+        await run_blocking(_append_line, INTENT_ROUTER_TOOL_CALL_LOG, json.dumps(record))
+    except Exception as e:
+        logger.warning(f"Could not write the tool call log: {e}")
+
+def _append_line(path: str, line: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path) and os.path.getsize(path) >= INTENT_ROUTER_TOOL_CALL_LOG_MAX_BYTES:
+        os.replace(path, f"{path}.1")
+    with open(path, "a", encoding="utf-8") as log_file:
+        log_file.write(line + "\n")
+
+# Process wide router, one model per gpt trained on its use cases and the tool call log
+intent_router = IntentRouter()
+if INTENT_ROUTER_ENABLED:
+    try:
+        intent_router.load_tool_call_log()
+    except Exception as e:
+        logger.warning(f"Intent router could not load the tool call log: {e}")
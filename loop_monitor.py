@@ -0,0 +1,72 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_INTERVAL_SECONDS = float(os.getenv("LOOP_MONITOR_INTERVAL_SECONDS", 0.1))
+LOOP_MONITOR_STALL_THRESHOLD_MS = float(os.getenv("LOOP_MONITOR_STALL_THRESHOLD_MS", 100))
+LOOP_MONITOR_WINDOW = int(os.getenv("LOOP_MONITOR_WINDOW", 600))
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how late a periodic sleep wakes up compared to when it was scheduled.
+    Any blocking call on the loop shows up directly as lag for every concurrent request.
+    """
+
+    _task: asyncio.Task = None
+    _samples = deque(maxlen=LOOP_MONITOR_WINDOW)
+    _stats = {"samples": 0, "stalls": 0, "max_lag_ms": 0.0}
+
+    @classmethod
+    def start(cls):
+        if cls._task is None or cls._task.done():
+            cls._task = asyncio.create_task(cls._run())
+            logger.info(f"Event loop lag monitor started (interval {LOOP_MONITOR_INTERVAL_SECONDS}s)")
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            try:
+                await cls._task
+            except asyncio.CancelledError:
+                pass
+            cls._task = None
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            scheduled = time.monotonic() + LOOP_MONITOR_INTERVAL_SECONDS
+            await asyncio.sleep(LOOP_MONITOR_INTERVAL_SECONDS)
+            lag_ms = max(0.0, (time.monotonic() - scheduled) * 1000)
+            cls._record(lag_ms)
+
+    @classmethod
+    def _record(cls, lag_ms: float):
+        cls._samples.append(lag_ms)
+        cls._stats["samples"] += 1
+        cls._stats["max_lag_ms"] = max(cls._stats["max_lag_ms"], lag_ms)
+        if lag_ms >= LOOP_MONITOR_STALL_THRESHOLD_MS:
+            cls._stats["stalls"] += 1
+            logger.warning(f"Event loop stalled for {lag_ms:.0f} ms")
+
+    @classmethod
+    def stats(cls) -> dict:
+        ordered = sorted(cls._samples)
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2) if ordered else 0.0
+
+        stats = dict(cls._stats)
+        stats["max_lag_ms"] = round(stats["max_lag_ms"], 2)
+        stats["running"] = cls._task is not None and not cls._task.done()
+        stats["window_p50_lag_ms"] = percentile(50)
+        stats["window_p99_lag_ms"] = percentile(99)
+        stats["window_max_lag_ms"] = round(ordered[-1], 2) if ordered else 0.0
+        return stats
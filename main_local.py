@@ -30,6 +30,17 @@ from azure_openai_utils import call_maf
 from routes.ilama32_routes import router as ilama32_router
 from routes.gpt_routes_secured import router as gpt_router_secured
 from routes.gpt_routes_unsecured import router as gpt_router_unsecured
+from routes.metrics_routes import router as metrics_router
+from dependencies import NiaAzureOpenAIClient
+from search_cache import SearchClientPool
+from loop_monitor import LoopLagMonitor
+from mongo_client import mongo_db_instance
+from mongo_indexes import bootstrap_indexes
+from message_writer import message_writer
+from message_archiver import message_archiver
+from entity_cache import entity_cache
+from conversation_summarizer import conversation_summarizer
+from blocking_io import shutdown_blocking_executor
 from auth_config import azure_scheme
 
 from standalone_programs.simple_gpt import get_conversation
@@ -130,6 +141,7 @@ app = FastAPI(
 app.include_router(ilama32_router, prefix="/ilama32", tags=["ilama32"])
 app.include_router(gpt_router_secured, dependencies=[Security(azure_scheme, scopes=["access_as_user"])])
 app.include_router(gpt_router_unsecured, prefix="/backend", tags=["backend"])
+app.include_router(metrics_router, prefix="/metrics", tags=["metrics"], dependencies=[Security(azure_scheme, scopes=["access_as_user"])])
 #app.include_router(gpt_router, dependencies=[Security(verify_jwt_token, scopes=["access_as_user"])])
 
 # Set up Jinja2 for templating
@@ -158,11 +170,50 @@ async def startup_event():
 
  msal_app.token_cache = cache
 
+ # Warm up the Azure OpenAI endpoint pool and start its background health probes
+ try:
+     await NiaAzureOpenAIClient.create()
+ except Exception as e:
+     logger.error(f"Azure OpenAI endpoint pool could not be initialized at startup: {e}", exc_info=True)
+
+ # Measure event loop lag so blocking calls on the request path are visible
+ LoopLagMonitor.start()
+
+ # Create the MongoDB connection pool and open a first connection before the first request
+ try:
+     await mongo_db_instance.connect()
+ except Exception as e:
+     logger.error(f"MongoDB connection could not be warmed up at startup: {e}", exc_info=True)
+
+ # Build the MongoDB indexes and verify the hot queries do not fall back to COLLSCAN
+ try:
+     await bootstrap_indexes()
+ except Exception as e:
+     logger.error(f"MongoDB index bootstrap failed: {e}", exc_info=True)
+
+ # Move soft-deleted messages past their retention period out of the hot collections
+ message_archiver.start()
+
+ # Keep the gpt / usecase cache coherent with the other workers (ENTITY_CACHE_CHANGE_STREAMS)
+ entity_cache.start_change_stream()
+
 @app.on_event("shutdown")
 async def shutdown_event():
  with open("token_cache.bin", "wb") as f:
      pickle.dump(msal_app.token_cache, f)
 
+ # Write the chat messages still queued in the write-behind buffer
+ await message_writer.stop()
+
+ await NiaAzureOpenAIClient.shutdown()
+ await SearchClientPool.close()
+ await LoopLagMonitor.stop()
+ await message_archiver.stop()
+ await entity_cache.stop_change_stream()
+ await conversation_summarizer.stop()
+ mongo_db_instance.close() # After the writer flushed its queue
+ shutdown_blocking_executor()
+
 @app.middleware("http")
 async def auth_middleware(request: Request, call_next):
     # Now process the request with the added header
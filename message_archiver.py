@@ -0,0 +1,158 @@
+import os
+import gzip
+import time
+import asyncio
+import logging
+import datetime as date
+import bson
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+
+from mongo_client import get_mongo_db
+from blocking_io import run_blocking
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+MESSAGE_ARCHIVER_ENABLED = os.getenv("MESSAGE_ARCHIVER_ENABLED", "false").lower() == "true"
+# Hidden (soft-deleted) messages are kept in place for this many days before they are archived
+MESSAGE_ARCHIVE_RETENTION_DAYS = float(os.getenv("MESSAGE_ARCHIVE_RETENTION_DAYS", 30))
+# collection: move to messages_archive / message_buckets_archive, jsonl: gzip compressed JSONL files in MESSAGE_ARCHIVE_DIR
+MESSAGE_ARCHIVE_TARGET = os.getenv("MESSAGE_ARCHIVE_TARGET", "collection").lower()
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "archive")
+MESSAGE_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("MESSAGE_ARCHIVE_INTERVAL_SECONDS", 3600))
+MESSAGE_ARCHIVE_BATCH_SIZE = int(os.getenv("MESSAGE_ARCHIVE_BATCH_SIZE", 500))
+# Upper bound of the archiving throughput, so the foreground queries keep the cluster
+MESSAGE_ARCHIVE_MAX_DOCS_PER_SECOND = float(os.getenv("MESSAGE_ARCHIVE_MAX_DOCS_PER_SECOND", 1000))
+
+DUPLICATE_KEY_ERROR = 11000
+
+class MessageArchiver:
+    """
+    Background job moving hidden messages (and fully hidden conversation buckets) out of the hot collections
+    once their retention period is over. Every batch is copied to the archive first and deleted afterwards,
+    so an interrupted run is simply resumed by the next one.
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task = None
+        self._running = asyncio.Lock()
+        self._stats = {"runs": 0, "archived_messages": 0, "archived_buckets": 0, "bytes_reclaimed": 0, "batches": 0,
+                       "errors": 0, "last_run_at": None, "last_run_seconds": None}
+
+    def start(self):
+        if not MESSAGE_ARCHIVER_ENABLED:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Message archiver started (retention {MESSAGE_ARCHIVE_RETENTION_DAYS} days, target {MESSAGE_ARCHIVE_TARGET})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"Message archiver run failed: {e}", exc_info=True)
+            await asyncio.sleep(MESSAGE_ARCHIVE_INTERVAL_SECONDS)
+
+    async def run_once(self) -> dict:
+        """Archive everything past the retention period. Concurrent calls wait for the running one."""
+        async with self._running:
+            started = time.monotonic()
+            cutoff = date.datetime.now(date.timezone.utc) - date.timedelta(days=MESSAGE_ARCHIVE_RETENTION_DAYS)
+
+            # System messages are the gpt's configuration, they are never archived.
+            # Messages hidden before hidden_at existed are aged on their creation time.
+            archived_messages = await self._archive_collection("messages", {
+                "hiddenFlag": True,
+                "role": {"$ne": "system"},
+                "$or": [{"hidden_at": {"$lt": cutoff}}, {"hidden_at": {"$exists": False}, "_id": {"$lt": ObjectId.from_datetime(cutoff)}}],
+            })
+            archived_buckets = await self._archive_collection("message_buckets", {
+                "all_hidden": True,
+                "$or": [{"hidden_at": {"$lt": cutoff}}, {"hidden_at": {"$exists": False}, "last_at": {"$lt": cutoff}}],
+            })
+
+            self._stats["runs"] += 1
+            self._stats["last_run_at"] = date.datetime.now(date.timezone.utc).isoformat()
+            self._stats["last_run_seconds"] = round(time.monotonic() - started, 2)
+            logger.info(f"Message archiver run completed: {archived_messages} message(s) and {archived_buckets} bucket(s) archived")
+            return self.stats()
+
+    async def _archive_collection(self, collection_name: str, query: dict) -> int:
+        db = await get_mongo_db()
+        collection = db[collection_name]
+        archived = 0
+
+        while True:
+            batch_started = time.monotonic()
+            documents = await collection.find(query).limit(MESSAGE_ARCHIVE_BATCH_SIZE).to_list(None)
+            if not documents:
+                break
+
+            # Step 1: Copy the batch to the archive
+            await self._write_archive(db, collection_name, documents)
+
+            # Step 2: Delete the originals. The query is repeated, so documents changed in the meantime stay in place.
+            ids = [document["_id"] for document in documents]
+            result = await collection.delete_many(dict(query, _id={"$in": ids}))
+
+            archived += result.deleted_count
+            self._stats["archived_buckets" if collection_name == "message_buckets" else "archived_messages"] += result.deleted_count
+            self._stats["bytes_reclaimed"] += sum(len(bson.encode(document)) for document in documents)
+            self._stats["batches"] += 1
+
+            # Step 3: Rate limit - never exceed MESSAGE_ARCHIVE_MAX_DOCS_PER_SECOND
+            minimum_duration = len(documents) / MESSAGE_ARCHIVE_MAX_DOCS_PER_SECOND
+            await asyncio.sleep(max(0.0, minimum_duration - (time.monotonic() - batch_started)))
+
+            if len(documents) < MESSAGE_ARCHIVE_BATCH_SIZE:
+                break
+
+        return archived
+
+    async def _write_archive(self, db, collection_name: str, documents: list[dict]):
+        archived_at = date.datetime.now(date.timezone.utc)
+
+        if MESSAGE_ARCHIVE_TARGET == "jsonl":
+            lines = "".join(json_util.dumps(dict(document, archived_at=archived_at)) + "\n" for document in documents)
+            path = os.path.join(MESSAGE_ARCHIVE_DIR, f"{collection_name}-{archived_at:%Y%m%d}.jsonl.gz")
+            await run_blocking(_append_compressed, path, lines)
+            return
+
+        try:
+            await db[f"{collection_name}_archive"].insert_many([dict(document, archived_at=archived_at) for document in documents], ordered=False)
+        except BulkWriteError as e:
+            # Already archived by an interrupted run
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["enabled"] = MESSAGE_ARCHIVER_ENABLED
+        stats["target"] = MESSAGE_ARCHIVE_TARGET
+        stats["retention_days"] = MESSAGE_ARCHIVE_RETENTION_DAYS
+        stats["mb_reclaimed"] = round(stats["bytes_reclaimed"] / (1024 * 1024), 2)
+        return stats
+
+def _append_compressed(path: str, lines: str):
+    # Appending creates a new gzip member per batch, which gzip readers concatenate transparently
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with gzip.open(path, "at", encoding="utf-8") as archive_file:
+        archive_file.write(lines)
+
+# Process wide archiver, started by the FastAPI startup event when MESSAGE_ARCHIVER_ENABLED
+message_archiver = MessageArchiver()
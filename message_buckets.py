@@ -0,0 +1,189 @@
+import os
+import logging
+import heapq
+import datetime as date
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.results import UpdateResult
+from dotenv import load_dotenv
+
+from mongo_client import get_mongo_db
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Bucketed conversations: one document per (gpt_id, use_case_id, window of MESSAGE_BUCKET_SIZE messages), appended with $push
+MESSAGE_BUCKETS_ENABLED = os.getenv("MESSAGE_BUCKETS_ENABLED", "false").lower() == "true"
+MESSAGE_BUCKET_SIZE = int(os.getenv("MESSAGE_BUCKET_SIZE", 50))
+
+async def get_buckets_collection():
+    db = await get_mongo_db()
+    return db["message_buckets"]
+
+async def append_message(message: dict) -> ObjectId:
+    """
+    Append a message to the open bucket of its (gpt_id, use_case_id), opening a new bucket when the last one is full.
+    The message gets its own id, so callers can reference it like a messages document.
+    """
+    buckets_collection = await get_buckets_collection()
+    message_id, operation = build_append_operation(message)
+    await buckets_collection.bulk_write([operation])
+    return message_id
+
+def build_append_operation(message: dict) -> tuple[ObjectId, UpdateOne]:
+    """The upserted $push of append_message, as a bulk_write operation (used by the batched message writer)."""
+    message_id = message.get("_id") or ObjectId()
+    created_at = message.get("created_at") or date.datetime.now(date.timezone.utc)
+
+    entry = {
+        "message_id": message_id,
+        "gpt_name": message.get("gpt_name"),
+        "role": message["role"],
+        "content": message["content"],
+        "token_count": message.get("token_count"),
+        "created_at": created_at,
+        "hiddenFlag": message.get("hiddenFlag", False),
+        "user": message.get("user"),
+    }
+
+    operation = UpdateOne(
+        # Hidden buckets are closed, new messages open a new bucket
+        {"gpt_id": ObjectId(message["gpt_id"]), "use_case_id": message.get("use_case_id"), "count": {"$lt": MESSAGE_BUCKET_SIZE}, "all_hidden": {"$ne": True}},
+        {
+            "$push": {"messages": entry},
+            "$inc": {"count": 1},
+            "$max": {"last_at": created_at},
+            "$min": {"first_at": created_at},
+            "$set": {"all_hidden": False},
+        },
+        upsert=True
+    )
+    return message_id, operation
+
+async def _read_buckets(query: dict, limit: int, message_filter=None, oldest_first: bool = False) -> list[dict]:
+    """
+    Visible messages of the matching buckets as messages-collection style documents, newest first (oldest first with oldest_first).
+    With a limit, buckets are read in that order and reading stops as soon as the remaining buckets cannot hold any of the selected messages.
+    """
+    buckets_collection = await get_buckets_collection()
+    query = dict(query, all_hidden={"$ne": True})
+    cursor = buckets_collection.find(query).sort("first_at" if oldest_first else "last_at", ASCENDING if oldest_first else DESCENDING)
+
+    messages = []
+    async for bucket in cursor:
+        if limit > 0 and len(messages) >= limit:
+            messages.sort(key=page_key, reverse=not oldest_first)
+            boundary = _sort_key(messages[limit - 1]["created_at"])
+            if (_sort_key(bucket.get("first_at")) > boundary) if oldest_first else (_sort_key(bucket.get("last_at")) < boundary):
+                break
+
+        for entry in bucket.get("messages", []):
+            if entry.get("hiddenFlag"):
+                continue
+            message = _to_message(bucket, entry)
+            if message_filter is None or message_filter(message):
+                messages.append(message)
+
+    messages.sort(key=page_key, reverse=not oldest_first)
+    return messages[:limit] if limit > 0 else messages
+
+async def read_page(gpt_id: str, use_case_id: str = None, cursor: tuple = None, older: bool = True, limit: int = 20) -> list[dict]:
+    """
+    Keyset page of bucketed messages next to cursor (created_at, _id): older ones newest first, or newer ones oldest first.
+    Only buckets that overlap the page are read.
+    """
+    query = {"gpt_id": ObjectId(gpt_id)}
+    if use_case_id is not None:
+        query["use_case_id"] = use_case_id
+
+    message_filter = None
+    if cursor is not None:
+        cursor_key = (_sort_key(cursor[0]), cursor[1])
+        if isinstance(cursor[0], date.datetime):
+            query["first_at" if older else "last_at"] = {"$lte": cursor[0]} if older else {"$gte": cursor[0]}
+        message_filter = (lambda message: page_key(message) < cursor_key) if older else (lambda message: page_key(message) > cursor_key)
+
+    return await _read_buckets(query, limit, message_filter, oldest_first=not older)
+
+async def iter_messages(gpt_id: str, use_case_id: str = None):
+    """
+    All visible bucketed messages of a gpt, oldest first, without loading them all: buckets are read by first_at
+    and a message is released once no later bucket can hold an older one.
+    """
+    buckets_collection = await get_buckets_collection()
+    query = {"gpt_id": ObjectId(gpt_id), "all_hidden": {"$ne": True}}
+    if use_case_id is not None:
+        query["use_case_id"] = use_case_id
+
+    pending = []
+    async for bucket in buckets_collection.find(query).sort("first_at", ASCENDING):
+        bucket_start = _sort_key(bucket.get("first_at"))
+        while pending and pending[0][0][0] < bucket_start:
+            yield heapq.heappop(pending)[1]
+
+        for entry in bucket.get("messages", []):
+            if not entry.get("hiddenFlag"):
+                message = _to_message(bucket, entry)
+                heapq.heappush(pending, (page_key(message), message))
+
+    while pending:
+        yield heapq.heappop(pending)[1]
+
+async def read_gpt_messages(gpt_id: str, limit: int) -> list[dict]:
+    return await _read_buckets({"gpt_id": ObjectId(gpt_id)}, limit)
+
+async def read_use_case_messages(gpt_id: str, use_case_id: str, limit: int) -> list[dict]:
+    return await _read_buckets({"gpt_id": ObjectId(gpt_id), "use_case_id": use_case_id}, limit)
+
+async def hide_messages(gpt_id: str = None, gpt_ids: list = None) -> UpdateResult:
+    """Set hiddenFlag on every bucketed message of a gpt, of a list of gpts, or of all gpts."""
+    buckets_collection = await get_buckets_collection()
+    if gpt_ids is not None:
+        query = {"gpt_id": {"$in": [ObjectId(id) for id in gpt_ids]}}
+    else:
+        query = {"gpt_id": ObjectId(gpt_id)} if gpt_id is not None else {}
+    query["all_hidden"] = {"$ne": True}
+    return await buckets_collection.update_many(
+        query,
+        {"$set": {"messages.$[].hiddenFlag": True, "all_hidden": True, "hidden_at": date.datetime.now(date.timezone.utc)}}
+    )
+
+def merge_histories(legacy: list[dict], bucketed: list[dict], limit: int, descending: bool) -> list[dict]:
+    """Compatibility reader: combine legacy messages documents with bucketed messages, dropping messages present in both."""
+    seen = set()
+    merged = []
+    for message in bucketed + legacy:
+        if message["_id"] in seen:
+            continue
+        seen.add(message["_id"])
+        merged.append(message)
+
+    merged.sort(key=lambda message: _sort_key(message.get("created_at")), reverse=descending)
+    return merged[:limit] if limit > 0 else merged
+
+def _to_message(bucket: dict, entry: dict) -> dict:
+    """A bucket entry as a messages-collection style document."""
+    return {
+        "_id": entry["message_id"],
+        "gpt_id": bucket["gpt_id"],
+        "gpt_name": entry.get("gpt_name"),
+        "role": entry["role"],
+        "content": entry["content"],
+        "token_count": entry.get("token_count"),
+        "created_at": entry["created_at"],
+        "hiddenFlag": False,
+        "user": entry.get("user"),
+        "use_case_id": bucket.get("use_case_id"),
+    }
+
+def page_key(message: dict) -> tuple:
+    """Keyset order of messages: (created_at, _id), with created_at ordered like BSON does."""
+    return (_sort_key(message.get("created_at")), message["_id"])
+
+def _sort_key(created_at) -> tuple:
+    """Order like BSON does: legacy ISO strings before native dates, then by value."""
+    if isinstance(created_at, date.datetime):
+        return (1, created_at.replace(tzinfo=None) if created_at.tzinfo is None else created_at.astimezone(date.timezone.utc).replace(tzinfo=None), "")
+    return (0, date.datetime.min, str(created_at or ""))
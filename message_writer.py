@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+import logging
+from bson import ObjectId
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+
+from mongo_client import get_mongo_db
+import message_buckets
+from message_buckets import MESSAGE_BUCKETS_ENABLED
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Durability of chat message writes:
+#   sync         - one bulk write per message, awaited by the request (previous behaviour)
+#   batched      - coalesced into bulk writes, the request waits for its batch to be acknowledged
+#   write_behind - coalesced into bulk writes, the request only waits for the message to be queued.
+#                  Failed batches are retried until they are written; queued messages are lost if the process dies.
+MESSAGE_WRITE_DURABILITY = os.getenv("MESSAGE_WRITE_DURABILITY", "batched").lower()
+MESSAGE_WRITER_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_WRITER_FLUSH_INTERVAL_MS", 5))
+MESSAGE_WRITER_MAX_BATCH_SIZE = int(os.getenv("MESSAGE_WRITER_MAX_BATCH_SIZE", 500))
+MESSAGE_WRITER_MAX_QUEUE_SIZE = int(os.getenv("MESSAGE_WRITER_MAX_QUEUE_SIZE", 10000))
+# Retries of a failed batch before the waiting requests get the error (batched, sync and shutdown). write_behind retries until written.
+MESSAGE_WRITER_MAX_RETRIES = int(os.getenv("MESSAGE_WRITER_MAX_RETRIES", 5))
+MESSAGE_WRITER_RETRY_BACKOFF_MS = float(os.getenv("MESSAGE_WRITER_RETRY_BACKOFF_MS", 100))
+MESSAGE_WRITER_MAX_BACKOFF_MS = float(os.getenv("MESSAGE_WRITER_MAX_BACKOFF_MS", 5000))
+
+DUPLICATE_KEY_ERROR = 11000
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages. Messages get their _id and created_at when queued, so callers can use
+    the id right away, and a background task writes whatever accumulated every few milliseconds as one bulk write.
+    The queue is bounded: when it is full, callers wait for room instead of growing memory.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+        self._stopping = False
+        self._stats = {"queued": 0, "written": 0, "failed": 0, "retries": 0, "lost": 0, "batches": 0, "largest_batch": 0, "flush_time_ms_total": 0.0}
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=MESSAGE_WRITER_MAX_QUEUE_SIZE)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Message writer started ({MESSAGE_WRITE_DURABILITY}, flush every {MESSAGE_WRITER_FLUSH_INTERVAL_MS} ms)")
+
+    async def write(self, document: dict) -> ObjectId:
+        """Persist a messages document according to MESSAGE_WRITE_DURABILITY and return its id."""
+        document.setdefault("_id", ObjectId())
+
+        if MESSAGE_WRITE_DURABILITY == "sync":
+            await self._write_with_retries([document], MESSAGE_WRITER_MAX_RETRIES)
+            return document["_id"]
+
+        self._ensure_started()
+        acknowledged = asyncio.get_running_loop().create_future() if MESSAGE_WRITE_DURABILITY == "batched" else None
+        await self._queue.put((document, acknowledged))
+        self._stats["queued"] += 1
+
+        if acknowledged is not None:
+            await acknowledged
+        return document["_id"]
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            # Coalesce whatever arrives within the flush interval, up to the batch size
+            deadline = time.monotonic() + MESSAGE_WRITER_FLUSH_INTERVAL_MS / 1000
+            while len(batch) < MESSAGE_WRITER_MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Nobody waits for write_behind messages, so their batch is retried until it is written
+            await self._flush(batch, max_retries=None if MESSAGE_WRITE_DURABILITY == "write_behind" else MESSAGE_WRITER_MAX_RETRIES)
+
+    async def _flush(self, batch: list, max_retries: int = MESSAGE_WRITER_MAX_RETRIES):
+        error = None
+        try:
+            await self._write_with_retries([document for document, _ in batch], max_retries)
+        except Exception as e:
+            error = e
+        finally:
+            for _, acknowledged in batch:
+                if acknowledged is not None and not acknowledged.done():
+                    if error is None:
+                        acknowledged.set_result(None)
+                    else:
+                        acknowledged.set_exception(error)
+                self._queue.task_done()
+
+    async def _write_with_retries(self, documents: list[dict], max_retries: int = None):
+        """Write documents, retrying what was not written with exponential backoff (max_retries None: until written)."""
+        attempt = 0
+        while True:
+            try:
+                if attempt > 0 and MESSAGE_BUCKETS_ENABLED:
+                    # An interrupted ordered bulk write may have applied some appends, they must not be pushed twice
+                    documents = await self._not_bucketed(documents)
+                    if not documents:
+                        return
+                documents = await self._write_batch(documents)
+                if not documents:
+                    return
+                error = RuntimeError(f"{len(documents)} message(s) were not written")
+            except Exception as e:
+                error = e
+
+            # Unbounded retries stop being unbounded at shutdown, so a database outage cannot hang it
+            limit = MESSAGE_WRITER_MAX_RETRIES if self._stopping else max_retries
+            if limit is not None and attempt >= limit:
+                self._stats["lost"] += len(documents)
+                logger.error(f"Message writer gave up on {len(documents)} message(s) after {attempt + 1} attempt(s): "
+                             f"{[str(document['_id']) for document in documents]}: {error}", exc_info=error)
+                raise error
+
+            backoff_ms = min(MESSAGE_WRITER_RETRY_BACKOFF_MS * 2 ** attempt, MESSAGE_WRITER_MAX_BACKOFF_MS)
+            logger.warning(f"Message writer could not persist {len(documents)} message(s), retrying in {backoff_ms:.0f} ms: {error}")
+            self._stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(backoff_ms / 1000)
+
+    async def _not_bucketed(self, documents: list[dict]) -> list[dict]:
+        """The documents whose message is not in a conversation bucket yet."""
+        db = await get_mongo_db()
+        ids = [document["_id"] for document in documents]
+        gpt_ids = list({ObjectId(document["gpt_id"]) for document in documents})
+        written = set()
+        async for bucket in db["message_buckets"].find({"gpt_id": {"$in": gpt_ids}, "messages.message_id": {"$in": ids}}, {"messages.message_id": 1}):
+            written.update(entry["message_id"] for entry in bucket["messages"])
+        return [document for document in documents if document["_id"] not in written]
+
+    async def _write_batch(self, documents: list[dict]) -> list[dict]:
+        """One bulk write. Returns the documents that were not written (empty when all were)."""
+        started = time.perf_counter()
+        db = await get_mongo_db()
+
+        try:
+            if MESSAGE_BUCKETS_ENABLED:
+                # Ordered, so appends to the same bucket respect its size limit
+                operations = [message_buckets.build_append_operation(document)[1] for document in documents]
+                await db["message_buckets"].bulk_write(operations, ordered=True)
+            else:
+                await db["messages"].bulk_write([InsertOne(document) for document in documents], ordered=False)
+            self._stats["written"] += len(documents)
+            return []
+        except BulkWriteError as e:
+            if MESSAGE_BUCKETS_ENABLED:
+                # Ordered: every append before the first error was applied (one upsert or one modified bucket each), none after it ran
+                written = e.details.get("nUpserted", 0) + e.details.get("nModified", 0)
+                pending = documents[written:]
+            else:
+                # Unordered: messages already written by a previous attempt (duplicate _id) are not failures
+                failed_indexes = sorted({error["index"] for error in e.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY_ERROR})
+                pending = [documents[index] for index in failed_indexes]
+            self._stats["written"] += len(documents) - len(pending)
+            self._stats["failed"] += len(pending)
+            return pending
+        except Exception:
+            self._stats["failed"] += len(documents)
+            raise
+        finally:
+            self._stats["batches"] += 1
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(documents))
+            self._stats["flush_time_ms_total"] += (time.perf_counter() - started) * 1000
+
+    async def flush(self):
+        """Wait until every queued message has been written."""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            await self._queue.join()
+
+    async def stop(self):
+        """Shutdown hook: flush the queue, then stop the background task."""
+        if self._queue is None:
+            return
+
+        self._stopping = True
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Messages left behind by a crashed writer task are written inline
+        leftovers = []
+        while not self._queue.empty():
+            leftovers.append(self._queue.get_nowait())
+        if leftovers:
+            await self._flush(leftovers)
+        logger.info(f"Message writer stopped: {self.stats()}")
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["durability"] = MESSAGE_WRITE_DURABILITY
+        stats["pending"] = self._queue.qsize() if self._queue is not None else 0
+        stats["avg_batch_size"] = round(stats["written"] / stats["batches"], 1) if stats["batches"] else 0.0
+        stats["flush_time_ms_avg"] = round(stats["flush_time_ms_total"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+# Process wide writer, flushed by the FastAPI shutdown event
+message_writer = MessageWriter()
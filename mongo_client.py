@@ -1,32 +1,146 @@
 import os
+import time
 import logging
+import threading
+from collections import deque
+from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 from pymongo.server_api import ServerApi
 
+load_dotenv()
+
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "chatbot_db"
 logger = logging.getLogger(__name__)
 
+# Pool sizing is per process: every uvicorn worker opens up to MONGO_MAX_POOL_SIZE connections
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 10))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 5))
+MONGO_MAX_IDLE_TIME_MS = os.getenv("MONGO_MAX_IDLE_TIME_MS")
+MONGO_WAIT_QUEUE_TIMEOUT_MS = os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS")
+MONGO_CONNECT_TIMEOUT_MS = os.getenv("MONGO_CONNECT_TIMEOUT_MS")
+MONGO_SOCKET_TIMEOUT_MS = os.getenv("MONGO_SOCKET_TIMEOUT_MS")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS")
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE") # e.g. primary, primaryPreferred, secondaryPreferred
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN") # e.g. 1, majority
+MONGO_WRITE_CONCERN_JOURNAL = os.getenv("MONGO_WRITE_CONCERN_JOURNAL") # true / false
+MONGO_POOL_METRICS_WINDOW = int(os.getenv("MONGO_POOL_METRICS_WINDOW", 1000))
+UVICORN_WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+
+def _client_options() -> dict:
+    """Keyword arguments of the Motor client. Unset options keep the driver defaults."""
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "readPreference": MONGO_READ_PREFERENCE,
+        "w": int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN and MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN,
+        "journal": MONGO_WRITE_CONCERN_JOURNAL.lower() == "true" if MONGO_WRITE_CONCERN_JOURNAL else None,
+    }
+    for name in ("maxIdleTimeMS", "waitQueueTimeoutMS", "connectTimeoutMS", "socketTimeoutMS", "serverSelectionTimeoutMS"):
+        if options[name] is not None:
+            options[name] = int(options[name])
+    return {name: value for name, value in options.items() if value is not None}
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Connection pool events of the driver turned into metrics: connections in use and how long
+    operations waited to check out a connection. Events are published from the driver's threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._wait_ms = deque(maxlen=MONGO_POOL_METRICS_WINDOW)
+        self._stats = {"connections_open": 0, "connections_in_use": 0, "max_in_use": 0, "connections_created": 0,
+                       "connections_closed": 0, "checkouts": 0, "checkout_failures": 0, "pool_clears": 0}
+
+    def pool_created(self, event):
+        logger.info(f"MongoDB connection pool created for {event.address}. Options: {event.options}")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._stats["pool_clears"] += 1
+        logger.warning(f"MongoDB connection pool cleared for {event.address}")
+
+    def pool_closed(self, event):
+        logger.info(f"MongoDB connection pool closed for {event.address}")
+
+    def connection_created(self, event):
+        with self._lock:
+            self._stats["connections_created"] += 1
+            self._stats["connections_open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._stats["connections_closed"] += 1
+            self._stats["connections_open"] = max(0, self._stats["connections_open"] - 1)
+
+    def connection_check_out_started(self, event):
+        # Started and checked out events of one checkout are published on the same thread
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._stats["checkout_failures"] += 1
+        logger.warning(f"MongoDB connection checkout failed for {event.address}: {event.reason}")
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["connections_in_use"] += 1
+            self._stats["max_in_use"] = max(self._stats["max_in_use"], self._stats["connections_in_use"])
+            if started is not None:
+                self._wait_ms.append((time.perf_counter() - started) * 1000)
+        self._local.started = None
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._stats["connections_in_use"] = max(0, self._stats["connections_in_use"] - 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            waits = sorted(self._wait_ms)
+        stats["checkout_wait_ms_avg"] = round(sum(waits) / len(waits), 3) if waits else 0.0
+        stats["checkout_wait_ms_p95"] = round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else 0.0
+        stats["checkout_wait_ms_max"] = round(waits[-1], 3) if waits else 0.0
+        return stats
+
 # MongoDB Connection Pooling Class (Improved)
 class MongoDB:
-    def __init__(self, uri: str, db_name: str, maxPoolSize=10, minPoolSize=5):
+    def __init__(self, uri: str, db_name: str, maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE):
         self.uri = uri
         self.db_name = db_name
         self.maxPoolSize = maxPoolSize
         self.minPoolSize = minPoolSize
         self._client = None  # Use a private attribute for the client
         self.db = None
+        self.pool_metrics = PoolMetricsListener()
 
     async def get_client(self): # changed connect() to get_client()
         """Get the MongoDB client (create if needed)."""
-        if self._client is None:  # efficient double-checked locking 
+        if self._client is None:  # efficient double-checked locking
+            options = dict(_client_options(), maxPoolSize=self.maxPoolSize, minPoolSize=self.minPoolSize)
             self._client = AsyncIOMotorClient(
                 self.uri,
-                maxPoolSize=self.maxPoolSize,
-                minPoolSize=self.minPoolSize,
-                server_api=ServerApi('1')
+                server_api=ServerApi('1'),
+                event_listeners=[self.pool_metrics],
+                **options
             )
-            print(f"MongoDB connection pool created. Max: {self.maxPoolSize}, Min:{self.minPoolSize}")
+            logger.info(f"MongoDB connection pool created. Max: {self.maxPoolSize}, Min:{self.minPoolSize}, Options: {options}")
         return self._client
 
     async def get_database(self):
@@ -34,10 +148,35 @@ class MongoDB:
         if self.db is None:
             client = await self.get_client()
             self.db = client[self.db_name]
-            print(f"Database '{self.db_name}' selected.") # Clearer logging
+            logger.info(f"Database '{self.db_name}' selected.") # Clearer logging
 
         return self.db
 
+    async def connect(self):
+        """Startup hook: create the client and open a first connection, so the first request does not pay for it."""
+        started = time.perf_counter()
+        db = await self.get_database()
+        await db.command("ping")
+        logger.info(f"MongoDB connection warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def close(self):
+        """Shutdown hook: close the pooled connections."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self.db = None
+            logger.info("MongoDB connection pool closed")
+
+    def get_pool_stats(self) -> dict:
+        stats = self.pool_metrics.stats()
+        stats["max_pool_size"] = self.maxPoolSize
+        stats["min_pool_size"] = self.minPoolSize
+        stats["uvicorn_workers"] = UVICORN_WORKERS
+        # What the cluster has to accept from this deployment when every worker fills its pool
+        stats["max_connections_all_workers"] = self.maxPoolSize * UVICORN_WORKERS
+        stats["pool_utilization"] = round(stats["max_in_use"] / self.maxPoolSize, 3) if self.maxPoolSize else 0.0
+        return stats
+
 # Global MongoDB instance (modified)
 mongo_db_instance: MongoDB = MongoDB(MONGO_URI, DB_NAME)  # Initialize immediately
 
@@ -45,4 +184,4 @@ async def get_mongo_db():  # changed to get_mongo_db()
     """Get the MongoDB database instance (using connection pool)."""
     global mongo_db_instance
     db = await mongo_db_instance.get_database()
-    return db
\ No newline at end of file
+    return db
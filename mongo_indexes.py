@@ -0,0 +1,173 @@
+import os
+import logging
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from dotenv import load_dotenv
+
+from mongo_client import get_mongo_db
+from context_builder import CONTEXT_HISTORY_MAX_MESSAGES
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "true").lower() == "true"
+MONGO_EXPLAIN_HOT_QUERIES = os.getenv("MONGO_EXPLAIN_HOT_QUERIES", "true").lower() == "true"
+
+# Indexes follow the equality -> sort -> range rule of the queries in mongo_service
+INDEX_SPECS = [
+    # fetch_chat_history: gpt_id + hiddenFlag, sorted on created_at, role != system
+    {"collection": "messages", "name": "gpt_history_idx",
+     "keys": [("gpt_id", ASCENDING), ("hiddenFlag", ASCENDING), ("created_at", DESCENDING), ("role", ASCENDING)]},
+    # fetch_chat_history_for_use_case: adds use_case_id
+    {"collection": "messages", "name": "gpt_usecase_history_idx",
+     "keys": [("gpt_id", ASCENDING), ("use_case_id", ASCENDING), ("hiddenFlag", ASCENDING), ("created_at", DESCENDING)]},
+    # fetch_chat_history_page / iter_chat_history: keyset order (created_at, _id)
+    {"collection": "messages", "name": "gpt_history_page_idx",
+     "keys": [("gpt_id", ASCENDING), ("hiddenFlag", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"collection": "messages", "name": "gpt_usecase_history_page_idx",
+     "keys": [("gpt_id", ASCENDING), ("use_case_id", ASCENDING), ("hiddenFlag", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]},
+    # update_system_message: system message of a gpt
+    {"collection": "messages", "name": "gpt_role_idx",
+     "keys": [("gpt_id", ASCENDING), ("role", ASCENDING)]},
+    # message_archiver: hidden messages past their retention period
+    {"collection": "messages", "name": "hidden_archive_idx",
+     "keys": [("hiddenFlag", ASCENDING), ("hidden_at", ASCENDING)]},
+    # get_usecases, get_prompts, DOC_SEARCH use case lookups
+    {"collection": "usecases", "name": "gpt_usecase_name_idx",
+     "keys": [("gpt_id", ASCENDING), ("name", ASCENDING)]},
+    # message_buckets.append_message: open bucket of a (gpt_id, use_case_id)
+    {"collection": "message_buckets", "name": "bucket_append_idx",
+     "keys": [("gpt_id", ASCENDING), ("use_case_id", ASCENDING), ("count", ASCENDING)]},
+    # message_buckets readers: newest buckets of a gpt / of a use case
+    {"collection": "message_buckets", "name": "bucket_gpt_recent_idx",
+     "keys": [("gpt_id", ASCENDING), ("last_at", DESCENDING)]},
+    {"collection": "message_buckets", "name": "bucket_usecase_recent_idx",
+     "keys": [("gpt_id", ASCENDING), ("use_case_id", ASCENDING), ("last_at", DESCENDING)]},
+    # get_gpts_for_user, delete_gpts
+    {"collection": "gpts", "name": "user_idx",
+     "keys": [("user", ASCENDING)]},
+    # conversation_summarizer: latest version of a gpt's conversation. Unique, so concurrent workers cannot write the same version twice.
+    {"collection": "conversation_summaries", "name": "summary_gpt_version_idx",
+     "keys": [("gpt_id", ASCENDING), ("version", DESCENDING)], "options": {"unique": True}}
+]
+
+# Hot queries verified with explain() at startup. The sample id only matters for the query shape.
+_SAMPLE_ID = ObjectId("000000000000000000000000")
+HOT_QUERIES = [
+    {"name": "fetch_chat_history", "collection": "messages",
+     "filter": {"gpt_id": _SAMPLE_ID, "role": {"$ne": "system"}, "hiddenFlag": False}, "sort": [("created_at", DESCENDING)], "limit": CONTEXT_HISTORY_MAX_MESSAGES + 1},
+    {"name": "fetch_chat_history (export)", "collection": "messages",
+     "filter": {"gpt_id": _SAMPLE_ID, "role": {"$ne": "system"}, "hiddenFlag": False}, "sort": [("created_at", ASCENDING)]},
+    {"name": "fetch_chat_history_for_use_case", "collection": "messages",
+     "filter": {"gpt_id": _SAMPLE_ID, "role": {"$ne": "system"}, "hiddenFlag": False, "use_case_id": "sample"}, "sort": [("created_at", DESCENDING)], "limit": 10},
+    {"name": "fetch_chat_history_page", "collection": "messages",
+     "filter": {"gpt_id": _SAMPLE_ID, "role": {"$ne": "system"}, "hiddenFlag": False}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)], "limit": 21},
+    {"name": "system_message", "collection": "messages",
+     "filter": {"gpt_id": _SAMPLE_ID, "role": "system"}},
+    {"name": "get_usecases", "collection": "usecases",
+     "filter": {"gpt_id": _SAMPLE_ID}},
+    {"name": "get_prompts", "collection": "usecases",
+     "filter": {"gpt_id": _SAMPLE_ID, "name": "DOC_SEARCH"}},
+    {"name": "get_gpts_for_user", "collection": "gpts",
+     "filter": {"user": "sample"}},
+]
+
+# Result of the last verification, exposed through the metrics routes
+last_index_report = {"indexes": [], "hot_queries": []}
+
+async def ensure_indexes() -> list[dict]:
+    """Idempotently create the declared indexes. Existing indexes with the same keys are left untouched."""
+    db = await get_mongo_db()
+    results = []
+
+    for spec in INDEX_SPECS:
+        result = {"collection": spec["collection"], "name": spec["name"]}
+        try:
+            await db[spec["collection"]].create_index(spec["keys"], name=spec["name"], background=True, **spec.get("options", {}))
+            result["status"] = "ok"
+        except OperationFailure as e:
+            # Same keys under another name / options (e.g. created by hand) - the existing index serves the query
+            result["status"] = f"skipped: {e.details.get('codeName') if e.details else e}"
+            logger.warning(f"Index {spec['name']} on {spec['collection']} not created: {e}")
+        results.append(result)
+
+    logger.info(f"MongoDB indexes ensured: {results}")
+    return results
+
+async def explain_hot_queries() -> list[dict]:
+    """Run explain() on the hot queries and report the winning plan. Queries falling back to COLLSCAN are logged as warnings."""
+    db = await get_mongo_db()
+    report = []
+
+    for query in HOT_QUERIES:
+        cursor = db[query["collection"]].find(query["filter"])
+        if query.get("sort"):
+            cursor = cursor.sort(query["sort"])
+        if query.get("limit"):
+            cursor = cursor.limit(query["limit"])
+
+        try:
+            explanation = await cursor.explain()
+            winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+            stages = _plan_stages(winning_plan)
+            entry = {
+                "query": query["name"],
+                "collection": query["collection"],
+                "stages": stages,
+                "index": _plan_index_name(winning_plan),
+                "collscan": "COLLSCAN" in stages,
+            }
+        except Exception as e:
+            entry = {"query": query["name"], "collection": query["collection"], "error": str(e)}
+
+        if entry.get("collscan"):
+            logger.warning(f"Hot query '{query['name']}' on {query['collection']} falls back to COLLSCAN: {entry['stages']}")
+        report.append(entry)
+
+    return report
+
+async def bootstrap_indexes() -> dict:
+    """Startup hook: build the indexes, then verify the hot queries use them."""
+    if MONGO_ENSURE_INDEXES:
+        last_index_report["indexes"] = await ensure_indexes()
+    if MONGO_EXPLAIN_HOT_QUERIES:
+        last_index_report["hot_queries"] = await explain_hot_queries()
+
+    collscans = [entry["query"] for entry in last_index_report["hot_queries"] if entry.get("collscan")]
+    if collscans:
+        logger.warning(f"{len(collscans)} hot quer(y/ies) without index support: {collscans}")
+    else:
+        logger.info("All hot MongoDB queries are index backed")
+    return last_index_report
+
+def _plan_stages(plan: dict) -> list[str]:
+    """Flatten the stage names of a (possibly nested) winning plan, outermost first."""
+    stages = []
+    while plan:
+        # Newer servers wrap the classic plan in queryPlan
+        plan = plan.get("queryPlan", plan)
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif plan.get("inputStages"):
+            for input_stage in plan["inputStages"]:
+                stages.extend(_plan_stages(input_stage))
+            break
+        else:
+            break
+    return stages
+
+def _plan_index_name(plan: dict) -> str:
+    plan = plan.get("queryPlan", plan)
+    if "indexName" in plan:
+        return plan["indexName"]
+    for child in [plan.get("inputStage")] + list(plan.get("inputStages", [])):
+        if child:
+            name = _plan_index_name(child)
+            if name:
+                return name
+    return None
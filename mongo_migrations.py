@@ -0,0 +1,198 @@
+import sys
+import asyncio
+import logging
+import datetime as date
+from pymongo import ASCENDING, UpdateOne
+from dotenv import load_dotenv
+
+load_dotenv() # mongo_client reads MONGO_URI at import time
+
+from mongo_client import get_mongo_db
+from message_buckets import MESSAGE_BUCKET_SIZE, _sort_key
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+def parse_created_at(value: str) -> date.datetime:
+    """
+    Parse a legacy ISO string created_at. Legacy values were written with datetime.now() (naive, server local time),
+    so naive values are interpreted in the server's local time zone and converted to UTC.
+    """
+    parsed = date.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()
+    return parsed.astimezone(date.timezone.utc)
+
+async def migrate_created_at_to_date(batch_size: int = DEFAULT_BATCH_SIZE, dry_run: bool = False) -> dict:
+    """
+    Rewrite string created_at values of the messages collection to native BSON dates, in batches.
+    Safe to re-run and to run while the application is writing: only string values are touched,
+    and documents are walked in _id order so unparsable values are skipped instead of retried forever.
+    """
+    db = await get_mongo_db()
+    messages_collection = db["messages"]
+
+    stats = {"scanned": 0, "converted": 0, "unparsable": 0, "batches": 0}
+    last_id = None
+
+    while True:
+        query = {"created_at": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+
+        batch = await messages_collection.find(query, {"created_at": 1}).sort("_id", ASCENDING).limit(batch_size).to_list(None)
+        if not batch:
+            break
+
+        operations = []
+        for message in batch:
+            try:
+                created_at = parse_created_at(message["created_at"])
+                # Match on the old value too, so a concurrent change is never overwritten
+                operations.append(UpdateOne({"_id": message["_id"], "created_at": message["created_at"]}, {"$set": {"created_at": created_at}}))
+            except (ValueError, TypeError):
+                stats["unparsable"] += 1
+                logger.warning(f"Message {message['_id']} has an unparsable created_at: {message['created_at']!r}")
+
+        if operations and not dry_run:
+            result = await messages_collection.bulk_write(operations, ordered=False)
+            stats["converted"] += result.modified_count
+        elif dry_run:
+            stats["converted"] += len(operations)
+
+        stats["scanned"] += len(batch)
+        stats["batches"] += 1
+        last_id = batch[-1]["_id"]
+        logger.info(f"created_at migration progress: {stats}")
+
+        # Yield between batches to keep the load on the cluster bounded
+        await asyncio.sleep(0)
+
+    logger.info(f"created_at migration {'(dry run) ' if dry_run else ''}completed: {stats}")
+    return stats
+
+def _bucket_entry(message: dict) -> dict:
+    created_at = message.get("created_at")
+    if isinstance(created_at, str):
+        try:
+            created_at = parse_created_at(created_at)
+        except ValueError:
+            created_at = message["_id"].generation_time.replace(tzinfo=None)
+
+    return {
+        "message_id": message["_id"],
+        "gpt_name": message.get("gpt_name"),
+        "role": message["role"],
+        "content": message["content"],
+        "token_count": message.get("token_count"),
+        "created_at": created_at,
+        "hiddenFlag": bool(message.get("hiddenFlag", False)),
+        "user": message.get("user"),
+    }
+
+def _bucket_document(gpt_id, use_case_id, window: list) -> dict:
+    window.sort(key=lambda entry: _sort_key(entry["created_at"]))
+    return {
+        # Deterministic id: a re-run after a crash finds the bucket instead of inserting it again
+        "_id": window[0]["message_id"],
+        "gpt_id": gpt_id,
+        "use_case_id": use_case_id,
+        "messages": window,
+        "count": len(window),
+        "first_at": window[0]["created_at"],
+        "last_at": window[-1]["created_at"],
+        "all_hidden": all(entry["hiddenFlag"] for entry in window),
+    }
+
+async def migrate_messages_to_buckets(batch_size: int = DEFAULT_BATCH_SIZE, dry_run: bool = False, delete_source: bool = False) -> dict:
+    """
+    Copy the legacy one-document-per-message history into conversation buckets (see message_buckets.py), gpt by gpt,
+    batch_size messages at a time. Migrated documents are marked with bucketed=True (or deleted with delete_source) right
+    after their buckets are written, and messages already found in a bucket are never copied again, so the migration
+    can be stopped and resumed at any point. Run created_at_to_date first, messages are bucketed in created_at order.
+    System messages stay in the messages collection. The compatibility reader drops messages present in both places.
+    """
+    db = await get_mongo_db()
+    messages_collection = db["messages"]
+    buckets_collection = db["message_buckets"]
+
+    stats = {"gpts": 0, "messages": 0, "buckets": 0, "already_bucketed": 0, "batches": 0}
+    source_filter = {"role": {"$ne": "system"}, "bucketed": {"$ne": True}}
+
+    async def flush(gpt_id, batch: list, open_windows: dict, final: bool):
+        # Step 1: Messages copied by an interrupted earlier run are only marked
+        ids = [message["_id"] for message in batch]
+        already_bucketed = set()
+        if ids:
+            async for bucket in buckets_collection.find({"gpt_id": gpt_id, "messages.message_id": {"$in": ids}}, {"messages.message_id": 1}):
+                already_bucketed.update(entry["message_id"] for entry in bucket["messages"])
+
+        # Step 2: The others fill the open window of their use case, full windows become buckets
+        bucket_documents = []
+        done_ids = [message_id for message_id in ids if message_id in already_bucketed]
+        for message in batch:
+            if message["_id"] in already_bucketed:
+                continue
+            window = open_windows.setdefault(message.get("use_case_id"), [])
+            window.append(_bucket_entry(message))
+            if len(window) >= MESSAGE_BUCKET_SIZE:
+                bucket_documents.append(_bucket_document(gpt_id, message.get("use_case_id"), open_windows.pop(message.get("use_case_id"))))
+        if final:
+            for use_case_id, window in open_windows.items():
+                bucket_documents.append(_bucket_document(gpt_id, use_case_id, window))
+            open_windows.clear()
+        done_ids += [entry["message_id"] for bucket in bucket_documents for entry in bucket["messages"]]
+
+        # Step 3: Write the buckets, then mark (or delete) their sources. Messages of still open windows are written by a later flush.
+        if not dry_run:
+            if bucket_documents:
+                await buckets_collection.bulk_write([UpdateOne({"_id": bucket["_id"]}, {"$setOnInsert": bucket}, upsert=True) for bucket in bucket_documents], ordered=False)
+            if done_ids:
+                if delete_source:
+                    await messages_collection.delete_many({"_id": {"$in": done_ids}})
+                else:
+                    await messages_collection.update_many({"_id": {"$in": done_ids}}, {"$set": {"bucketed": True}})
+
+        stats["messages"] += len(done_ids) - len(already_bucketed)
+        stats["already_bucketed"] += len(already_bucketed)
+        stats["buckets"] += len(bucket_documents)
+        stats["batches"] += 1
+        batch.clear()
+
+    for gpt_id in await messages_collection.distinct("gpt_id", source_filter):
+        batch, open_windows = [], {}
+        cursor = messages_collection.find(dict(source_filter, gpt_id=gpt_id)).sort([("created_at", ASCENDING), ("_id", ASCENDING)]).batch_size(batch_size)
+        async for message in cursor:
+            batch.append(message)
+            if len(batch) >= batch_size:
+                await flush(gpt_id, batch, open_windows, final=False)
+                logger.info(f"Bucket migration progress: {stats}")
+                # Yield between batches to keep the load on the cluster bounded
+                await asyncio.sleep(0)
+        await flush(gpt_id, batch, open_windows, final=True)
+
+        stats["gpts"] += 1
+        logger.info(f"Bucket migration progress: {stats}")
+
+    logger.info(f"Bucket migration {'(dry run) ' if dry_run else ''}completed: {stats}")
+    return stats
+
+MIGRATIONS = {
+    "created_at_to_date": migrate_created_at_to_date,
+    "messages_to_buckets": migrate_messages_to_buckets,
+}
+
+# Usage: python mongo_migrations.py <migration> [--batch-size N] [--dry-run] [--delete-source]
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in MIGRATIONS:
+        print(f"Usage: python mongo_migrations.py <{'|'.join(MIGRATIONS)}> [--batch-size N] [--dry-run] [--delete-source]")
+        sys.exit(1)
+
+    batch_size = int(sys.argv[sys.argv.index("--batch-size") + 1]) if "--batch-size" in sys.argv else DEFAULT_BATCH_SIZE
+    dry_run = "--dry-run" in sys.argv
+    options = {"delete_source": True} if "--delete-source" in sys.argv and sys.argv[1] == "messages_to_buckets" else {}
+    print(asyncio.run(MIGRATIONS[sys.argv[1]](batch_size=batch_size, dry_run=dry_run, **options)))
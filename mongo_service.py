@@ -1,4 +1,7 @@
 import os
+import json
+import base64
+import asyncio
 import logging
 import datetime as date
 from bson import ObjectId
@@ -11,14 +14,58 @@ from data.GPTData import GPTData
 from data.MessageData import Message
 from data.Usecase import Usecase
 from mongo_client import get_mongo_db
+import message_buckets
+from message_buckets import MESSAGE_BUCKETS_ENABLED
+from message_writer import message_writer
+from entity_cache import entity_cache, GPTS, USECASES, SUMMARIES
+from token_ledger import ledger_for
 from role_mapping import NIA_OFFICIAL_MAIL, NIA_SYSTEM_PROMPT, SYSTEM_SAFETY_MESSAGE, USE_CASES_LIST
 
 logger = logging.getLogger(__name__)
 
+# Number of GPTs handled per batch when a user deletes all their GPTs
+BULK_DELETE_CHUNK_SIZE = int(os.getenv("BULK_DELETE_CHUNK_SIZE", 100))
+
+# Projection profiles: the fields each call site reads. None returns the whole document.
+PROJECTIONS = {
+    "full": None,
+    "chat_context": {"role": 1, "content": 1, "created_at": 1, "token_count": 1}, # conversation passed to the model
+    "chat_ui": {"role": 1, "content": 1, "created_at": 1, "gpt_id": 1, "use_case_id": 1, "token_count": 1}, # chat history panel
+    "gpt_list": {"name": 1, "description": 1, "use_rag": 1, "use_case_id": 1, "user": 1}, # sidebar, without the instructions
+}
+
+# Keyset pagination of the chat history (fetch_chat_history_page)
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 20))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", 100))
+
 ignored_content = "The requested information is not found in the retrieved data. Please try another query or topic."
 
-# Create a unique index on the 'name' field (optional but recommended)
-#gpts_collection.create_index("_id", unique=True)
+# Indexes of the collections used here are declared and built at startup by mongo_indexes.py
+
+def serialize_created_at(created_at):
+    """
+    created_at is a native BSON date for new messages and an ISO string for messages written before the migration.
+    Both are returned as ISO strings. Dates always sort after strings in BSON, so mixed collections keep their order.
+    """
+    if isinstance(created_at, date.datetime):
+        return (created_at if created_at.tzinfo else created_at.replace(tzinfo=date.timezone.utc)).isoformat()
+    return created_at
+
+def created_at_utc(created_at) -> date.datetime:
+    """
+    created_at (native, serialized or legacy) as an aware UTC datetime, for comparisons across both formats.
+    Native dates are UTC, legacy strings without an offset were written in server local time. None when it cannot be parsed.
+    """
+    if isinstance(created_at, str):
+        try:
+            created_at = date.datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        if created_at.tzinfo is None:
+            created_at = created_at.astimezone()
+    if not isinstance(created_at, date.datetime):
+        return None
+    return created_at.replace(tzinfo=date.timezone.utc) if created_at.tzinfo is None else created_at.astimezone(date.timezone.utc)
 
 async def get_collection(collection_name:str):
     mongo_collection = None
@@ -35,6 +82,8 @@ async def get_collection(collection_name:str):
         mongo_collection = db["orders"]
     elif collection_name == "prompts":
         mongo_collection = db["prompts"]
+    elif collection_name == SUMMARIES:
+        mongo_collection = db[SUMMARIES]
     
     return mongo_collection
 
@@ -75,6 +124,7 @@ async def update_gpt(gpt_id: str, gpt_name: str, updated_gpt: GPTData):
             {"_id": ObjectId(gpt_id)}, 
             {"$set": dict(gpt)}
         )
+        entity_cache.invalidate(GPTS, gpt_id)
 
         # Update in messages table as well to maintain consistency
         await update_system_message(gpt_id, updated_gpt.description)
@@ -89,12 +139,13 @@ async def delete_rag_use_case(gpt_id: str = None):
     # Get all the use cases starting with "Chat with"
     usecases_collection = await get_collection("usecases")
     if gpt_id is not None:
-        existing_use_cases = await usecases_collection.find({"gpt_id": ObjectId(gpt_id), "name": {"$regex": "^DOC_SEARCH"}}).to_list(None)
+        existing_use_cases = [use_case async for use_case in usecases_collection.find({"gpt_id": ObjectId(gpt_id), "name": {"$regex": "^DOC_SEARCH"}}, {"_id": 1})]
     else:
-        existing_use_cases = await usecases_collection.find({"name": {"$regex": "^DOC_SEARCH"}}).to_list(None)
+        existing_use_cases = [use_case async for use_case in usecases_collection.find({"name": {"$regex": "^DOC_SEARCH"}}, {"_id": 1})]
 
     if existing_use_cases is not None and len(existing_use_cases) > 0:
         result: DeleteResult = await usecases_collection.delete_many({"_id": {"$in": [use_case["_id"] for use_case in existing_use_cases]}})
+        entity_cache.invalidate(USECASES, gpt_id)
         logger.info(f"Deleted existing use case for RAG use case successfully : {result.deleted_count}")
         # result: DeleteResult = await delete_usecase(str(existing_use_case["_id"]))
         # logger.info(f"Step 1: Deleted existing use case for document search successfully. usecase_id : {result.deleted_count}")
@@ -114,15 +165,15 @@ async def create_usecase_for_document_search(gpt_id: str, use_case_name: str, in
 
     usecases_collection = await get_collection("usecases")
     if gpt_id is not None:
-        existing_use_cases = await usecases_collection.find({"gpt_id": ObjectId(gpt_id), "name": {"$regex": "^DOC_SEARCH"}}).to_list(None)
+        existing_use_case = await usecases_collection.find_one({"gpt_id": ObjectId(gpt_id), "name": {"$regex": "^DOC_SEARCH"}}, {"prompts": 1})
     else:
-        existing_use_cases = await usecases_collection.find({"name": {"$regex": "^DOC_SEARCH"}}).to_list(None)
+        existing_use_case = await usecases_collection.find_one({"name": {"$regex": "^DOC_SEARCH"}}, {"prompts": 1})
 
     # Extract prompts from existing use case if available
     prompts = []
-    if existing_use_cases and len(existing_use_cases) > 0:
+    if existing_use_case:
         # Take prompts from the first matching use case
-        prompts = existing_use_cases[0].get("prompts", [])
+        prompts = existing_use_case.get("prompts", [])
 
     use_case_document = {
         "name": label,
@@ -190,6 +241,7 @@ async def create_usecase_for_document_search(gpt_id: str, use_case_name: str, in
             {"$set": {"use_case_id": result.inserted_id}}
         )
         logger.info(f"Step 3: Use case connected with GPT: {gpt_id}. Usecase ID : {result.upserted_id}")
+        entity_cache.invalidate_gpt(gpt_id)
     
     return use_case_created
 
@@ -229,6 +281,7 @@ async def update_gpt_instruction(gpt_id: str, gpt_name: str, usecase_id: str, lo
                     }
                 }
             )
+            entity_cache.invalidate(GPTS, gpt_id)
 
             # Update in messages table as well to maintain consistency
             await update_system_message(gpt_id, useCase["instructions"])
@@ -240,6 +293,7 @@ async def update_gpt_instruction(gpt_id: str, gpt_name: str, usecase_id: str, lo
 async def delete_gpt(gpt_id: str, gpt_name: str):
     gpts_collection = await get_collection("gpts")
     result = await gpts_collection.delete_one({"_id": ObjectId(gpt_id)})
+    entity_cache.invalidate_gpt(gpt_id)
 
     if result.deleted_count == 1:
         # clear related chat history as well
@@ -249,78 +303,228 @@ async def delete_gpt(gpt_id: str, gpt_name: str):
     return result
 
 async def delete_gpts(loggedUser: str):
+     """
+     Delete all the GPTs of a user and hide exactly their chat history, BULK_DELETE_CHUNK_SIZE gpts at a time.
+     Each chunk hides the messages before deleting the GPTs, so an interrupted wipe can simply be repeated.
+     """
      gpts_collection = await get_collection("gpts")
-     result = await gpts_collection.delete_many({"user": loggedUser}) #delete all the GPTs created by the user
-     #gpts_collection.delete_many({}) 
+     messages_collection = await get_collection("messages")
+     await message_writer.flush() # Queued messages must be hidden too
 
-     if result.deleted_count > 0:
-        logger.info(f"Deleted all GPTs successfully. Total records deleted: {result.deleted_count}")
-        
-        # clear related chat histories as well
-        await delete_all_chat_history()
+     gpt_ids = [gpt["_id"] async for gpt in gpts_collection.find({"user": loggedUser}, {"_id": 1})]
+     deleted_count = 0
+     hidden_count = 0
 
-     return result
+     for start in range(0, len(gpt_ids), BULK_DELETE_CHUNK_SIZE):
+        chunk = gpt_ids[start:start + BULK_DELETE_CHUNK_SIZE]
 
-async def fetch_chat_history(gpt_id: str, gpt_name: str, limit: int): 
+        # Step 1: Hide the chat history of the chunk (messages and conversation buckets)
+        hide_result: UpdateResult = await messages_collection.update_many(
+            {"gpt_id": {"$in": chunk}, "hiddenFlag": {"$ne": True}},
+            {"$set": {"hiddenFlag": True, "hidden_at": date.datetime.now(date.timezone.utc)}}
+        )
+        bucket_result: UpdateResult = await message_buckets.hide_messages(gpt_ids=chunk)
+        await delete_conversation_summaries(chunk)
+        hidden_count += hide_result.modified_count + bucket_result.modified_count
+
+        # Step 2: Delete the GPTs of the chunk
+        delete_result: DeleteResult = await gpts_collection.delete_many({"_id": {"$in": chunk}, "user": loggedUser})
+        deleted_count += delete_result.deleted_count
+        for gpt_id in chunk:
+            entity_cache.invalidate_gpt(gpt_id)
+
+        logger.info(f"Deleting GPTs of {loggedUser}: {min(start + len(chunk), len(gpt_ids))}/{len(gpt_ids)} processed, "
+                    f"{deleted_count} GPTs deleted, {hidden_count} chat history records hidden")
+        await asyncio.sleep(0) # Let the foreground requests in between chunks
+
+     if deleted_count > 0:
+        logger.info(f"Deleted all GPTs successfully. Total records deleted: {deleted_count}")
+
+     return DeleteResult({"n": deleted_count}, acknowledged=True)
+
+async def fetch_chat_history(gpt_id: str, gpt_name: str, limit: int, profile: str = "full"): 
     """ 
         chat history with limit we use to show in the UI
         chat history without limit we use in the conversation context
+        profile selects the projection (see PROJECTIONS)
     """
     messages_collection = await get_collection("messages")
-    chat_history = []
+    projection = PROJECTIONS[profile]
 
     if gpt_name == "export_pdf":
-        chat_history = await messages_collection.find({"gpt_id": ObjectId(gpt_id), "role" : {"$ne": "system"}, "hiddenFlag" : False}).sort("created_at", ASCENDING).to_list(None)
+        # Already in order and merged with the conversation buckets
+        return [chat async for chat in iter_chat_history(gpt_id, profile=profile)]
     else:
         if limit > 0:
-            chat_history = await messages_collection.find({"gpt_id": ObjectId(gpt_id), "role" : {"$ne": "system"}, "hiddenFlag" : False}).sort("created_at", DESCENDING).limit(limit).to_list(None) #only the last 10 conversations are picked. Since we are using the same call for adding to the conversations we have the same answer repeating problem
+            cursor = messages_collection.find({"gpt_id": ObjectId(gpt_id), "role" : {"$ne": "system"}, "hiddenFlag" : False}, projection).sort("created_at", DESCENDING).limit(limit) #only the last 10 conversations are picked. Since we are using the same call for adding to the conversations we have the same answer repeating problem
         else:
-            chat_history = await messages_collection.find({"gpt_id": ObjectId(gpt_id), "name" : {"$ne": ignored_content}, "hiddenFlag" : False}).sort("created_at", ASCENDING).to_list(None) #discard message content with ignored_content
+            cursor = messages_collection.find({"gpt_id": ObjectId(gpt_id), "name" : {"$ne": ignored_content}, "hiddenFlag" : False}, projection).sort("created_at", ASCENDING) #discard message content with ignored_content
+    chat_history = [chat async for chat in cursor]
 
-    if chat_history is not None:
-        chat_history = list(chat_history)
+    # Compatibility reader: messages written (or migrated) to conversation buckets are merged with the legacy documents
+    if MESSAGE_BUCKETS_ENABLED:
+        bucketed_history = await message_buckets.read_gpt_messages(gpt_id, limit)
+        chat_history = message_buckets.merge_histories(chat_history, bucketed_history, limit, descending=(limit > 0))
 
-        # Convert ObjectId to string (_id and gpt_id)
-        for chat in chat_history:
-            chat["_id"] = str(chat["_id"])
-            chat["gpt_id"] = str(chat["gpt_id"]) 
-            chat["use_case_id"] = str(chat["use_case_id"]) 
-    
-        logger.info(f"Chat History Length for {gpt_name}: {len(chat_history)}")
+    chat_history = [serialize_message(chat, projection) for chat in chat_history]
+    logger.info(f"Chat History Length for {gpt_name}: {len(chat_history)}")
 
     return chat_history
 
-async def fetch_chat_history_for_use_case(use_case_id: str, gpt_id: str, gpt_name: str, limit: int = 10): 
+async def fetch_chat_history_for_use_case(use_case_id: str, gpt_id: str, gpt_name: str, limit: int = 10, profile: str = "full"): 
     """ 
         chat history with limit we use to show in the UI
         chat history without limit we use in the conversation context
+        profile selects the projection (see PROJECTIONS)
     """
     messages_collection = await get_collection("messages")
-    chat_history = []
+    projection = PROJECTIONS[profile]
     
-    chat_history = await messages_collection.find({"gpt_id": ObjectId(gpt_id), "role" : {"$ne": "system"}, "hiddenFlag" : False, "use_case_id" : use_case_id}).sort("created_at", DESCENDING).limit(limit).to_list(None) #only the last 10 conversations are picked. Since we are using the same call for adding to the conversations we have the same answer repeating problem
+    cursor = messages_collection.find({"gpt_id": ObjectId(gpt_id), "role" : {"$ne": "system"}, "hiddenFlag" : False, "use_case_id" : use_case_id}, projection).sort("created_at", DESCENDING).limit(limit) #only the last 10 conversations are picked. Since we are using the same call for adding to the conversations we have the same answer repeating problem
+    chat_history = [chat async for chat in cursor]
+
+    # Compatibility reader: merge the conversation buckets of this use case with the legacy documents
+    if MESSAGE_BUCKETS_ENABLED:
+        bucketed_history = await message_buckets.read_use_case_messages(gpt_id, use_case_id, limit)
+        chat_history = message_buckets.merge_histories(chat_history, bucketed_history, limit, descending=True)
     #logger.info(f"Chat History {chat_history}")
-    if chat_history is not None:
-        chat_history = list(chat_history)
-
-        # Convert ObjectId to string (_id and gpt_id)
-        for chat in chat_history:
-            chat["_id"] = str(chat["_id"])
-            chat["gpt_id"] = str(chat["gpt_id"]) 
-            chat["use_case_id"] = str(chat["use_case_id"]) 
-    
-        logger.info(f"Chat History Length for {gpt_name}: {len(chat_history)}")
+
+    chat_history = [serialize_message(chat, projection) for chat in chat_history]
+    logger.info(f"Chat History Length for {gpt_name}: {len(chat_history)}")
 
     return chat_history
 
+def encode_history_cursor(message: dict) -> str:
+    """Opaque pagination cursor of a (raw) message: its (created_at, _id) key."""
+    created_at = message.get("created_at")
+    is_date = isinstance(created_at, date.datetime)
+    payload = {"c": serialize_created_at(created_at) if is_date else created_at, "d": is_date, "id": str(message["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor: str) -> tuple:
+    """Inverse of encode_history_cursor. Raises ValueError on a malformed cursor."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        created_at = date.datetime.fromisoformat(payload["c"]) if payload["d"] else payload["c"]
+        return created_at, ObjectId(payload["id"])
+    except Exception as e:
+        raise ValueError(f"Invalid chat history cursor: {cursor}") from e
+
+def _keyset_filter(cursor: tuple, older: bool) -> dict:
+    """Messages strictly older (or newer) than the cursor in (created_at, _id) order."""
+    created_at, message_id = cursor
+    clauses = [
+        {"created_at": {"$lt" if older else "$gt": created_at}},
+        {"created_at": created_at, "_id": {"$lt" if older else "$gt": message_id}},
+    ]
+    # Comparisons only match values of the same BSON type: legacy string dates sort before native dates
+    if older and isinstance(created_at, date.datetime):
+        clauses.append({"created_at": {"$type": "string"}})
+    elif not older and not isinstance(created_at, date.datetime):
+        clauses.append({"created_at": {"$type": "date"}})
+    return {"$or": clauses}
+
+def _history_filter(gpt_id: str, use_case_id: str = None) -> dict:
+    query = {"gpt_id": ObjectId(gpt_id), "role": {"$ne": "system"}, "hiddenFlag": False}
+    if use_case_id is not None:
+        query["use_case_id"] = use_case_id
+    if MESSAGE_BUCKETS_ENABLED:
+        # Migrated messages are read from their bucket
+        query["bucketed"] = {"$ne": True}
+    return query
+
+async def fetch_chat_history_page(gpt_id: str, page_size: int = CHAT_HISTORY_PAGE_SIZE, before: str = None, after: str = None, use_case_id: str = None, profile: str = "chat_ui", with_cursors: bool = False) -> dict:
+    """
+    One page of chat history with keyset pagination on (created_at, _id), in chronological order.
+    Without cursors the newest page is returned. before pages towards older messages, after towards newer ones.
+    The returned before / after cursors are None when there is nothing more in that direction.
+    with_cursors adds the cursor of every message to it (resume points of the conversation summarizer).
+    """
+    messages_collection = await get_collection("messages")
+    projection = PROJECTIONS[profile]
+    page_size = max(1, min(page_size, CHAT_HISTORY_MAX_PAGE_SIZE))
+    older = after is None
+    cursor = decode_history_cursor(before if older else after) if (before or after) else None
+
+    query = _history_filter(gpt_id, use_case_id)
+    if cursor is not None:
+        query.update(_keyset_filter(cursor, older))
+
+    # Sorted away from the cursor, one extra message tells whether there is a next page
+    direction = DESCENDING if older else ASCENDING
+    messages = [chat async for chat in messages_collection.find(query, projection).sort([("created_at", direction), ("_id", direction)]).limit(page_size + 1)]
+
+    if MESSAGE_BUCKETS_ENABLED:
+        bucketed = await message_buckets.read_page(gpt_id, use_case_id, cursor, older, page_size + 1)
+        messages = sorted(messages + bucketed, key=message_buckets.page_key, reverse=older)[:page_size + 1]
+
+    has_more = len(messages) > page_size
+    messages = sorted(messages[:page_size], key=message_buckets.page_key)
+
+    page = {
+        "chat_history": [dict(serialize_message(chat, projection), cursor=encode_history_cursor(chat)) if with_cursors else serialize_message(chat, projection) for chat in messages],
+        "before": encode_history_cursor(messages[0]) if messages and (has_more or not older) else None,
+        "after": encode_history_cursor(messages[-1]) if messages and (has_more or older) and cursor is not None else None,
+    }
+    return page
+
+async def iter_chat_history(gpt_id: str, use_case_id: str = None, profile: str = "full"):
+    """
+    The whole visible chat history of a gpt, oldest first, streamed from the cursor (used by the export).
+    Bucketed messages are merged in order without materializing either side.
+    """
+    messages_collection = await get_collection("messages")
+    projection = PROJECTIONS[profile]
+    cursor = messages_collection.find(_history_filter(gpt_id, use_case_id), projection).sort([("created_at", ASCENDING), ("_id", ASCENDING)])
+
+    if not MESSAGE_BUCKETS_ENABLED:
+        async for chat in cursor:
+            yield serialize_message(chat, projection)
+        return
+
+    # Two-way merge of the legacy cursor and the bucket stream
+    legacy = cursor.__aiter__()
+    bucketed = message_buckets.iter_messages(gpt_id, use_case_id).__aiter__()
+    next_legacy = await anext(legacy, None)
+    next_bucketed = await anext(bucketed, None)
+    while next_legacy is not None or next_bucketed is not None:
+        if next_bucketed is None or (next_legacy is not None and message_buckets.page_key(next_legacy) <= message_buckets.page_key(next_bucketed)):
+            yield serialize_message(next_legacy, projection)
+            next_legacy = await anext(legacy, None)
+        else:
+            yield serialize_message(next_bucketed, projection)
+            next_bucketed = await anext(bucketed, None)
+
+def serialize_message(chat: dict, projection: dict = None) -> dict:
+    """JSON friendly message: ObjectIds and dates as strings, restricted to the projected fields (bucketed messages carry all of them)."""
+    if projection is not None:
+        chat = {key: value for key, value in chat.items() if key == "_id" or key in projection}
+
+    # Convert ObjectId to string (_id and gpt_id)
+    chat["_id"] = str(chat["_id"])
+    for key in ("gpt_id", "use_case_id"):
+        if key in chat:
+            chat[key] = str(chat[key])
+    if "created_at" in chat:
+        chat["created_at"] = serialize_created_at(chat["created_at"])
+    return chat
+
 async def delete_chat_history(gpt_id: str, gpt_name: str):
     #result = messages_collection.delete_many({"gpt_id": ObjectId(gpt_id)})
     messages_collection = await get_collection("messages")
+    await message_writer.flush() # Queued messages must be hidden too
 
+    # hidden_at starts the retention period of the message archiver (message_archiver.py)
     result: UpdateResult = await messages_collection.update_many(
-            {"gpt_id": ObjectId(gpt_id)},
-            {"$set": {"hiddenFlag" : True}}
+            {"gpt_id": ObjectId(gpt_id), "hiddenFlag": {"$ne": True}},
+            {"$set": {"hiddenFlag" : True, "hidden_at": date.datetime.now(date.timezone.utc)}}
         )
+
+    # Messages in conversation buckets are hidden as well (also after the buckets are switched off again)
+    bucket_result: UpdateResult = await message_buckets.hide_messages(gpt_id)
+    await delete_conversation_summaries([ObjectId(gpt_id)])
+    if result.modified_count == 0:
+        result = bucket_result
     
     logger.info(f"Modified count: {result.modified_count}")
     if result.modified_count > 0:
@@ -332,11 +536,15 @@ async def delete_chat_history(gpt_id: str, gpt_name: str):
 async def delete_all_chat_history():
     #result = messages_collection.delete_many({})
     messages_collection = await get_collection("messages")
+    await message_writer.flush() # Queued messages must be hidden too
 
+    # Only visible messages are touched, so already hidden ones keep their hidden_at
     result: UpdateResult = await messages_collection.update_many(
-        {},  # This matches all documents
-        {"$set": {"hiddenFlag": True}}  # Update to set hiddenFlag to True
+        {"hiddenFlag": {"$ne": True}},
+        {"$set": {"hiddenFlag": True, "hidden_at": date.datetime.now(date.timezone.utc)}}  # Update to set hiddenFlag to True
     )
+    await message_buckets.hide_messages()
+    await delete_conversation_summaries()
     
     if result.modified_count > 0:
         logger.info(f"Deleted chat history for all GPTs successfully. Total records deleted: {result.modified_count}")
@@ -344,20 +552,27 @@ async def delete_all_chat_history():
         logger.info(f"No chat history found for deletion")
     return result
 
+async def delete_conversation_summaries(gpt_ids: list = None):
+    """The summaries of a hidden chat history must not be sent to the model anymore (all gpts when no ids are given)."""
+    summaries_collection = await get_collection(SUMMARIES)
+    result: DeleteResult = await summaries_collection.delete_many({"gpt_id": {"$in": gpt_ids}} if gpt_ids is not None else {})
+    entity_cache.invalidate(SUMMARIES)
+    logger.info(f"Deleted {result.deleted_count} conversation summaries")
+    return result
+
 async def update_message(message: dict):
     """
     Update the message in the database
     """
 
-    messages_collection = await get_collection("messages")
-
-    # Add message to the messages Collection
-    await messages_collection.insert_one({
+    # Written through the batched message writer. Bucketed storage appends to the conversation bucket instead.
+    return await message_writer.write({
         "gpt_id": ObjectId(message["gpt_id"]),
         "gpt_name": message["gpt_name"],
         "role": message["role"],
         "content": message["content"],
-        "created_at": date.datetime.now().isoformat(),
+        "token_count": ledger_for(message["gpt_name"]).count(message["content"]), # Counted with the deployment's encoding on the request path, so usually a cache hit
+        "created_at": date.datetime.now(date.timezone.utc),
         "hiddenFlag" : False,
         "user": message["user"],
         "use_case_id": message["use_case_id"]
@@ -368,10 +583,9 @@ async def update_system_message(gpt_id: str, system_message: str) -> UpdateResul
     logger.info(f"Updating system message for GPT ID: {gpt_id} and system message: {system_message}")
 
     messages_collection = await get_collection("messages")
-    gpts_collection = await get_collection("gpts")
 
     # Get the gpt
-    gpt: GPTData = await gpts_collection.find_one({"_id": ObjectId(gpt_id)})
+    gpt: GPTData = await get_gpt_by_id(gpt_id)
 
     # fetch the respective record from the messages collection
     message: Message = await messages_collection.find_one({"gpt_id": ObjectId(gpt_id), "role": "system"})
@@ -382,7 +596,7 @@ async def update_system_message(gpt_id: str, system_message: str) -> UpdateResul
             "gpt_id": ObjectId(gpt_id),
             "role": "system",
             "content": system_message,
-            "created_at": date.datetime.now().isoformat(),
+            "created_at": date.datetime.now(date.timezone.utc),
             "hiddenFlag" : False,
             "user": gpt["user"],
             "use_case_id": gpt["use_case_id"]
@@ -405,16 +619,17 @@ async def get_usecases(gpt_id: str):
     """
     Fetch the list of usecases from the "usecase" collection
     """
-    usecases_collection = await get_collection("usecases")
-    usecases = await usecases_collection.find({"gpt_id": ObjectId(gpt_id)}).to_list(None) 
+    return await entity_cache.get_or_load(USECASES, gpt_id, lambda: _load_usecases(gpt_id))
 
-    if usecases is not None:
-        usecases = list(usecases)
+async def _load_usecases(gpt_id: str):
+    usecases_collection = await get_collection("usecases")
+    usecases = []
 
+    async for usecase in usecases_collection.find({"gpt_id": ObjectId(gpt_id)}):
         # Convert ObjectId to string (_id)
-        for usecase in usecases:
-            usecase["_id"] = str(usecase["_id"])
-            usecase["gpt_id"] = str(usecase["gpt_id"])
+        usecase["_id"] = str(usecase["_id"])
+        usecase["gpt_id"] = str(usecase["gpt_id"])
+        usecases.append(usecase)
 
     logger.info(f"Fetched usecases successfully.")
 
@@ -480,6 +695,7 @@ async def update_prompt(gpt_id: str, use_case_name: str, user: str, refinedPromp
             {"_id": prompt["_id"]},
             {"$set": {"prompts": prompt["prompts"]}}
             )
+            entity_cache.invalidate(USECASES, gpt_id)
             logger.info(f"prompt: {prompt}")
             return {"status": "success"}
         except Exception as e:
@@ -505,6 +721,7 @@ async def delete_prompt(gpt_id: str, use_case_name: str, user: str, key: str):
                     {"_id": prompt["_id"]},
                     {"$set": {"prompts": prompt["prompts"]}}
                 )
+                entity_cache.invalidate(USECASES, gpt_id)
                 logger.info(f"Deleted prompt with key: {key} for user: {user}")
                 return {"status": "success"}
             except Exception as e:
@@ -540,16 +757,15 @@ async def update_usecases(gpt_id: str, updated_use_cases: list):
     Update the list of usecases in the "usecase" collection
     """
     usecases_collection = await get_collection("usecases")
-    existing_use_cases = await usecases_collection.find({"gpt_id": ObjectId(gpt_id)}).to_list(None)
-
-    if existing_use_cases is not None and len(existing_use_cases) > 0:
-        # Delete the existing use cases
-        await usecases_collection.delete_many({"gpt_id": ObjectId(gpt_id)})
+    # Delete the existing use cases
+    delete_result: DeleteResult = await usecases_collection.delete_many({"gpt_id": ObjectId(gpt_id)})
+    if delete_result.deleted_count > 0:
         logger.info(f"Deleted existing usecases for {gpt_id} successfully.")
 
     # Insert the new list of use cases into the collection
     updated_use_cases = await convert_json_to_mongo_format(updated_use_cases)
     result = await usecases_collection.insert_many(updated_use_cases)
+    entity_cache.invalidate(USECASES, gpt_id)
     logger.info(f"{result.inserted_ids} Updated usecases successfully.")
 
 async def update_orders(orders):
@@ -614,16 +830,21 @@ async def get_order_by_id(order_id: str):
 
     return order
 
-async def get_gpts_for_user(username):
+async def get_gpts_for_user(username, profile: str = "full"):
     gpts_collection = await get_collection("gpts")
-    gpts = await gpts_collection.find({'user': username}).to_list(None) # Get all GPTs from MongoDB
-    for gpt in gpts:
+    gpts = []
+
+    async for gpt in gpts_collection.find({'user': username}, PROJECTIONS[profile]): # Get all GPTs from MongoDB
         gpt["_id"] = str(gpt.get("_id", "")) # Convert ObjectId to string
         gpt["use_case_id"] = str(gpt.get("use_case_id", "")) # Convert ObjectId to string or set to empty string if not available
+        gpts.append(gpt)
 
     return gpts
 
 async def get_gpt_by_id(gpt_id):
+    return await entity_cache.get_or_load(GPTS, gpt_id, lambda: _load_gpt(gpt_id))
+
+async def _load_gpt(gpt_id):
     gpts_collection = await get_collection("gpts")
     gpt: GPTData = await gpts_collection.find_one({"_id": ObjectId(gpt_id)})
     return gpt
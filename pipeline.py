@@ -0,0 +1,73 @@
+import time
+import asyncio
+import logging
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+class PipelineStage:
+    def __init__(self, name: str, func, depends_on: tuple):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+
+class Pipeline:
+    """
+    Small dependency-graph executor for the request pipeline.
+    Every stage is an async callable receiving the results of the stages run so far. A stage starts as soon as
+    its dependencies are done, so independent I/O runs concurrently. Timings are kept per stage.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.results = {}
+        self.timings = {}
+        self._stages: dict[str, PipelineStage] = {}
+        self._started_at = time.monotonic()
+
+    def add_stage(self, name: str, func, depends_on: tuple = ()):
+        # Dependencies must be registered first, which also rules out cycles
+        missing = [dependency for dependency in depends_on if dependency not in self._stages]
+        if missing:
+            raise ValueError(f"Stage '{name}' depends on unknown stage(s) {missing}")
+        self._stages[name] = PipelineStage(name, func, depends_on)
+
+    async def run(self) -> dict:
+        """Run every registered stage that has not run yet. Returns the shared results."""
+        tasks = {}
+
+        async def run_stage(stage: PipelineStage):
+            if stage.depends_on:
+                await asyncio.gather(*(tasks[dependency] for dependency in stage.depends_on if dependency in tasks))
+            self.results[stage.name] = await self.timed(stage.name, stage.func(self.results))
+
+        for stage in self._stages.values():
+            if stage.name not in self.results:
+                tasks[stage.name] = asyncio.create_task(run_stage(stage))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        return self.results
+
+    async def timed(self, name: str, awaitable):
+        """Await a single step and record its duration under the given stage name."""
+        started = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.timings[name] = round((time.monotonic() - started) * 1000, 1)
+
+    def timing_breakdown(self) -> dict:
+        return {"stages_ms": dict(self.timings), "total_ms": round((time.monotonic() - self._started_at) * 1000, 1)}
+
+    def server_timing_header(self) -> str:
+        """Stage timings in the Server-Timing header format, e.g. chat_history;dur=12.3"""
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.timings.items())
+
+    def log_timings(self):
+        logger.info(f"Pipeline {self.name} timings: {self.timing_breakdown()}")
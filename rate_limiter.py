@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Optional static quotas per deployment, e.g. {"gpt-4o": {"tpm": 30000, "rpm": 180}}.
+# Deployments without a configured quota learn their capacity from the x-ratelimit-* response headers.
+DEPLOYMENT_QUOTAS = json.loads(os.getenv("AZURE_OPENAI_DEPLOYMENT_QUOTAS", "{}"))
+RATE_LIMIT_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_QUEUE_WAIT_SECONDS", 2))
+RATE_LIMIT_MAX_QUEUE_DEPTH = int(os.getenv("RATE_LIMIT_MAX_QUEUE_DEPTH", 20))
+RATE_LIMIT_POLL_SECONDS = 0.05
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at capacity-per-minute."""
+
+    def __init__(self, capacity: float = None):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def is_known(self) -> bool:
+        return self.capacity is not None
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.is_known:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def has(self, amount: float) -> bool:
+        if not self.is_known:
+            return True
+        self._refill()
+        # A request bigger than the whole bucket can only run on a full bucket
+        return self.tokens >= min(amount, self.capacity)
+
+    def consume(self, amount: float):
+        if self.is_known:
+            self._refill()
+            self.tokens -= amount
+
+    def seconds_until(self, amount: float) -> float:
+        if self.has(amount):
+            return 0.0
+        missing = min(amount, self.capacity) - self.tokens
+        return missing * 60 / self.capacity if self.capacity > 0 else RATE_LIMIT_MAX_QUEUE_WAIT_SECONDS
+
+    def sync(self, remaining: float, limit: float = None):
+        """Align the bucket with the quota reported by the service."""
+        if limit is not None:
+            self.capacity = limit
+        elif self.capacity is None or remaining > self.capacity:
+            self.capacity = remaining
+        self.tokens = remaining
+        self.updated_at = time.monotonic()
+
+class DeploymentBuckets:
+    """Token and request buckets of a single (endpoint, deployment) pair."""
+
+    def __init__(self, quota: dict):
+        self.tokens = TokenBucket(quota.get("tpm"))
+        self.requests = TokenBucket(quota.get("rpm"))
+        self.blocked_until = 0.0
+        self.waiters = 0
+        self.throttled_count = 0
+
+    def has_headroom(self, tokens: int) -> bool:
+        return time.monotonic() >= self.blocked_until and self.tokens.has(tokens) and self.requests.has(1)
+
+    def seconds_until_headroom(self, tokens: int) -> float:
+        return max(self.blocked_until - time.monotonic(), self.tokens.seconds_until(tokens), self.requests.seconds_until(1))
+
+    def consume(self, tokens: int):
+        self.tokens.consume(tokens)
+        self.requests.consume(1)
+
+class DeploymentRateLimiter:
+    """
+    Client-side rate limiter keyed by (endpoint, deployment).
+    Buckets are fed by pre-flight token estimates and corrected by the x-ratelimit-remaining-* headers.
+    """
+
+    def __init__(self):
+        self._buckets: dict[tuple, DeploymentBuckets] = {}
+
+    def _get_buckets(self, endpoint: str, deployment: str) -> DeploymentBuckets:
+        key = (endpoint, deployment)
+        if key not in self._buckets:
+            self._buckets[key] = DeploymentBuckets(DEPLOYMENT_QUOTAS.get(deployment, {}))
+        return self._buckets[key]
+
+    def has_headroom(self, endpoint: str, deployment: str, tokens: int) -> bool:
+        return self._get_buckets(endpoint, deployment).has_headroom(tokens)
+
+    def try_acquire(self, endpoint: str, deployment: str, tokens: int) -> bool:
+        buckets = self._get_buckets(endpoint, deployment)
+        if buckets.has_headroom(tokens):
+            buckets.consume(tokens)
+            return True
+        return False
+
+    async def acquire(self, endpoint: str, deployment: str, tokens: int, max_wait: float = RATE_LIMIT_MAX_QUEUE_WAIT_SECONDS) -> bool:
+        """Wait in a short, bounded queue for headroom. Returns False if none appears within max_wait."""
+        buckets = self._get_buckets(endpoint, deployment)
+
+        if self.try_acquire(endpoint, deployment, tokens):
+            return True
+
+        if buckets.waiters >= RATE_LIMIT_MAX_QUEUE_DEPTH or buckets.seconds_until_headroom(tokens) > max_wait:
+            return False
+
+        deadline = time.monotonic() + max_wait
+        buckets.waiters += 1
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(min(RATE_LIMIT_POLL_SECONDS, max(0.0, deadline - time.monotonic())))
+                if self.try_acquire(endpoint, deployment, tokens):
+                    return True
+        finally:
+            buckets.waiters -= 1
+
+        return False
+
+    def update_from_headers(self, endpoint: str, deployment: str, headers, status_code: int):
+        buckets = self._get_buckets(endpoint, deployment)
+
+        remaining_tokens = _header_as_float(headers, "x-ratelimit-remaining-tokens")
+        remaining_requests = _header_as_float(headers, "x-ratelimit-remaining-requests")
+
+        if remaining_tokens is not None:
+            buckets.tokens.sync(remaining_tokens, _header_as_float(headers, "x-ratelimit-limit-tokens"))
+        if remaining_requests is not None:
+            buckets.requests.sync(remaining_requests, _header_as_float(headers, "x-ratelimit-limit-requests"))
+
+        if status_code == 429:
+            buckets.throttled_count += 1
+            retry_after_ms = _header_as_float(headers, "retry-after-ms")
+            retry_after = retry_after_ms / 1000 if retry_after_ms is not None else _header_as_float(headers, "retry-after")
+            buckets.blocked_until = time.monotonic() + (retry_after if retry_after is not None else 1.0)
+            logger.warning(f"Deployment {deployment} on {endpoint} throttled. Blocked for {retry_after}s")
+
+    def snapshot(self) -> list[dict]:
+        """Current bucket state, used for metrics."""
+        now = time.monotonic()
+        snapshot = []
+        for (endpoint, deployment), buckets in self._buckets.items():
+            buckets.tokens.has(0) # refresh the refill before reporting
+            buckets.requests.has(0)
+            snapshot.append({
+                "endpoint": endpoint,
+                "deployment": deployment,
+                "tokens_remaining": round(buckets.tokens.tokens, 1) if buckets.tokens.is_known else None,
+                "tokens_capacity": buckets.tokens.capacity,
+                "requests_remaining": round(buckets.requests.tokens, 1) if buckets.requests.is_known else None,
+                "requests_capacity": buckets.requests.capacity,
+                "blocked_for_seconds": round(max(0.0, buckets.blocked_until - now), 2),
+                "waiters": buckets.waiters,
+                "throttled_count": buckets.throttled_count,
+            })
+        return snapshot
+
+def _header_as_float(headers, name: str):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+# Process wide limiter shared by every Azure OpenAI call
+rate_limiter = DeploymentRateLimiter()
@@ -0,0 +1,184 @@
+import os
+import re
+import math
+import time
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from dependencies import NiaAzureOpenAIClient
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Off by default: when enabled, a repeated question is answered from the cache instead of a fresh completion
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 900))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 500))
+
+# Optional semantic tier: near-duplicate questions over the same retrieved context share a response
+RESPONSE_CACHE_SEMANTIC_ENABLED = os.getenv("RESPONSE_CACHE_SEMANTIC_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD", 0.95))
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "text-embedding-3-large")
+
+# Request headers that skip the cache (lookup and store)
+RESPONSE_CACHE_BYPASS_HEADER = "x-nia-cache-bypass"
+STREAM_REPLAY_CHUNK_WORDS = 8
+
+class CacheKey:
+    """
+    Identity of a cacheable response.
+        scope : everything except the user message (gpt, use case, retrieved context, model configuration)
+        exact : scope + normalized user message
+    """
+
+    def __init__(self, scope: str, exact: str, message: str):
+        self.scope = scope
+        self.exact = exact
+        self.message = message
+
+class CacheEntry:
+    def __init__(self, key: CacheKey, value: dict, embedding: list[float] = None):
+        self.key = key
+        self.value = value
+        self.embedding = embedding
+        self.expires_at = time.monotonic() + RESPONSE_CACHE_TTL_SECONDS
+
+    def is_expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+class ResponseCache:
+    """In-process TTL + LRU cache of final model responses, with an optional embedding-similarity tier."""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bypassed": 0}
+
+    def build_key(self, gpt: dict, use_case: str, user_message: str, retrieved_context: str, model_configuration, streaming: bool) -> CacheKey:
+        scope = _sha256(json.dumps({
+            "gpt_id": str(gpt["_id"]),
+            "model": gpt["name"],
+            "instructions": _sha256(gpt.get("instructions") or ""),
+            "use_case": use_case,
+            "context": _sha256(retrieved_context or ""),
+            "model_configuration": {
+                "max_tokens": model_configuration.max_tokens,
+                "temperature": model_configuration.temperature,
+                "top_p": model_configuration.top_p,
+                "frequency_penalty": model_configuration.frequency_penalty,
+                "presence_penalty": model_configuration.presence_penalty,
+            },
+            "streaming": streaming,
+        }, sort_keys=True, default=str))
+        message = normalize_message(user_message)
+        return CacheKey(scope, _sha256(f"{scope}:{message}"), message)
+
+    async def get(self, key: CacheKey) -> dict:
+        entry = self._entries.get(key.exact)
+        if entry is not None and entry.is_expired():
+            self._remove(key.exact)
+            entry = None
+
+        if entry is not None:
+            self._entries.move_to_end(key.exact)
+            self._stats["hits"] += 1
+            return entry.value
+
+        if RESPONSE_CACHE_SEMANTIC_ENABLED:
+            entry = await self._get_similar(key)
+            if entry is not None:
+                self._stats["semantic_hits"] += 1
+                return entry.value
+
+        self._stats["misses"] += 1
+        return None
+
+    async def put(self, key: CacheKey, value: dict):
+        embedding = await _embed(key.message) if RESPONSE_CACHE_SEMANTIC_ENABLED else None
+        self._entries[key.exact] = CacheEntry(key, value, embedding)
+        self._entries.move_to_end(key.exact)
+        self._stats["stores"] += 1
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def record_bypass(self):
+        self._stats["bypassed"] += 1
+
+    async def _get_similar(self, key: CacheKey) -> CacheEntry:
+        candidates = [entry for entry in self._entries.values() if entry.key.scope == key.scope and entry.embedding is not None and not entry.is_expired()]
+        if not candidates:
+            return None
+
+        embedding = await _embed(key.message)
+        if embedding is None:
+            return None
+
+        best_entry, best_score = None, 0.0
+        for entry in candidates:
+            score = _cosine_similarity(embedding, entry.embedding)
+            if score > best_score:
+                best_entry, best_score = entry, score
+
+        if best_entry is None or best_score < RESPONSE_CACHE_SEMANTIC_THRESHOLD:
+            return None
+
+        logger.info(f"Semantic cache hit (similarity {best_score:.3f}) for '{key.message}' ~ '{best_entry.key.message}'")
+        self._entries.move_to_end(best_entry.key.exact)
+        return best_entry
+
+    def _remove(self, exact_key: str):
+        self._entries.pop(exact_key, None)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["entries"] = len(self._entries)
+        stats["enabled"] = RESPONSE_CACHE_ENABLED
+        stats["semantic_enabled"] = RESPONSE_CACHE_SEMANTIC_ENABLED
+        return stats
+
+def normalize_message(message: str) -> str:
+    return re.sub(r"\s+", " ", (message or "").strip().lower()).rstrip(" ?!.")
+
+def is_cache_bypassed(headers) -> bool:
+    """True if the caller asked to skip the cache, either with the custom header or Cache-Control: no-cache."""
+    if headers is None:
+        return False
+    if headers.get(RESPONSE_CACHE_BYPASS_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in headers.get("cache-control", "").lower()
+
+async def replay_stream(content: str):
+    """Replay a cached response as a stream, a few words at a time."""
+    words = re.split(r"(\s+)", content)
+    step = STREAM_REPLAY_CHUNK_WORDS * 2 # words and their separators
+    for i in range(0, len(words), step):
+        yield "".join(words[i:i + step])
+        await asyncio.sleep(0)
+
+async def _embed(text: str) -> list[float]:
+    try:
+        nia_azure_client = await NiaAzureOpenAIClient.create()
+        response = await nia_azure_client.get_azure_client().embeddings.create(model=RESPONSE_CACHE_EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+    except Exception as e:
+        logger.warning(f"Embedding for the semantic response cache failed: {e}")
+        return None
+
+def _cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def _sha256(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+# Process wide response cache
+response_cache = ResponseCache()
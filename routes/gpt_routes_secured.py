@@ -20,7 +20,9 @@ from data.InputPrompt import InputPrompt
 from data.ModelConfiguration import ModelConfiguration
 from gpt_utils import handle_upload_files, create_folders
 from azure_openai_utils import generate_response
-from mongo_service import fetch_chat_history_for_use_case, get_gpt_by_id, create_new_gpt, get_gpts_for_user, update_gpt, delete_gpt, delete_gpts, delete_chat_history, fetch_chat_history, get_usecases, update_gpt_instruction, get_collection, get_prompts, update_prompt, delete_prompt
+from response_cache import is_cache_bypassed
+from blocking_io import run_blocking
+from mongo_service import fetch_chat_history_for_use_case, get_gpt_by_id, create_new_gpt, get_gpts_for_user, update_gpt, delete_gpt, delete_gpts, delete_chat_history, fetch_chat_history, get_usecases, update_gpt_instruction, get_collection, get_prompts, update_prompt, delete_prompt, fetch_chat_history_page, iter_chat_history, CHAT_HISTORY_PAGE_SIZE
 from prompt_utils import PromptValidator
 
 from bson import ObjectId
@@ -99,6 +101,18 @@ async def get_gpts(request: Request, user: Annotated[dict, Depends(azure_scheme)
 
     return JSONResponse({"gpts": gpts}, status_code=200)
 
+@router.get("/get_gpts_list")
+async def get_gpts_list(request: Request, user: Annotated[dict, Depends(azure_scheme)]):
+    """Lightweight gpt list for the sidebar: no instructions (see PROJECTIONS["gpt_list"])."""
+    gpts = []
+    loggedUser = user.name  # Extract the username from the user token payload
+    logger.info(f"Logged User: {loggedUser}")
+
+    if loggedUser != None and loggedUser != "N/A":
+        gpts = await get_gpts_for_user(loggedUser, profile="gpt_list")
+
+    return JSONResponse({"gpts": gpts}, status_code=200)
+
 @router.post("/chat/{gpt_id}/{gpt_name}")
 async def chat(request: Request, gpt_id: str, gpt_name: str, user: Annotated[dict, Depends(azure_scheme)], user_message: str = Form(...), params: str = Form(...), uploadedImage: UploadFile = File(...)):
     if not user_message:
@@ -117,12 +131,12 @@ async def chat(request: Request, gpt_id: str, gpt_name: str, user: Annotated[dic
             return JSONResponse({"error": "GPT not found."}, status_code=404)
         
         streaming_response = False
-        response = await generate_response(streaming_response, user_message, model_configuration, gpt, uploadedImage)
+        response = await generate_response(streaming_response, user_message, model_configuration, gpt, uploadedImage, is_cache_bypassed(request.headers))
     except HTTPException as he:
         logger.error(f"Error while getting response from Model. Details : \n {he.detail}", exc_info=True)
         return JSONResponse({"error": f"Error while getting response from Model. Details : \n {he.detail}"}, status_code=500)
 
-    return JSONResponse({"response": response['model_response'], "total_tokens" : response['total_tokens'] if response['total_tokens'] else 0, "follow_up_questions": response['follow_up_questions'] }, status_code=200)
+    return JSONResponse({"response": response['model_response'], "total_tokens" : response['total_tokens'] if response['total_tokens'] else 0, "follow_up_questions": response['follow_up_questions'], "stage_timings": response.get('stage_timings', {}) }, status_code=200)
 
 @router.post("/chat/stream/{gpt_id}/{gpt_name}")
 async def chat(request: Request, gpt_id: str, gpt_name: str, user: Annotated[dict, Depends(azure_scheme)], user_message: str = Form(...), params: str = Form(...), uploadedImage: UploadFile = File(...)):
@@ -145,7 +159,7 @@ async def chat(request: Request, gpt_id: str, gpt_name: str, user: Annotated[dic
             return JSONResponse({"error": "GPT not found."}, status_code=404)
         
         streaming_response = True
-        return await generate_response(streaming_response, user_message, model_configuration, gpt, uploadedImage)
+        return await generate_response(streaming_response, user_message, model_configuration, gpt, uploadedImage, is_cache_bypassed(request.headers))
     except HTTPException as he:
         logger.error(f"Error while getting response from Model. Details : \n {he.detail}", exc_info=True)
         return JSONResponse({"error": f"Error while getting response from Model. Details : \n {he.detail}"}, status_code=500)
@@ -308,6 +322,39 @@ async def delete_all_gpts(request: Request, user: Annotated[dict, Depends(azure_
     
     return response
     
+@router.get("/chat_history_page/{gpt_id}/{gpt_name}")
+async def get_chat_history_page(gpt_id: str, gpt_name: str, user: Annotated[dict, Depends(azure_scheme)], page_size: int = CHAT_HISTORY_PAGE_SIZE, before: str = None, after: str = None, use_case_id: str = None):
+    """Keyset paginated chat history: pass the returned before / after cursor to page towards older / newer messages."""
+    logger.info(f"Fetching chat history page for GPT: {gpt_id} Name: {gpt_name} before: {before} after: {after}")
+
+    loggedUser = user.name  # Extract the username from the user token payload
+    logger.info(f"Logged User: {loggedUser}")
+
+    try:
+        page = await fetch_chat_history_page(gpt_id, page_size, before=before, after=after, use_case_id=use_case_id)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    return JSONResponse(page, status_code=200)
+
+@router.get("/chat_history_export/{gpt_id}/{gpt_name}")
+async def export_chat_history(gpt_id: str, gpt_name: str, user: Annotated[dict, Depends(azure_scheme)], use_case_id: str = None):
+    """The whole chat history as NDJSON (one message per line, oldest first), streamed from the database cursor."""
+    logger.info(f"Exporting chat history for GPT: {gpt_id} Name: {gpt_name}")
+
+    loggedUser = user.name  # Extract the username from the user token payload
+    logger.info(f"Logged User: {loggedUser}")
+
+    async def ndjson_lines():
+        async for chat in iter_chat_history(gpt_id, use_case_id=use_case_id, profile="chat_ui"):
+            yield json.dumps(chat) + "\n"
+
+    return StreamingResponse(
+        ndjson_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={gpt_name}_chat_history.ndjson"}
+    )
+
 @router.get("/chat_history/{gpt_id}/{gpt_name}")
 async def get_chat_history(gpt_id: str, gpt_name: str, user: Annotated[dict, Depends(azure_scheme)]):
     logger.info(f"Fetching chat history for GPT: {gpt_id} Name: {gpt_name}")
@@ -315,7 +362,7 @@ async def get_chat_history(gpt_id: str, gpt_name: str, user: Annotated[dict, Dep
     loggedUser = user.name  # Extract the username from the user token payload
     logger.info(f"Logged User: {loggedUser}")
 
-    chat_history = await fetch_chat_history(gpt_id, gpt_name, max_tokens_in_conversation)  # Fetch chat history from MongoDB
+    chat_history = await fetch_chat_history(gpt_id, gpt_name, max_tokens_in_conversation, profile="chat_ui")  # Fetch chat history from MongoDB
     #logger.info(f"Chat history {chat_history}")
 
     # After saving the image, read its contents and encode the image as base64
@@ -343,9 +390,9 @@ async def get_chat_history_for_use_case(gpt_id: str, gpt_name: str, user: Annota
     logger.info(f"Logged User: {loggedUser}")
 
     if use_case_id == "all":
-        chat_history = await fetch_chat_history(gpt_id, gpt_name, max_tokens_in_conversation)
+        chat_history = await fetch_chat_history(gpt_id, gpt_name, max_tokens_in_conversation, profile="chat_ui")
     else:
-        chat_history = await fetch_chat_history_for_use_case(use_case_id, gpt_id, gpt_name, max_tokens_in_conversation)  # Fetch chat history from MongoDB
+        chat_history = await fetch_chat_history_for_use_case(use_case_id, gpt_id, gpt_name, max_tokens_in_conversation, profile="chat_ui")  # Fetch chat history from MongoDB
     logger.info(f"Chat history {chat_history}")
 
     # After saving the image, read its contents and encode the image as base64
@@ -609,8 +656,8 @@ async def getDeployments2():
         
         logger.info("Starting to fetch deployments...")
 
-        # Get all deployments in the subscription
-        deployments = client.deployments.list(resource_group_name=resource_group, account_name=openai_account)
+        # Get all deployments in the subscription. The management SDK is sync, so the paged listing runs in the blocking I/O pool
+        deployments = await run_blocking(lambda: list(client.deployments.list(resource_group_name=resource_group, account_name=openai_account)))
 
         if not deployments:
             logger.warning("No deployments found.")
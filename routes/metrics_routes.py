@@ -0,0 +1,186 @@
+import logging
+from typing import Annotated
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+
+from auth_config import azure_scheme, require_admin
+from dependencies import NiaAzureOpenAIClient
+from completion_executor import completion_executor
+from response_cache import response_cache
+from search_cache import search_cache
+from search_context import search_context_compactor
+from loop_monitor import LoopLagMonitor
+from intent_router import intent_router
+import mongo_indexes
+from mongo_client import mongo_db_instance
+from message_writer import message_writer
+from message_archiver import message_archiver
+from entity_cache import entity_cache
+from rate_limiter import rate_limiter
+from token_ledger import ledger_stats
+from context_builder import context_builder
+from conversation_summarizer import conversation_summarizer
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# create the router
+router = APIRouter()
+
+@router.get("/openai/endpoints")
+async def get_openai_endpoint_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Load, latency and circuit breaker state of every Azure OpenAI endpoint in the pool."""
+    try:
+        nia_azure_client = await NiaAzureOpenAIClient.create()
+        response = JSONResponse({"endpoints": nia_azure_client.get_pool_stats()}, status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching endpoint metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching endpoint metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/openai/rate_limits")
+async def get_openai_rate_limit_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Client-side TPM/RPM bucket state per (endpoint, deployment)."""
+    return JSONResponse({"buckets": rate_limiter.snapshot()}, status_code=200)
+
+@router.get("/openai/executor")
+async def get_completion_executor_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Success, failure and fallback latency counters of the completion executor."""
+    return JSONResponse(completion_executor.stats(), status_code=200)
+
+@router.get("/response_cache")
+async def get_response_cache_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Hit, miss and eviction counters of the response cache."""
+    return JSONResponse(response_cache.stats(), status_code=200)
+
+@router.get("/search_cache")
+async def get_search_cache_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Hit, miss and invalidation counters of the Azure AI Search result cache."""
+    return JSONResponse(search_cache.stats(), status_code=200)
+
+@router.get("/event_loop")
+async def get_event_loop_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Event loop lag percentiles and stall count."""
+    return JSONResponse(LoopLagMonitor.stats(), status_code=200)
+
+@router.get("/intent_router")
+async def get_intent_router_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Share of RAG queries routed locally instead of through the function calling model."""
+    return JSONResponse(intent_router.stats(), status_code=200)
+
+@router.get("/mongo/indexes")
+async def get_mongo_index_report(user: Annotated[dict, Depends(azure_scheme)]):
+    """Declared indexes and the explain() plan of the hot queries, as of the last verification."""
+    return JSONResponse(mongo_indexes.last_index_report, status_code=200)
+
+@router.post("/mongo/indexes/refresh")
+async def refresh_mongo_indexes(user: Annotated[dict, Depends(require_admin)]):
+    """Create the declared indexes (createIndexes on the production collections) and re-run the verification. Admin only."""
+    try:
+        response = JSONResponse(await mongo_indexes.bootstrap_indexes(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while verifying MongoDB indexes: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while verifying MongoDB indexes: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/mongo/message_writer")
+async def get_message_writer_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Durability mode, queue depth and batch sizes of the chat message writer."""
+    try:
+        response = JSONResponse(message_writer.stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching message writer metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching message writer metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/mongo/archiver")
+async def get_message_archiver_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Messages archived and bytes reclaimed by the hidden message archiver."""
+    try:
+        response = JSONResponse(message_archiver.stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching message archiver metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching message archiver metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.post("/mongo/archiver/run")
+async def run_message_archiver(user: Annotated[dict, Depends(require_admin)]):
+    """Archive the hidden messages past their retention period now (copy, then delete). Admin only."""
+    try:
+        response = JSONResponse(await message_archiver.run_once(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while running the message archiver: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while running the message archiver: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/mongo/pool")
+async def get_mongo_pool_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Connections in use and checkout wait times of this worker's MongoDB pool."""
+    try:
+        response = JSONResponse(mongo_db_instance.get_pool_stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching MongoDB pool metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching MongoDB pool metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/mongo/entity_cache")
+async def get_entity_cache_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Hit ratio and size of the gpt / usecase document cache."""
+    try:
+        response = JSONResponse(entity_cache.stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching entity cache metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching entity cache metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/token_ledger")
+async def get_token_ledger_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Hit ratio of the per message token count caches (one per encoding) and the loaded tokenizers."""
+    try:
+        response = JSONResponse(ledger_stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching token ledger metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching token ledger metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/context_builder")
+async def get_context_builder_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """History kept and dropped, summaries used and retrieved context truncated to fit the prompt budgets."""
+    try:
+        response = JSONResponse(context_builder.stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching context builder metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching context builder metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/conversation_summarizer")
+async def get_conversation_summarizer_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Background summarization runs, summary versions written and messages folded into them."""
+    try:
+        response = JSONResponse(conversation_summarizer.stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching conversation summarizer metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching conversation summarizer metrics: {e}"}, status_code=500)
+
+    return response
+
+@router.get("/search_context")
+async def get_search_context_metrics(user: Annotated[dict, Depends(azure_scheme)]):
+    """Search documents kept and dropped (low score, duplicate, over budget) and tokens of the retrieved context."""
+    try:
+        response = JSONResponse(search_context_compactor.stats(), status_code=200)
+    except Exception as e:
+        logger.error(f"Error occurred while fetching search context metrics: {e}", exc_info=True)
+        response = JSONResponse({"error": f"Error occurred while fetching search context metrics: {e}"}, status_code=500)
+
+    return response
@@ -0,0 +1,124 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from azure.identity.aio import ClientSecretCredential
+from azure.search.documents.aio import SearchClient
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+SEARCH_ENDPOINT_URL = os.getenv("SEARCH_ENDPOINT_URL")
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 60))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 256))
+
+class SearchClientPool:
+    """One long lived async SearchClient per index, sharing a single credential and HTTP pipeline per index."""
+
+    _clients: dict[str, SearchClient] = {}
+    _credential: ClientSecretCredential = None
+    _lock = asyncio.Lock()
+
+    @classmethod
+    async def get_client(cls, index_name: str) -> SearchClient:
+        client = cls._clients.get(index_name)
+        if client is not None:
+            return client
+
+        async with cls._lock:
+            if index_name not in cls._clients:
+                if cls._credential is None:
+                    cls._credential = ClientSecretCredential(os.getenv("TENANT_ID"), os.getenv("CLIENT_ID"), os.getenv("CLIENT_SECRET_VALUE"))
+                cls._clients[index_name] = SearchClient(endpoint=SEARCH_ENDPOINT_URL, index_name=index_name, credential=cls._credential)
+                logger.info(f"Created pooled search client for index {index_name}")
+            return cls._clients[index_name]
+
+    @classmethod
+    async def close(cls):
+        for index_name, client in list(cls._clients.items()):
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"Error while closing search client for index {index_name}: {e}")
+        cls._clients.clear()
+
+        if cls._credential is not None:
+            await cls._credential.close()
+            cls._credential = None
+
+class SearchResultCache:
+    """Short lived TTL + LRU cache of Azure AI Search results, keyed by (index, semantic config, query, fields, top)."""
+
+    def __init__(self, max_entries: int = SEARCH_CACHE_MAX_ENTRIES, ttl_seconds: float = SEARCH_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[tuple, tuple] = OrderedDict()  # key -> (expires_at, gpt_id, results)
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def build_key(index_name: str, semantic_configuration_name: str, search_text: str, select: list[str], top: int) -> tuple:
+        return (index_name, semantic_configuration_name, " ".join((search_text or "").split()), tuple(select or ()), top)
+
+    def get(self, key: tuple) -> list:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self._stats["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return entry[2]
+
+    def put(self, key: tuple, results: list, gpt_id: str = None):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, gpt_id, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, index_name: str = None, gpt_id: str = None):
+        """Drop cached results of an index and/or of a gpt. Without arguments the whole cache is cleared."""
+        keys = [
+            key for key, (_, entry_gpt_id, _) in self._entries.items()
+            if (index_name is None and gpt_id is None) or key[0] == index_name or (gpt_id is not None and entry_gpt_id == gpt_id)
+        ]
+        for key in keys:
+            del self._entries[key]
+
+        self._stats["invalidations"] += 1
+        logger.info(f"Invalidated {len(keys)} cached search result(s) for index={index_name} gpt_id={gpt_id}")
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["entries"] = len(self._entries)
+        return stats
+
+async def cached_search(index_name: str, semantic_configuration_name: str, search_text: str, select: list[str], top: int, gpt_id: str = None) -> list:
+    """Semantic search through the pooled client, served from the result cache when possible."""
+    key = search_cache.build_key(index_name, semantic_configuration_name, search_text, select, top)
+
+    results = search_cache.get(key)
+    if results is not None:
+        logger.info(f"Search cache hit for index {index_name}")
+        return results
+
+    client = await SearchClientPool.get_client(index_name)
+    search_results = await client.search(search_text=search_text,
+                                         top=top,
+                                         include_total_count=True,
+                                         query_type="semantic",
+                                         semantic_configuration_name=semantic_configuration_name,
+                                         select=select)
+    results = [result async for result in search_results]
+
+    search_cache.put(key, results, gpt_id)
+    return results
+
+# Process wide search result cache
+search_cache = SearchResultCache()
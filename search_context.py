@@ -0,0 +1,135 @@
+import os
+import re
+import json
+import logging
+from dotenv import load_dotenv
+
+from token_ledger import ledger_for
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+SEARCH_CONTEXT_COMPACTION_ENABLED = os.getenv("SEARCH_CONTEXT_COMPACTION_ENABLED", "true").lower() == "true"
+# Documents below this score are dropped. The semantic reranker scores from 0 to 4, plain BM25 scores are unbounded.
+SEARCH_CONTEXT_MIN_RERANKER_SCORE = float(os.getenv("SEARCH_CONTEXT_MIN_RERANKER_SCORE", 1.0))
+# The best documents are kept whatever their score, so filter style lookups (e.g. by order id) still get an answer
+SEARCH_CONTEXT_MIN_DOCUMENTS = int(os.getenv("SEARCH_CONTEXT_MIN_DOCUMENTS", 3))
+# Documents whose words overlap this much (Jaccard) with a better ranked one are dropped as duplicates
+SEARCH_CONTEXT_DUPLICATE_SIMILARITY = float(os.getenv("SEARCH_CONTEXT_DUPLICATE_SIMILARITY", 0.9))
+# Token cap of one formatted result set
+SEARCH_CONTEXT_MAX_TOKENS = int(os.getenv("SEARCH_CONTEXT_MAX_TOKENS", 8000))
+# json: one compact JSON array, table: a header row and one pipe separated row per document
+SEARCH_CONTEXT_FORMAT = os.getenv("SEARCH_CONTEXT_FORMAT", "json").lower()
+# Fields that are never sent to the model
+SEARCH_CONTEXT_EXCLUDED_FIELDS = [field.strip() for field in os.getenv("SEARCH_CONTEXT_EXCLUDED_FIELDS", "password").split(",") if field.strip()]
+
+RERANKER_SCORE = "@search.reranker_score"
+SEARCH_SCORE = "@search.score"
+
+class SearchContextCompactor:
+    """
+    Turns Azure AI Search results into the retrieved context of the prompt: ranked by semantic score, low scoring
+    and near duplicate documents dropped, search metadata and excluded fields stripped, formatted without
+    indentation and cut at SEARCH_CONTEXT_MAX_TOKENS (whole documents only).
+    """
+
+    def __init__(self):
+        self._stats = {"result_sets": 0, "documents_in": 0, "documents_out": 0, "dropped_low_score": 0, "dropped_duplicates": 0,
+                       "dropped_over_budget": 0, "tokens_out": 0}
+
+    def selectable_fields(self, fields: list[str]) -> list[str]:
+        """The fields to request from the index, without the excluded ones."""
+        return [field for field in fields if field not in SEARCH_CONTEXT_EXCLUDED_FIELDS]
+
+    def score(self, document: dict) -> float:
+        score = document.get(RERANKER_SCORE)
+        return float(score if score is not None else document.get(SEARCH_SCORE) or 0.0)
+
+    def compact(self, results: list, max_tokens: int = SEARCH_CONTEXT_MAX_TOKENS) -> str:
+        """Formatted retrieved context of one result set."""
+        if not SEARCH_CONTEXT_COMPACTION_ENABLED:
+            return json.dumps(results, default=lambda x: x.__dict__, indent=2)
+
+        # Step 1: Rank by semantic score (the reranker score when the query was semantic)
+        ranked = sorted(results, key=self.score, reverse=True)
+        uses_reranker = any(document.get(RERANKER_SCORE) is not None for document in ranked)
+
+        # Step 2: Drop low scoring documents, keeping the best SEARCH_CONTEXT_MIN_DOCUMENTS
+        kept = [document for index, document in enumerate(ranked)
+                if index < SEARCH_CONTEXT_MIN_DOCUMENTS or not uses_reranker or self.score(document) >= SEARCH_CONTEXT_MIN_RERANKER_SCORE]
+        dropped_low_score = len(ranked) - len(kept)
+
+        # Step 3: Strip search metadata, excluded and empty fields, then drop near duplicates of better ranked documents
+        documents, signatures = [], []
+        for document in kept:
+            fields = {name: value for name, value in document.items()
+                      if not name.startswith("@search.") and name not in SEARCH_CONTEXT_EXCLUDED_FIELDS and value not in (None, "", [], {})}
+            signature = set(re.findall(r"\w+", json.dumps(fields, default=str, ensure_ascii=False).lower()))
+            if any(self._similarity(signature, other) >= SEARCH_CONTEXT_DUPLICATE_SIMILARITY for other in signatures):
+                continue
+            documents.append(fields)
+            signatures.append(signature)
+        dropped_duplicates = len(kept) - len(documents)
+
+        # Step 4: Format and cut at the token cap
+        context, tokens, included = self._format(documents, max_tokens)
+
+        self._stats["result_sets"] += 1
+        self._stats["documents_in"] += len(results)
+        self._stats["documents_out"] += included
+        self._stats["dropped_low_score"] += dropped_low_score
+        self._stats["dropped_duplicates"] += dropped_duplicates
+        self._stats["dropped_over_budget"] += len(documents) - included
+        self._stats["tokens_out"] += tokens
+        logger.info(f"Search context compacted: {len(results)} document(s) in, {included} out ({dropped_low_score} low score, "
+                    f"{dropped_duplicates} duplicate, {len(documents) - included} over budget), {tokens} tokens")
+        return context
+
+    def _similarity(self, first: set, second: set) -> float:
+        if not first and not second:
+            return 1.0
+        return len(first & second) / len(first | second)
+
+    def _format(self, documents: list[dict], max_tokens: int) -> tuple:
+        """(context, tokens, documents included). Documents are added whole while they fit."""
+        ledger = ledger_for()
+
+        if SEARCH_CONTEXT_FORMAT == "table":
+            columns = list(dict.fromkeys(name for document in documents for name in document))
+            lines = [" | ".join(columns)] if documents else []
+            rows = [" | ".join(self._cell(document.get(name)) for name in columns) for document in documents]
+        else:
+            lines = []
+            rows = [json.dumps(document, default=str, ensure_ascii=False, separators=(",", ":")) for document in documents]
+
+        tokens = sum(ledger.count_many(lines)) if lines else 0
+        included = 0
+        for row, row_tokens in zip(rows, ledger.count_many(rows) if rows else []):
+            if tokens + row_tokens > max_tokens:
+                break
+            lines.append(row)
+            tokens += row_tokens
+            included += 1
+
+        if SEARCH_CONTEXT_FORMAT == "table":
+            return ("\n".join(lines) if included else ""), tokens, included
+        return "[" + ",\n".join(lines) + "]", tokens, included
+
+    def _cell(self, value) -> str:
+        if value is None:
+            return ""
+        text = value if isinstance(value, str) else json.dumps(value, default=str, ensure_ascii=False, separators=(",", ":"))
+        return " ".join(text.replace("|", "/").split())
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["enabled"] = SEARCH_CONTEXT_COMPACTION_ENABLED
+        stats["format"] = SEARCH_CONTEXT_FORMAT
+        stats["max_tokens"] = SEARCH_CONTEXT_MAX_TOKENS
+        stats["min_reranker_score"] = SEARCH_CONTEXT_MIN_RERANKER_SCORE
+        return stats
+
+# Process wide compactor used by get_data_from_azure_search
+search_context_compactor = SearchContextCompactor()
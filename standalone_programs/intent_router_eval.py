@@ -0,0 +1,101 @@
+import sys
+import json
+import time
+from collections import Counter
+
+sys.path.append(".")
+from intent_router import IntentModel, INTENT_ROUTER_TOOL_CALL_LOG
+
+"""
+Offline evaluation of the local intent router against the decisions of the function calling model.
+Ground truth is the tool call log written by determineFunctionCalling when INTENT_ROUTER_TOOL_CALL_LOG_ENABLED=true (one JSON record per LLM tool call).
+The log is split in two: the first part trains one model per gpt (like the router does), the second part is evaluated.
+Run it before setting INTENT_ROUTER_ENABLED=true, and after changing the INTENT_ROUTER_MIN_* thresholds.
+
+    python standalone_programs/intent_router_eval.py [tool_call_log.jsonl] [train_ratio]
+"""
+
+def load_records(path: str) -> list[dict]:
+    records = []
+    with open(path, "r", encoding="utf-8") as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+                if record.get("query") and record.get("use_case"):
+                    records.append(record)
+            except ValueError:
+                continue
+    return records
+
+def build_models(records: list[dict]) -> dict:
+    """One model per gpt, from the use case names and the logged queries of the gpt."""
+    by_gpt = {}
+    for record in records:
+        by_gpt.setdefault(str(record.get("gpt_id")), []).append(record)
+
+    models = {}
+    for gpt_id, gpt_records in by_gpt.items():
+        model = IntentModel()
+        model.add_usecases([{"name": name} for name in {record["use_case"] for record in gpt_records}])
+        for record in gpt_records:
+            model.add_example(record["use_case"], record["query"])
+        models[gpt_id] = model.build()
+    return models
+
+def evaluate(records: list[dict], train_ratio: float):
+    split = int(len(records) * train_ratio)
+    train, test = records[:split], records[split:]
+    models = build_models(train)
+
+    routed = 0
+    use_case_correct = 0
+    extra_data_correct = 0
+    top1_correct = 0
+    confusion = Counter()
+    route_time_us = 0.0
+
+    for record in test:
+        model = models.get(str(record.get("gpt_id")))
+        if model is None:
+            continue
+
+        started = time.perf_counter()
+        decision = model.decide(record["query"], record.get("current_use_case"), "")
+        route_time_us += (time.perf_counter() - started) * 1_000_000
+
+        ranking = model.classify(record["query"])
+        if ranking and ranking[0][0] == record["use_case"]:
+            top1_correct += 1
+
+        if decision is None:
+            continue
+
+        routed += 1
+        if decision.use_case == record["use_case"]:
+            use_case_correct += 1
+        else:
+            confusion[(record["use_case"], decision.use_case)] += 1
+        if decision.get_extra_data == bool(record.get("get_extra_data")):
+            extra_data_correct += 1
+
+    total = len(test)
+    print(f"Records: {len(records)} (train {len(train)}, test {total})")
+    if total == 0:
+        return
+
+    print(f"Top-1 use case accuracy (all test queries): {top1_correct / total:.1%}")
+    print(f"Coverage (routed without the LLM): {routed}/{total} = {routed / total:.1%}")
+    if routed:
+        print(f"Use case agreement with the LLM on routed queries: {use_case_correct / routed:.1%}")
+        print(f"get_extra_data agreement with the LLM on routed queries: {extra_data_correct / routed:.1%}")
+    print(f"Average routing time: {route_time_us / total:.1f} us")
+
+    if confusion:
+        print("Most frequent disagreements (LLM -> router):")
+        for (expected, actual), count in confusion.most_common(10):
+            print(f"  {expected} -> {actual}: {count}")
+
+if __name__ == "__main__":
+    log_path = sys.argv[1] if len(sys.argv) > 1 else INTENT_ROUTER_TOOL_CALL_LOG
+    train_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    evaluate(load_records(log_path), train_ratio)
@@ -0,0 +1,76 @@
+"""
+Fires concurrent chat requests at a running instance and reports the event loop lag seen by the server.
+With LOAD_TEST_BEARER_TOKEN the secured /chat routes are used and the lag is read from /metrics/event_loop
+(LoopLagMonitor, also secured). Without a token the unsecured /backend/chat routes are used and only client latencies are reported.
+
+    python standalone_programs/loop_lag_load_test.py <gpt_id> <gpt_name> [concurrency]
+"""
+import os
+import json
+import time
+import asyncio
+import httpx
+from dotenv import load_dotenv # For environment variables (recommended)
+
+load_dotenv()  # Load environment variables from .env file
+
+BASE_URL = os.getenv("LOAD_TEST_BASE_URL", "http://localhost:8000")
+BEARER_TOKEN = os.getenv("LOAD_TEST_BEARER_TOKEN")
+USER_MESSAGE = os.getenv("LOAD_TEST_USER_MESSAGE", "What are the top selling products this month?")
+MODEL_PARAMS = {"max_tokens": 800, "temperature": 0.7, "top_p": 0.95, "frequency_penalty": 0, "presence_penalty": 0}
+
+# The unsecured chat routes are mounted under /backend
+CHAT_PREFIX = "" if BEARER_TOKEN else "/backend"
+
+async def get_loop_lag(client: httpx.AsyncClient) -> dict:
+    """Event loop metrics of the server, None when they cannot be read (the metrics routes need a bearer token)."""
+    try:
+        response = await client.get("/metrics/event_loop")
+    except Exception as e:
+        print(f"Event loop metrics request failed: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Event loop metrics unavailable: HTTP {response.status_code}")
+        return None
+    return response.json()
+
+async def send_chat(client: httpx.AsyncClient, gpt_id: str, gpt_name: str, streaming: bool):
+    path = f"{CHAT_PREFIX}/chat/stream/{gpt_id}/{gpt_name}" if streaming else f"{CHAT_PREFIX}/chat/{gpt_id}/{gpt_name}"
+    started = time.monotonic()
+    try:
+        response = await client.post(path,
+                                     data={"user_message": USER_MESSAGE, "params": json.dumps(MODEL_PARAMS)},
+                                     files={"uploadedImage": ("blob", b"", "application/octet-stream")},
+                                     headers={"x-nia-cache-bypass": "true"})
+        return response.status_code, time.monotonic() - started
+    except Exception as e:
+        print(f"Request failed: {e}")
+        return None, time.monotonic() - started
+
+async def main(gpt_id: str, gpt_name: str, concurrency: int):
+    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"} if BEARER_TOKEN else {}
+    async with httpx.AsyncClient(base_url=BASE_URL, headers=headers, timeout=300) as client:
+        before = await get_loop_lag(client) if BEARER_TOKEN else None
+
+        started = time.monotonic()
+        results = await asyncio.gather(*[send_chat(client, gpt_id, gpt_name, i % 2 == 0) for i in range(concurrency)])
+        elapsed = time.monotonic() - started
+
+        after = await get_loop_lag(client) if before is not None else None
+
+    latencies = sorted(latency for _, latency in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"{concurrency} concurrent chats completed in {elapsed:.1f}s. Status codes: {statuses}")
+    print(f"Client latency p50={latencies[len(latencies) // 2]:.2f}s p99={latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.2f}s")
+    if after is not None:
+        print(f"Server event loop lag: p99={after['window_p99_lag_ms']} ms, max={after['window_max_lag_ms']} ms, stalls during test={after['stalls'] - before['stalls']}")
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        print("Usage: python standalone_programs/loop_lag_load_test.py <gpt_id> <gpt_name> [concurrency]")
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 200))
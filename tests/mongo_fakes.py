@@ -0,0 +1,147 @@
+"""
+In-memory stand-in for the Motor collections used by the chat history code. Supports the query operators,
+sorts and bulk writes these modules send, with BSON comparison rules: values of different types never match
+a range operator, and legacy string dates sort before native dates.
+"""
+import copy
+import datetime as date
+from bson import ObjectId
+from pymongo import ASCENDING, InsertOne
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+
+def bson_key(value) -> tuple:
+    """Sort key following the BSON type order (null, numbers, strings, ObjectId, booleans, dates)."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, ObjectId):
+        return (7, value)
+    if isinstance(value, date.datetime):
+        return (9, value if value.tzinfo else value.replace(tzinfo=date.timezone.utc))
+    return (5, str(value))
+
+def _values(document: dict, path: str) -> list:
+    """Values at a dotted path, descending into arrays like MongoDB does."""
+    values = [document]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, dict) and part in item:
+                    found.append(item[part])
+        values = found
+    return [item for value in values for item in (value if isinstance(value, list) else [value])]
+
+def _compare(value, other, operator: str) -> bool:
+    first, second = bson_key(value), bson_key(other)
+    if first[0] != second[0]:
+        return False
+    return {"$lt": first < second, "$lte": first <= second, "$gt": first > second, "$gte": first >= second}[operator]
+
+def _equal(value, other) -> bool:
+    # Through bson_key, so naive (stored) and aware (queried) dates of the same instant are equal
+    return bson_key(value) == bson_key(other) if not isinstance(value, (dict, list)) else value == other
+
+def _matches_condition(values: list, condition) -> bool:
+    if not isinstance(condition, dict) or not any(key.startswith("$") for key in condition):
+        return any(_equal(value, condition) for value in values)
+
+    for operator, operand in condition.items():
+        if operator == "$ne":
+            if any(_equal(value, operand) for value in values):
+                return False
+        elif operator == "$in":
+            if not any(_equal(value, candidate) for value in values for candidate in operand):
+                return False
+        elif operator == "$type":
+            expected = {"string": str, "date": date.datetime}[operand]
+            if not any(isinstance(value, expected) for value in values):
+                return False
+        elif not any(_compare(value, operand, operator) for value in values):
+            return False
+    return True
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif not _matches_condition(_values(document, key), condition):
+            return False
+    return True
+
+class FakeCursor:
+    def __init__(self, documents: list):
+        self._documents = documents
+        self._limit = 0
+
+    def sort(self, key, direction=None):
+        keys = key if isinstance(key, list) else [(key, direction if direction is not None else ASCENDING)]
+        # Stable sorts from the last key to the first give the compound order
+        for field, field_direction in reversed(keys):
+            self._documents.sort(key=lambda document: bson_key(document.get(field)), reverse=field_direction != ASCENDING)
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def _selected(self) -> list:
+        return self._documents[:self._limit] if self._limit else self._documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._selected():
+            yield document
+
+    async def to_list(self, length=None):
+        return list(self._selected())
+
+class FakeCollection:
+    def __init__(self, documents: list = None):
+        self.documents = [copy.deepcopy(document) for document in documents or []]
+        self.bulk_writes = []
+
+    def find(self, query: dict = None, projection: dict = None) -> FakeCursor:
+        found = [copy.deepcopy(document) for document in self.documents if matches(document, query)]
+        if projection:
+            fields = {field.split(".")[0] for field, included in projection.items() if included}
+            found = [{key: value for key, value in document.items() if key == "_id" or key in fields} for document in found]
+        return FakeCursor(found)
+
+    async def find_one(self, query: dict = None, sort: list = None):
+        cursor = self.find(query)
+        if sort:
+            cursor.sort(sort)
+        documents = await cursor.to_list()
+        return documents[0] if documents else None
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        """InsertOne only, with the duplicate _id errors and error details of the server."""
+        self.bulk_writes.append(len(operations))
+        inserted, errors = 0, []
+        for index, operation in enumerate(operations):
+            assert isinstance(operation, InsertOne), "FakeCollection.bulk_write only supports InsertOne"
+            document = operation._doc
+            if any(existing["_id"] == document["_id"] for existing in self.documents):
+                errors.append({"index": index, "code": DUPLICATE_KEY_ERROR, "errmsg": "E11000 duplicate key error"})
+                if ordered:
+                    break
+                continue
+            self.documents.append(copy.deepcopy(document))
+            inserted += 1
+
+        if errors:
+            raise BulkWriteError({"nInserted": inserted, "nUpserted": 0, "nModified": 0, "writeErrors": errors})
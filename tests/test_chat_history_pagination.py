@@ -0,0 +1,114 @@
+import asyncio
+import datetime as date
+import pytest
+from bson import ObjectId
+
+import mongo_service
+from message_buckets import page_key
+from mongo_fakes import FakeCollection, matches
+
+GPT_ID = ObjectId()
+
+def native(minute: int) -> date.datetime:
+    # Naive UTC, as returned by the (not tz_aware) Motor client
+    return date.datetime(2024, 5, 1, 12, minute)
+
+def legacy(minute: int) -> str:
+    return f"2024-04-30T09:{minute:02d}:00.000000"
+
+def message(created_at, content: str, **fields) -> dict:
+    return {"_id": ObjectId(), "gpt_id": GPT_ID, "role": "user", "content": content, "created_at": created_at, "hiddenFlag": False, **fields}
+
+def mixed_history() -> list:
+    """Legacy string and native dates, with ties on created_at, in (created_at, _id) order."""
+    return [
+        message(legacy(1), "legacy 1"),
+        message(legacy(2), "legacy 2a"),
+        message(legacy(2), "legacy 2b"),
+        message(legacy(3), "legacy 3"),
+        message(native(1), "native 1"),
+        message(native(2), "native 2a"),
+        message(native(2), "native 2b"),
+        message(native(3), "native 3"),
+    ]
+
+@pytest.mark.parametrize("created_at", [native(5), native(5).replace(tzinfo=date.timezone.utc), legacy(5)])
+def test_cursor_round_trip(created_at):
+    chat = message(created_at, "hello")
+
+    decoded_at, decoded_id = mongo_service.decode_history_cursor(mongo_service.encode_history_cursor(chat))
+
+    assert decoded_id == chat["_id"]
+    assert type(decoded_at) is type(created_at)
+    assert page_key({"_id": decoded_id, "created_at": decoded_at}) == page_key(chat)
+
+@pytest.mark.parametrize("cursor", ["not a cursor", "eyJjIjogMX0="])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        mongo_service.decode_history_cursor(cursor)
+
+@pytest.mark.parametrize("older", [True, False])
+def test_keyset_filter_matches_exactly_the_messages_past_the_cursor(older):
+    history = mixed_history()
+    assert sorted(history, key=page_key) == history
+
+    for position, chat in enumerate(history):
+        cursor = mongo_service.decode_history_cursor(mongo_service.encode_history_cursor(chat))
+        query = mongo_service._keyset_filter(cursor, older)
+
+        selected = [other for other in history if matches(other, query)]
+
+        assert selected == (history[:position] if older else history[position + 1:]), f"cursor at {chat['content']}"
+
+@pytest.fixture
+def messages(monkeypatch):
+    collection = FakeCollection(mixed_history() + [
+        message(native(4), "hidden", hiddenFlag=True),
+        message(native(4), "system prompt", role="system"),
+        message(native(4), "other gpt", gpt_id=ObjectId()),
+    ])
+
+    async def get_collection(collection_name: str):
+        assert collection_name == "messages"
+        return collection
+
+    monkeypatch.setattr(mongo_service, "get_collection", get_collection)
+    monkeypatch.setattr(mongo_service, "MESSAGE_BUCKETS_ENABLED", False)
+    return collection
+
+def test_paging_through_mixed_history_returns_every_message_once(messages):
+    expected = [chat["content"] for chat in mixed_history()]
+
+    async def page_backwards() -> tuple:
+        seen, pages = [], []
+        page = await mongo_service.fetch_chat_history_page(str(GPT_ID), page_size=3)
+        while True:
+            pages.append(page)
+            seen = [chat["content"] for chat in page["chat_history"]] + seen
+            if page["before"] is None:
+                return seen, pages
+            page = await mongo_service.fetch_chat_history_page(str(GPT_ID), page_size=3, before=page["before"])
+
+    seen, pages = asyncio.run(page_backwards())
+
+    assert seen == expected
+    assert [len(page["chat_history"]) for page in pages] == [3, 3, 2]
+    assert pages[0]["after"] is None
+
+    async def page_forwards(after: str) -> list:
+        seen = []
+        while after is not None:
+            page = await mongo_service.fetch_chat_history_page(str(GPT_ID), page_size=3, after=after)
+            seen += [chat["content"] for chat in page["chat_history"]]
+            after = page["after"]
+        return seen
+
+    oldest_page = pages[-1]
+    assert asyncio.run(page_forwards(oldest_page["after"])) == expected[len(oldest_page["chat_history"]):]
+
+def test_page_serializes_both_date_formats(messages):
+    page = asyncio.run(mongo_service.fetch_chat_history_page(str(GPT_ID), page_size=5))
+
+    assert [chat["created_at"] for chat in page["chat_history"]] == [
+        legacy(3), "2024-05-01T12:01:00+00:00", "2024-05-01T12:02:00+00:00", "2024-05-01T12:02:00+00:00", "2024-05-01T12:03:00+00:00",
+    ]
@@ -0,0 +1,89 @@
+import pytest
+
+import context_builder
+import token_ledger
+from context_builder import ContextBuilder, SUMMARY_PREFIX, TRUNCATION_MARKER
+from tokenizer_registry import tokenizer_registry
+
+DEPLOYMENT = "gpt-4o"
+USER_MESSAGE = "what now"
+
+class WordEncoder:
+    """One token per whitespace separated word, so the budgets below can be counted by hand."""
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return text.split()
+
+    def encode_batch(self, texts: list, disallowed_special=()) -> list:
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens: list) -> str:
+        return " ".join(tokens)
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(tokenizer_registry, "get_encoder", lambda encoding_name=None: WordEncoder())
+    monkeypatch.setattr(token_ledger, "_ledgers", {})
+
+def words(prefix: str, count: int) -> str:
+    return " ".join(f"{prefix}{number}" for number in range(count))
+
+def conversation() -> list:
+    """System prompt (6 tokens), 6 history messages (13 each), retrieved context (33) and the user message (5)."""
+    history = [{"role": "user" if number % 2 == 0 else "assistant", "content": words(f"h{number}-", 10)} for number in range(6)]
+    return [{"role": "system", "content": "You are helpful"}] + history + [
+        {"role": "user", "content": words("doc", 30)},
+        {"role": "user", "content": USER_MESSAGE},
+    ]
+
+# With an 80 token budget, 66 tokens are left after the system prompt, the user message and the reply priming
+@pytest.mark.parametrize("priorities, history_kept, summary_used, rag_kept, rag_truncated", [
+    ("rag,summary,history", 1, True, True, False),
+    ("rag,history,summary", 2, False, True, False),
+    ("summary,rag,history", 1, True, True, False),
+    ("summary,history,rag", 4, True, False, True),
+    ("history,summary,rag", 5, False, False, True),
+    ("history,rag,summary", 5, False, False, True),
+])
+def test_fit_under_a_tight_budget(monkeypatch, priorities, history_kept, summary_used, rag_kept, rag_truncated):
+    monkeypatch.setattr(context_builder, "CONTEXT_MAX_PROMPT_TOKENS", 80)
+    monkeypatch.setattr(context_builder, "CONTEXT_PRIORITIES", priorities.split(","))
+    conversations = conversation()
+    original = list(conversations)
+
+    report = ContextBuilder().fit(conversations, 6, DEPLOYMENT, USER_MESSAGE, summary="short summary of it")
+
+    assert report["budget"] == 80
+    assert report["prompt_tokens"] <= report["budget"]
+    assert (report["history_kept"], report["summary_used"], report["rag_truncated"]) == (history_kept, summary_used, rag_truncated)
+
+    # System prompt first, then the summary, the newest history messages whole, and the turn
+    expected = original[:1]
+    if summary_used:
+        expected.append({"role": "system", "content": f"{SUMMARY_PREFIX}short summary of it"})
+    expected += original[7 - history_kept:7]
+    expected += original[7:] if rag_kept else original[8:]
+    assert conversations == expected
+
+def test_retrieved_context_is_truncated_to_what_is_left(monkeypatch):
+    monkeypatch.setattr(context_builder, "CONTEXT_MAX_PROMPT_TOKENS", 100)
+    monkeypatch.setattr(context_builder, "CONTEXT_PRIORITIES", ["history", "rag"])
+    conversations = conversation()
+
+    report = ContextBuilder().fit(conversations, 6, DEPLOYMENT, USER_MESSAGE)
+
+    # 86 tokens left: 78 for the history, 8 for the retrieved context message (3 of overhead, 4 words and the marker)
+    assert report["history_kept"] == 6
+    assert report["rag_truncated"]
+    assert report["prompt_tokens"] == report["budget"]
+    assert conversations[-2]["content"] == "doc0 doc1 doc2 doc3" + TRUNCATION_MARKER
+    assert conversations[-1]["content"] == USER_MESSAGE
+
+def test_system_prompt_and_user_turn_are_kept_over_budget(monkeypatch):
+    monkeypatch.setattr(context_builder, "CONTEXT_MAX_PROMPT_TOKENS", 10)
+    conversations = conversation()
+
+    report = ContextBuilder().fit(conversations, 6, DEPLOYMENT, USER_MESSAGE, summary="short summary of it")
+
+    assert conversations == [conversation()[0], conversation()[-1]]
+    assert report["prompt_tokens"] > report["budget"]
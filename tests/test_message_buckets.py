@@ -0,0 +1,98 @@
+import asyncio
+import datetime as date
+import pytest
+from bson import ObjectId
+
+import message_buckets
+from mongo_fakes import FakeCollection, matches
+
+GPT_ID = ObjectId()
+
+def at(minute: int) -> date.datetime:
+    return date.datetime(2024, 5, 1, 12, minute, tzinfo=date.timezone.utc)
+
+def entry(minute: int, hidden: bool = False) -> dict:
+    return {"message_id": ObjectId(), "role": "user", "content": f"message {minute}", "created_at": at(minute), "hiddenFlag": hidden}
+
+def bucket(entries: list, use_case_id: str = "uc-1", all_hidden: bool = False) -> dict:
+    times = [item["created_at"] for item in entries]
+    return {
+        "_id": ObjectId(), "gpt_id": GPT_ID, "use_case_id": use_case_id, "count": len(entries),
+        "first_at": min(times), "last_at": max(times), "all_hidden": all_hidden, "messages": entries,
+    }
+
+def contents(messages: list) -> list:
+    return [message["content"] for message in messages]
+
+async def collect(iterator) -> list:
+    return [message async for message in iterator]
+
+@pytest.fixture
+def buckets(monkeypatch):
+    collection = FakeCollection()
+
+    async def get_buckets_collection():
+        return collection
+
+    monkeypatch.setattr(message_buckets, "get_buckets_collection", get_buckets_collection)
+    return collection
+
+def test_read_gpt_messages_skips_hidden_entries_and_hidden_buckets(buckets):
+    buckets.documents = [
+        bucket([entry(1), entry(2, hidden=True), entry(3)]),
+        bucket([entry(4), entry(5)], all_hidden=True),
+        bucket([entry(6), entry(7)]),
+    ]
+
+    assert contents(asyncio.run(message_buckets.read_gpt_messages(str(GPT_ID), 0))) == ["message 7", "message 6", "message 3", "message 1"]
+    assert contents(asyncio.run(message_buckets.read_gpt_messages(str(GPT_ID), 2))) == ["message 7", "message 6"]
+
+def test_iter_messages_is_oldest_first_across_overlapping_buckets(buckets):
+    buckets.documents = [
+        bucket([entry(1), entry(4), entry(9)], use_case_id="uc-1"),
+        bucket([entry(2), entry(3, hidden=True), entry(8)], use_case_id="uc-2"),
+        bucket([entry(5), entry(6)], use_case_id="uc-1", all_hidden=True),
+        bucket([entry(7), entry(10)], use_case_id="uc-2"),
+    ]
+
+    messages = asyncio.run(collect(message_buckets.iter_messages(str(GPT_ID))))
+
+    assert contents(messages) == [f"message {minute}" for minute in (1, 2, 4, 7, 8, 9, 10)]
+    assert contents(asyncio.run(collect(message_buckets.iter_messages(str(GPT_ID), "uc-2")))) == ["message 2", "message 7", "message 8", "message 10"]
+
+def test_read_page_returns_the_messages_next_to_the_cursor(buckets):
+    entries = [entry(minute) for minute in range(1, 9)]
+    buckets.documents = [bucket(entries[:4]), bucket(entries[4:])]
+    cursor = (entries[4]["created_at"], entries[4]["message_id"])
+
+    older = asyncio.run(message_buckets.read_page(str(GPT_ID), cursor=cursor, older=True, limit=3))
+    newer = asyncio.run(message_buckets.read_page(str(GPT_ID), cursor=cursor, older=False, limit=2))
+
+    assert contents(older) == ["message 4", "message 3", "message 2"]
+    assert contents(newer) == ["message 6", "message 7"]
+
+def test_merge_histories_orders_legacy_and_bucketed_messages_without_duplicates():
+    shared_id = ObjectId()
+    legacy = [
+        {"_id": ObjectId(), "content": "legacy string", "created_at": "2024-04-30T09:00:00"},
+        {"_id": shared_id, "content": "legacy copy", "created_at": at(2)},
+        {"_id": ObjectId(), "content": "legacy native", "created_at": at(1)},
+    ]
+    bucketed = [
+        {"_id": shared_id, "content": "bucketed copy", "created_at": at(2)},
+        {"_id": ObjectId(), "content": "bucketed", "created_at": at(3)},
+    ]
+
+    assert contents(message_buckets.merge_histories(legacy, bucketed, 0, descending=True)) == ["bucketed", "bucketed copy", "legacy native", "legacy string"]
+    assert contents(message_buckets.merge_histories(legacy, bucketed, 0, descending=False)) == ["legacy string", "legacy native", "bucketed copy", "bucketed"]
+    assert contents(message_buckets.merge_histories(legacy, bucketed, 2, descending=True)) == ["bucketed", "bucketed copy"]
+
+def test_build_append_operation_never_appends_to_a_hidden_or_full_bucket():
+    message_id, operation = message_buckets.build_append_operation({"gpt_id": str(GPT_ID), "use_case_id": "uc-1", "role": "user", "content": "hello", "created_at": at(1)})
+    full = bucket([entry(1)])
+    full["count"] = message_buckets.MESSAGE_BUCKET_SIZE
+
+    assert operation._doc["$push"]["messages"]["message_id"] == message_id
+    assert matches(bucket([entry(1)]), operation._filter)
+    assert not matches(bucket([entry(1)], all_hidden=True), operation._filter)
+    assert not matches(full, operation._filter)
@@ -0,0 +1,120 @@
+import asyncio
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import message_writer
+from message_writer import MessageWriter
+from mongo_fakes import FakeCollection
+
+GPT_ID = str(ObjectId())
+
+def message(number: int) -> dict:
+    return {"_id": ObjectId(), "gpt_id": GPT_ID, "use_case_id": "uc-1", "role": "user", "content": f"message {number}"}
+
+class FlakyMessages(FakeCollection):
+    """Rejects the documents at failing_indexes on the first bulk write, with a non duplicate key error."""
+
+    def __init__(self, failing_indexes: set):
+        super().__init__()
+        self.failing_indexes = failing_indexes
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        if self.bulk_writes:
+            return await super().bulk_write(operations, ordered)
+        self.bulk_writes.append(len(operations))
+        self.documents.extend(operation._doc for index, operation in enumerate(operations) if index not in self.failing_indexes)
+        errors = [{"index": index, "code": 121, "errmsg": "Document failed validation"} for index in sorted(self.failing_indexes)]
+        raise BulkWriteError({"nInserted": len(operations) - len(errors), "writeErrors": errors})
+
+class InterruptedBuckets(FakeCollection):
+    """Applies the first append of the first bulk write, then loses the connection."""
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        self.bulk_writes.append(len(operations))
+        for index, operation in enumerate(operations):
+            if len(self.bulk_writes) == 1 and index == 1:
+                raise AutoReconnect("connection reset")
+            self.documents.append({"_id": ObjectId(), **operation._filter, "messages": [operation._doc["$push"]["messages"]]})
+
+@pytest.fixture
+def database(monkeypatch):
+    collections = {"messages": FakeCollection(), "message_buckets": FakeCollection()}
+
+    async def get_mongo_db():
+        return collections
+
+    monkeypatch.setattr(message_writer, "get_mongo_db", get_mongo_db)
+    monkeypatch.setattr(message_writer, "MESSAGE_WRITER_RETRY_BACKOFF_MS", 0)
+    monkeypatch.setattr(message_writer, "MESSAGE_WRITE_DURABILITY", "sync")
+    monkeypatch.setattr(message_writer, "MESSAGE_BUCKETS_ENABLED", False)
+    return collections
+
+def test_duplicate_key_errors_count_as_written(database):
+    existing = message(1)
+    database["messages"].documents.append(dict(existing))
+    writer = MessageWriter()
+
+    asyncio.run(writer._write_with_retries([existing, message(2)], max_retries=3))
+
+    assert database["messages"].bulk_writes == [2]
+    assert len(database["messages"].documents) == 2
+    assert writer.stats()["retries"] == 0
+    assert writer.stats()["written"] == 2
+
+def test_only_the_failed_documents_are_retried(database):
+    database["messages"] = FlakyMessages(failing_indexes={1})
+    documents = [message(number) for number in range(3)]
+    writer = MessageWriter()
+
+    asyncio.run(writer._write_with_retries(documents, max_retries=3))
+
+    assert database["messages"].bulk_writes == [3, 1]
+    assert sorted(document["content"] for document in database["messages"].documents) == ["message 0", "message 1", "message 2"]
+    assert writer.stats()["retries"] == 1
+
+def test_interrupted_bucket_appends_are_not_pushed_twice(database, monkeypatch):
+    monkeypatch.setattr(message_writer, "MESSAGE_BUCKETS_ENABLED", True)
+    database["message_buckets"] = InterruptedBuckets()
+    documents = [message(number) for number in range(3)]
+
+    asyncio.run(MessageWriter()._write_with_retries(documents, max_retries=3))
+
+    appended = [entry["message_id"] for bucket in database["message_buckets"].documents for entry in bucket["messages"]]
+    assert database["message_buckets"].bulk_writes == [3, 2]
+    assert sorted(appended) == sorted(document["_id"] for document in documents)
+
+def test_stop_flushes_write_behind_messages(database, monkeypatch):
+    monkeypatch.setattr(message_writer, "MESSAGE_WRITE_DURABILITY", "write_behind")
+    monkeypatch.setattr(message_writer, "MESSAGE_WRITER_FLUSH_INTERVAL_MS", 50)
+    writer = MessageWriter()
+
+    async def write_and_stop():
+        ids = [await writer.write(message(number)) for number in range(5)]
+        assert database["messages"].documents == []
+        await writer.stop()
+        return ids
+
+    ids = asyncio.run(write_and_stop())
+
+    assert [document["_id"] for document in database["messages"].documents] == ids
+    assert writer.stats()["pending"] == 0
+    assert writer.stats()["lost"] == 0
+
+def test_stop_writes_messages_left_by_a_crashed_writer_task(database, monkeypatch):
+    monkeypatch.setattr(message_writer, "MESSAGE_WRITE_DURABILITY", "write_behind")
+    writer = MessageWriter()
+
+    async def write_after_crash_and_stop():
+        writer._ensure_started()
+        writer._task.cancel()
+        await asyncio.sleep(0)
+        # A cancelled task is restarted by the next write, so the messages go straight to the queue
+        for number in range(3):
+            writer._queue.put_nowait((message(number), None))
+        await writer.stop()
+
+    asyncio.run(write_after_crash_and_stop())
+
+    assert len(database["messages"].documents) == 3
+    assert writer.stats()["pending"] == 0
@@ -0,0 +1,184 @@
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from tokenizer_registry import tokenizer_registry, image_dimensions, TOKENIZER_DEFAULT_ENCODING
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+TOKEN_LEDGER_MAX_ENTRIES = int(os.getenv("TOKEN_LEDGER_MAX_ENTRIES", 20000))
+
+class TokenLedger:
+    """
+    Token counts of message contents for one encoding, cached by content hash. A text is tokenized once; afterwards its count costs a hash.
+    Counts persisted with the messages (token_count) are fed back with prime(), so history is never re-tokenized.
+    """
+
+    def __init__(self, encoding_name: str = TOKENIZER_DEFAULT_ENCODING):
+        self.encoding_name = encoding_name
+        self._counts: OrderedDict = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "primed": 0, "tokenized_chars": 0}
+
+    def _key(self, text: str) -> str:
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+    def count(self, text) -> int:
+        """Token count of a text (non strings are counted as their str())."""
+        text = text if isinstance(text, str) else str(text)
+        key = self._key(text)
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+            self._stats["hits"] += 1
+            return count
+
+        count = len(tokenizer_registry.get_encoder(self.encoding_name).encode(text, disallowed_special=()))
+        self._stats["misses"] += 1
+        self._stats["tokenized_chars"] += len(text)
+        self._store(key, count)
+        return count
+
+    def count_many(self, texts: list) -> list[int]:
+        """Token counts of several texts. The texts missing from the cache are tokenized together with encode_batch."""
+        texts = [text if isinstance(text, str) else str(text) for text in texts]
+        keys = [self._key(text) for text in texts]
+        counts = [self._counts.get(key) for key in keys]
+
+        # Repeated texts are tokenized once
+        missing = {keys[index]: texts[index] for index, count in enumerate(counts) if count is None}
+        self._stats["hits"] += len(texts) - len(missing)
+        if missing:
+            encoded = tokenizer_registry.get_encoder(self.encoding_name).encode_batch(list(missing.values()), disallowed_special=())
+            tokenized = {key: len(tokens) for key, tokens in zip(missing, encoded)}
+            for key, count in tokenized.items():
+                self._store(key, count)
+                self._stats["tokenized_chars"] += len(missing[key])
+            self._stats["misses"] += len(missing)
+            counts = [tokenized[key] if count is None else count for key, count in zip(keys, counts)]
+        return counts
+
+    def count_content(self, content, deployment: str = None) -> int:
+        """Tokens of a message content: a text, or a list of text and image_url parts (images are priced by their size and detail)."""
+        if not isinstance(content, list):
+            return self.count(content)
+
+        tokens = 0
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                image_url = part.get("image_url") or {}
+                width, height = image_dimensions(image_url.get("url"))
+                tokens += tokenizer_registry.image_tokens(deployment, width, height, image_url.get("detail", "auto"))
+            elif isinstance(part, dict) and part.get("type") == "text":
+                tokens += self.count(part.get("text", ""))
+            else:
+                tokens += self.count(part)
+        return tokens
+
+    def prime(self, text, token_count: int):
+        """Remember a persisted token count, so the text is not tokenized again."""
+        if token_count is None:
+            return
+        text = text if isinstance(text, str) else str(text)
+        self._store(self._key(text), int(token_count))
+        self._stats["primed"] += 1
+
+    def prime_messages(self, messages: list):
+        for message in messages or []:
+            if "token_count" in message and "content" in message:
+                self.prime(message["content"], message["token_count"])
+
+    def _store(self, key: str, count: int):
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        while len(self._counts) > TOKEN_LEDGER_MAX_ENTRIES:
+            self._counts.popitem(last=False)
+
+    def count_messages(self, messages: list, include_system: bool = True, deployment: str = None) -> int:
+        """Content tokens of a list of chat messages (without the chat format overhead)."""
+        messages = [message for message in messages if include_system or message.get("role") != "system"]
+        texts = [message["content"] for message in messages if not isinstance(message["content"], list)]
+        parts = [message["content"] for message in messages if isinstance(message["content"], list)]
+        return sum(self.count_many(texts)) + sum(self.count_content(content, deployment) for content in parts)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["entries"] = len(self._counts)
+        stats["encoding"] = self.encoding_name
+        return stats
+
+class ConversationTokens:
+    """
+    Running token totals of a conversation list that grows by appends: only messages added since the last call are counted.
+    If the list is changed in any other way (messages removed or replaced), it is counted again from scratch.
+    """
+
+    def __init__(self, conversations: list, deployment: str = None):
+        self.conversations = conversations
+        self.deployment = deployment
+        self.ledger = ledger_for(deployment)
+        self._counted: list = []
+        self._system_tokens = 0
+        self._history_tokens = 0
+
+    def _refresh(self):
+        counted = len(self._counted)
+        if len(self.conversations) < counted or any(self.conversations[i] is not self._counted[i] for i in range(counted)):
+            self._counted, self._system_tokens, self._history_tokens = [], 0, 0
+
+        new_messages = self.conversations[len(self._counted):]
+        # Plain text contents are counted in one batch, multi-part contents (text and images) one by one
+        text_counts = iter(self.ledger.count_many([message["content"] for message in new_messages if not isinstance(message["content"], list)]))
+        for message in new_messages:
+            if isinstance(message["content"], list):
+                tokens = self.ledger.count_content(message["content"], self.deployment)
+            else:
+                tokens = next(text_counts)
+            if message.get("role") == "system":
+                self._system_tokens += tokens
+            else:
+                self._history_tokens += tokens
+            self._counted.append(message)
+
+    def total(self) -> int:
+        """Prompt tokens of the conversation, including the chat format overhead."""
+        self._refresh()
+        return self._system_tokens + self._history_tokens + tokenizer_registry.chat_overhead(self.conversations)
+
+    def token_data(self, user_message: str, max_tokens: int = 0) -> dict:
+        """Same breakdown as gpt_utils.get_token_count."""
+        self._refresh()
+        query_tokens = self.ledger.count(user_message or "")
+        overhead = tokenizer_registry.chat_overhead(self.conversations)
+        return {"token_breakdown":
+                    {
+                        "message_history": self._history_tokens,
+                        "user_query": query_tokens,
+                        "system_message": self._system_tokens,
+                        "chat_overhead": overhead,
+                        "max_response": max_tokens,
+                        "estimated_max_tokens": self._system_tokens + self._history_tokens + query_tokens + overhead + max_tokens
+                    }
+                }
+
+_ledgers: dict[str, TokenLedger] = {}
+
+def ledger_for(deployment: str = None) -> TokenLedger:
+    """The ledger of the deployment's encoding (one ledger per encoding, shared by all deployments using it)."""
+    encoding_name = tokenizer_registry.encoding_name_for(deployment)
+    ledger = _ledgers.get(encoding_name)
+    if ledger is None:
+        ledger = _ledgers[encoding_name] = TokenLedger(encoding_name)
+    return ledger
+
+def ledger_stats() -> dict:
+    return {"ledgers": {encoding_name: ledger.stats() for encoding_name, ledger in _ledgers.items()}, "tokenizers": tokenizer_registry.stats()}
+
+# Process wide ledger of the default encoding
+token_ledger = ledger_for()
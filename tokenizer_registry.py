@@ -0,0 +1,128 @@
+import os
+import json
+import math
+import base64
+import struct
+import logging
+import threading
+import tiktoken
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+
+# Deployment name -> tiktoken encoding, e.g. {"nia-gpt-4o-2": "o200k_base", "nia-gpt-35-turbo": "cl100k_base"}
+TOKENIZER_DEPLOYMENT_ENCODINGS = json.loads(os.getenv("TOKENIZER_DEPLOYMENT_ENCODINGS", "{}"))
+TOKENIZER_DEFAULT_ENCODING = os.getenv("TOKENIZER_DEFAULT_ENCODING", "o200k_base")
+# Size assumed for images whose dimensions cannot be read (e.g. blob storage URLs)
+TOKENIZER_DEFAULT_IMAGE_SIZE = os.getenv("TOKENIZER_DEFAULT_IMAGE_SIZE", "1024x1024")
+
+# Model families recognised in deployment names, most specific first: (name fragment, encoding)
+MODEL_FAMILY_ENCODINGS = [
+    ("gpt-4o", "o200k_base"), ("gpt4o", "o200k_base"), ("gpt-4.1", "o200k_base"), ("gpt-5", "o200k_base"),
+    ("o1", "o200k_base"), ("o3", "o200k_base"), ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"), ("gpt4", "cl100k_base"), ("gpt-35", "cl100k_base"), ("gpt-3.5", "cl100k_base"),
+    ("text-embedding", "cl100k_base"),
+]
+
+# Chat format overhead (OpenAI cookbook): every message is wrapped in <|start|>{role}\n{content}<|end|>\n,
+# a name costs one extra token and every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+# Vision pricing: (base tokens, tokens per 512px tile). Low detail images cost only the base tokens.
+IMAGE_TOKENS = {"gpt-4o-mini": (2833, 5667), "default": (85, 170)}
+
+class TokenizerRegistry:
+    """
+    Maps deployment names to tiktoken encodings and shares one encoder per encoding across the process.
+    Encoders are loaded on first use (loading reads the BPE ranks), not at import time.
+    """
+
+    def __init__(self):
+        self._encoders: dict = {}
+        self._deployment_encodings: dict = {}
+        self._lock = threading.Lock()
+
+    def encoding_name_for(self, deployment: str = None) -> str:
+        if not deployment:
+            return TOKENIZER_DEFAULT_ENCODING
+
+        encoding_name = self._deployment_encodings.get(deployment)
+        if encoding_name is None:
+            encoding_name = TOKENIZER_DEPLOYMENT_ENCODINGS.get(deployment)
+            if encoding_name is None:
+                lowered = deployment.lower()
+                encoding_name = next((encoding for fragment, encoding in MODEL_FAMILY_ENCODINGS if fragment in lowered), TOKENIZER_DEFAULT_ENCODING)
+            self._deployment_encodings[deployment] = encoding_name
+        return encoding_name
+
+    def get_encoder(self, encoding_name: str = TOKENIZER_DEFAULT_ENCODING) -> tiktoken.Encoding:
+        encoder = self._encoders.get(encoding_name)
+        if encoder is None:
+            # Loaded once, even when several callers need a new encoding at the same time
+            with self._lock:
+                encoder = self._encoders.get(encoding_name)
+                if encoder is None:
+                    encoder = tiktoken.get_encoding(encoding_name)
+                    self._encoders[encoding_name] = encoder
+                    logger.info(f"Loaded tokenizer {encoding_name}")
+        return encoder
+
+    def encoder_for(self, deployment: str = None) -> tiktoken.Encoding:
+        return self.get_encoder(self.encoding_name_for(deployment))
+
+    def image_tokens(self, deployment: str = None, width: int = None, height: int = None, detail: str = "auto") -> int:
+        """Tokens of one image input: base tokens, plus tiles of 512px after the image is fit into 2048px and its short side scaled to 768px."""
+        lowered = (deployment or "").lower()
+        base_tokens, tile_tokens = next((value for family, value in IMAGE_TOKENS.items() if family in lowered), IMAGE_TOKENS["default"])
+        if detail == "low":
+            return base_tokens
+
+        if not width or not height:
+            width, height = (int(value) for value in TOKENIZER_DEFAULT_IMAGE_SIZE.lower().split("x"))
+
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return base_tokens + tile_tokens * math.ceil(width / 512) * math.ceil(height / 512)
+
+    def chat_overhead(self, messages: list) -> int:
+        """Formatting tokens of a chat request, on top of the content tokens."""
+        return TOKENS_PER_MESSAGE * len(messages) + TOKENS_PER_NAME * sum(1 for message in messages if message.get("name")) + TOKENS_PER_REPLY
+
+    def stats(self) -> dict:
+        return {"loaded_encodings": sorted(self._encoders), "deployments": dict(self._deployment_encodings)}
+
+def image_dimensions(url: str) -> tuple:
+    """(width, height) of a base64 data URL image (PNG or JPEG), read from its header only. (None, None) when unknown."""
+    if not url or not url.startswith("data:") or "," not in url:
+        return None, None
+    try:
+        # The dimensions are in the first few KB of the file
+        data = base64.b64decode(url.split(",", 1)[1][:65536])
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", data[16:24])
+        if data[:2] == b"\xff\xd8":
+            index = 2
+            while index + 9 < len(data):
+                if data[index] != 0xFF:
+                    index += 1
+                    continue
+                marker = data[index + 1]
+                segment_length = struct.unpack(">H", data[index + 2:index + 4])[0]
+                # Start of frame markers carry the dimensions (SOF0-SOF15 except DHT, JPG and DAC)
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", data[index + 5:index + 9])
+                    return width, height
+                index += 2 + segment_length
+    except Exception as e:
+        logger.debug(f"Could not read the image dimensions: {e}")
+    return None, None
+
+# Process wide registry
+tokenizer_registry = TokenizerRegistry()